@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the dictionary build pipeline.
+
+Runs against synthetic dictionary sources, without a database or Celery.
+
+Usage:
+    python scripts/benchmark_dictionary_creator.py tokenizer
+    python scripts/benchmark_dictionary_creator.py tokenizer --sizes 100000 1000000
+    python scripts/benchmark_dictionary_creator.py memory
+    python scripts/benchmark_dictionary_creator.py parallel --workers 1 2 4 8
+    python scripts/benchmark_dictionary_creator.py html --sizes 10000 100000 1000000
+    python scripts/benchmark_dictionary_creator.py compact --kindlegen "wine /opt/kindlegen/kindlegen.exe"
+
+Each subcommand prints one line per input size.
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import shlex
+import random
+import shutil
+import zipfile
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+WORDS = ['zamek', 'gęśl', 'jaźń', 'kot', 'pies', 'dom', 'łódź', 'rzeka', 'mięso', 'źdźbło']
+ENDINGS = ['a', 'u', 'em', 'ami', 'ach', 'om', 'y', 'ie']
+
+
+def legacy_parse_line(line):
+    """parse_line as it was before the tokenizer module (reference baseline)."""
+    match = re.match(r'^(.*?)\s*\|\s*(\{.*?\})?\s+(.*)$', line)
+    if match:
+        term = match.group(1).strip()
+        inflections = match.group(2)
+        description = match.group(3).strip()
+        if inflections:
+            inflections = inflections.strip('{}').split(',')
+            inflections = [inf.strip() for inf in inflections]
+        else:
+            inflections = []
+        return {'term': term, 'inflections': inflections, 'description': description}
+    else:
+        return None
+
+
+def legacy_generate_entry_html(entry, indent=0):
+    """generate_entry_html before the fragment writer (reference baseline)."""
+    indent_str = '    ' * indent
+    term = entry.term
+    inflections = entry.inflections
+    description = entry.description
+    idx_infl = ''
+    if inflections:
+        idx_infl = '\n' + indent_str + '                <idx:infl>\n'
+        for inf in inflections:
+            idx_infl += indent_str + f'                    <idx:iform value="{inf}"/>\n'
+        idx_infl += indent_str + '                </idx:infl>\n'
+    else:
+        idx_infl = ''
+    header_tag = 'h2'
+    processed_description = re.sub(r'(\\n|\r|<br>|<BR>)', '</p><p>', description)
+    entry_html = indent_str + f'''        <idx:entry name="word" scriptable="yes">
+{indent_str}            <idx:orth value="{term.lower()}">
+{indent_str}                <{header_tag}>{term}</{header_tag}>{idx_infl}{indent_str}            </idx:orth>
+{indent_str}            <p>{processed_description}</p>
+'''
+    if entry.children:
+        for child in entry.children:
+            entry_html += legacy_generate_entry_html(child, indent=indent+2)
+    entry_html += indent_str + f'''        </idx:entry>
+'''
+    return entry_html
+
+
+def legacy_generate_html(entries, header, footer):
+    """generate_html before streaming: the whole document as one string built with +=."""
+    html_entries = ''
+    for entry in entries:
+        html_entries += legacy_generate_entry_html(entry)
+    return header + html_entries + footer
+
+
+def setup_django():
+    """Configure minimal Django settings so dictionary_creator can be imported."""
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(BASE_DIR=os.path.abspath(SRC_DIR))
+
+
+def legacy_entries(lines):
+    """Dict-based entry list as built by process_dictionary_content before Entry."""
+    entries = []
+    current_group = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('~'):
+            entry = legacy_parse_line(line[1:].strip())
+            if entry is None:
+                continue
+            entry['children'] = []
+            entries.append(entry)
+            current_group = entry
+        elif line.startswith('+'):
+            if current_group is None:
+                continue
+            entry = legacy_parse_line(line[1:].strip())
+            if entry is None:
+                continue
+            current_group['children'].append(entry)
+        else:
+            entry = legacy_parse_line(line)
+            if entry is None:
+                continue
+            entries.append(entry)
+            current_group = None
+    return entries
+
+
+def synthetic_lines(count, seed=1):
+    """Generate ``count`` source lines with groups, inflections and paragraphs."""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        term = f"{rng.choice(WORDS)}{i}"
+        if rng.random() < 0.5:
+            inflections = ' {' + ', '.join(term + e for e in rng.sample(ENDINGS, 3)) + '}'
+        else:
+            inflections = ''
+        description = f"Opis hasła {term}.\\nDrugi akapit opisu numer {i}."
+        prefix = rng.choice(['', '', '', '~', '+'])
+        lines.append(f"{prefix}{term} |{inflections} {description}")
+    return lines
+
+
+def _rate(func, lines):
+    start = time.perf_counter()
+    for line in lines:
+        func(line)
+    elapsed = time.perf_counter() - start
+    return len(lines) / elapsed if elapsed else float('inf')
+
+
+def bench_tokenizer(args):
+    """Compare lines/sec of the tokenizer against the legacy regex parse_line."""
+    from dictionary.tokenizer import tokenize_line
+
+    for size in args.sizes:
+        lines = synthetic_lines(size)
+        for line in lines[:1000]:
+            tokens = tokenize_line(line)
+            legacy = legacy_parse_line(line)
+            assert tokens == (legacy['term'], legacy['inflections'], legacy['description'])
+        legacy_rate = _rate(legacy_parse_line, lines)
+        new_rate = _rate(tokenize_line, lines)
+        print(f"{size:>9} lines  legacy: {legacy_rate:>12,.0f} lines/s  "
+              f"tokenizer: {new_rate:>12,.0f} lines/s  speedup: {new_rate / legacy_rate:.2f}x")
+
+
+def _traced_bytes(build, lines):
+    tracemalloc.start()
+    try:
+        entries = build(lines)
+        size, _peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return entries, size
+
+
+def bench_memory(args):
+    """Compare retained bytes per parsed entry: dicts vs slotted Entry objects."""
+    setup_django()
+    from dictionary.dictionary_creator import iter_entries
+
+    for size in args.sizes:
+        lines = synthetic_lines(size)
+        legacy, legacy_bytes = _traced_bytes(legacy_entries, lines)
+        current, current_bytes = _traced_bytes(lambda l: list(iter_entries(l)), lines)
+        count = sum(1 + len(entry['children']) if 'children' in entry else 1 for entry in legacy)
+        assert count == sum(1 + len(entry.children) for entry in current)
+        print(f"{size:>9} lines  {count} entries  dict: {legacy_bytes / count:>7.1f} B/entry  "
+              f"Entry: {current_bytes / count:>7.1f} B/entry  "
+              f"saved: {100 * (1 - current_bytes / legacy_bytes):.0f}%")
+
+
+def bench_parallel(args):
+    """Compare in-process parse+render with the process pool for several worker counts."""
+    setup_django()
+    from dictionary.dictionary_creator import HtmlPartWriter, iter_entries, write_entries, write_entries_parallel
+
+    workers_list = args.workers or list(range(1, (os.cpu_count() or 1) + 1))
+    print(f"CPU cores: {os.cpu_count()}")
+    for size in args.sizes:
+        lines = synthetic_lines(size)
+        with tempfile.TemporaryDirectory() as work_dir:
+            with HtmlPartWriter(work_dir, 'bench') as html_writer:
+                start = time.perf_counter()
+                write_entries(html_writer, iter_entries(lines))
+                baseline = time.perf_counter() - start
+        print(f"{size:>9} lines  in-process: {baseline:.2f}s")
+        for workers in workers_list:
+            with tempfile.TemporaryDirectory() as work_dir:
+                with HtmlPartWriter(work_dir, 'bench') as html_writer:
+                    start = time.perf_counter()
+                    write_entries_parallel(html_writer, lines, workers, args.chunk_lines)
+                    elapsed = time.perf_counter() - start
+            print(f"{'':>9}        {workers:>2} workers: {elapsed:.2f}s  speedup: {baseline / elapsed:.2f}x")
+
+
+def bench_html(args):
+    """Compare the fragment writer with the legacy string-concatenation renderer."""
+    setup_django()
+    from dictionary.dictionary_creator import iter_entries, write_html, _HTML_HEADER, _HTML_FOOTER
+
+    for size in args.sizes:
+        entries = list(iter_entries(synthetic_lines(size)))
+        with open(os.devnull, 'w', encoding='utf-8') as f:
+            start = time.perf_counter()
+            f.write(legacy_generate_html(entries, _HTML_HEADER, _HTML_FOOTER))
+            legacy = time.perf_counter() - start
+        with open(os.devnull, 'w', encoding='utf-8') as f:
+            start = time.perf_counter()
+            write_html(f, entries, 'bench', {})
+            current = time.perf_counter() - start
+        buffer = io.StringIO()
+        write_html(buffer, entries[:1000], 'bench', {})
+        assert buffer.getvalue() == legacy_generate_html(entries[:1000], _HTML_HEADER, _HTML_FOOTER)
+        print(f"{len(entries):>9} entries  legacy: {legacy:.2f}s  writer: {current:.2f}s  "
+              f"speedup: {legacy / current:.2f}x")
+
+
+def _build_html(work_dir, entries, compact):
+    """Render entries into work_dir and return (seconds, HTML bytes, deflated bytes)."""
+    from dictionary.dictionary_creator import HtmlPartWriter, write_entries
+
+    start = time.perf_counter()
+    with HtmlPartWriter(work_dir, 'bench', compact=compact) as html_writer:
+        write_entries(html_writer, entries)
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(path) for path in html_writer.paths)
+    zip_path = os.path.join(work_dir, 'bench.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for path in html_writer.paths:
+            zipf.write(path, os.path.basename(path))
+    zipped = os.path.getsize(zip_path)
+    os.remove(zip_path)
+    return elapsed, size, zipped, [os.path.basename(path) for path in html_writer.paths]
+
+
+def _run_kindlegen(command, work_dir, html_files):
+    """Build the rendered dictionary with kindlegen and return (seconds, exit code)."""
+    from django.conf import settings
+    from dictionary.dictionary_creator import generate_opf, generate_cover_image
+
+    language_info = {'language_code': 'pl', 'creator_name': 'benchmark', 'output_encoding': 'utf-8',
+                     'dictionary_in_language': 'pl', 'dictionary_out_language': 'pl'}
+    opf_path = os.path.join(work_dir, 'bench.opf')
+    with open(opf_path, 'w', encoding='utf-8') as f:
+        f.write(generate_opf('bench', language_info, html_files))
+    shutil.copy(os.path.join(settings.BASE_DIR, 'static', 'css', 'styles.css'), work_dir)
+    generate_cover_image('bench', os.path.join(work_dir, 'bench.jpg'))
+    start = time.perf_counter()
+    result = subprocess.run(shlex.split(command) + ['bench.opf'], cwd=work_dir, capture_output=True)
+    return time.perf_counter() - start, result.returncode
+
+
+def bench_compact(args):
+    """Compare HTML size (and optionally kindlegen time) of the indented and compact layouts."""
+    setup_django()
+    from dictionary.dictionary_creator import iter_entries
+
+    for size in args.sizes:
+        entries = list(iter_entries(synthetic_lines(size)))
+        results = {}
+        for compact in (False, True):
+            with tempfile.TemporaryDirectory() as work_dir:
+                elapsed, html_bytes, zipped, html_files = _build_html(work_dir, entries, compact)
+                kindlegen = _run_kindlegen(args.kindlegen, work_dir, html_files) if args.kindlegen else None
+            results[compact] = (elapsed, html_bytes, zipped, kindlegen)
+
+        (indented_time, indented_bytes, indented_zip, indented_kg), (compact_time, compact_bytes, compact_zip, compact_kg) = \
+            results[False], results[True]
+        print(f"{len(entries):>9} entries  indented: {indented_bytes / 1e6:.1f} MB ({indented_zip / 1e6:.1f} MB zipped, "
+              f"{indented_time:.2f}s)  compact: {compact_bytes / 1e6:.1f} MB ({compact_zip / 1e6:.1f} MB zipped, "
+              f"{compact_time:.2f}s)  saved: {100 * (1 - compact_bytes / indented_bytes):.0f}%")
+        if args.kindlegen:
+            print(f"{'':>9}          kindlegen indented: {indented_kg[0]:.1f}s (exit {indented_kg[1]})  "
+                  f"compact: {compact_kg[0]:.1f}s (exit {compact_kg[1]})  "
+                  f"speedup: {indented_kg[0] / compact_kg[0]:.2f}x")
+
+
+def setup_argparse():
+    """Setup command line arguments."""
+    parser = argparse.ArgumentParser(description='Benchmark the dictionary build pipeline')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    tokenizer = subparsers.add_parser('tokenizer', help='Line tokenizer vs legacy regex parse_line')
+    tokenizer.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000],
+                           help='Number of synthetic lines per run')
+    tokenizer.set_defaults(func=bench_tokenizer)
+
+    memory = subparsers.add_parser('memory', help='Bytes per parsed entry: dicts vs Entry objects')
+    memory.add_argument('--sizes', type=int, nargs='+', default=[100000],
+                        help='Number of synthetic lines per run')
+    memory.set_defaults(func=bench_memory)
+
+    parallel = subparsers.add_parser('parallel', help='Process pool speedup vs number of workers')
+    parallel.add_argument('--sizes', type=int, nargs='+', default=[1000000],
+                          help='Number of synthetic lines per run')
+    parallel.add_argument('--workers', type=int, nargs='+',
+                          help='Worker counts to try (default: 1..CPU count)')
+    parallel.add_argument('--chunk-lines', type=int, default=20000,
+                          help='Source lines per chunk')
+    parallel.set_defaults(func=bench_parallel)
+
+    html = subparsers.add_parser('html', help='Fragment writer vs legacy string-concatenation renderer')
+    html.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                      help='Number of synthetic lines per run')
+    html.set_defaults(func=bench_html)
+
+    compact = subparsers.add_parser('compact', help='HTML size and kindlegen time: indented vs compact layout')
+    compact.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000],
+                         help='Number of synthetic lines per run')
+    compact.add_argument('--kindlegen', help='kindlegen command to time on both layouts, '
+                                             'e.g. "wine /opt/kindlegen/kindlegen.exe"')
+    compact.set_defaults(func=bench_compact)
+
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+    args = setup_argparse()
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
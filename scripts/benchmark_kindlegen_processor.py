@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the kindlegen job processor (process_kindlegen_jobs.py).
+
+throughput: queues a batch of jobs in a temporary media root and lets the
+processor run them with each given concurrency. kindlegen is replaced by a
+stub that sleeps for a fixed time and writes a small MOBI file, so the
+numbers show how well the worker pool overlaps jobs, not how fast kindlegen
+is. Prints one line per concurrency.
+
+scheduling: queues a batch of bulk jobs followed by a few interactive ones
+(as when a user creates a dictionary during an admin mass rebuild) and
+prints the queue wait per priority recorded in the job index; interactive
+jobs should start as soon as a worker is free.
+
+wine-startup: per-job Wine start-up overhead in a fresh prefix, with the
+wineserver started by every run (as without --wine-pool) and with the
+persistent wineserver of a WinePool slot.
+
+Usage:
+    python scripts/benchmark_kindlegen_processor.py throughput
+    python scripts/benchmark_kindlegen_processor.py throughput --jobs 32 --concurrency 1 2 4 8 --stub-seconds 0.5
+    python scripts/benchmark_kindlegen_processor.py scheduling --bulk 16 --interactive 4 --concurrency 2
+    python scripts/benchmark_kindlegen_processor.py wine-startup --runs 10
+    python scripts/benchmark_kindlegen_processor.py wine-startup --kindlegen-path ./src/tools/kindlegen.exe
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+import statistics
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Called by the processor as: <wine> <kindlegen> <opf> -o <mobi>
+STUB_KINDLEGEN = '''import sys, time
+time.sleep({seconds})
+with open(sys.argv[sys.argv.index('-o') + 1], 'wb') as f:
+    f.write(b'BOOKMOBI')
+'''
+
+
+def load_processor():
+    """Import process_kindlegen_jobs.py as a module."""
+    spec = importlib.util.spec_from_file_location(
+        'process_kindlegen_jobs', os.path.join(SCRIPTS_DIR, 'process_kindlegen_jobs.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_jobs(jobs_dir, count, priority='interactive', prefix='bench'):
+    """Create ``count`` pending jobs with a minimal OPF file each."""
+    for number in range(count):
+        job_dir = os.path.join(jobs_dir, f"{prefix}_{number}")
+        os.makedirs(job_dir)
+        with open(os.path.join(job_dir, 'bench.opf'), 'w', encoding='utf-8') as f:
+            f.write('<package/>')
+        with open(os.path.join(job_dir, 'job.json'), 'w', encoding='utf-8') as f:
+            json.dump({'opf_file': 'bench.opf', 'output_file': 'bench.mobi', 'status': 'pending',
+                       'priority': priority, 'input_size': 10, 'created_at': time.time()}, f)
+
+
+@contextmanager
+def stub_kindlegen(stub_seconds):
+    """Temporary root directory holding the stub kindlegen; yields (root, stub path)."""
+    with tempfile.TemporaryDirectory() as root:
+        stub_path = os.path.join(root, 'kindlegen_stub.py')
+        with open(stub_path, 'w', encoding='utf-8') as f:
+            f.write(STUB_KINDLEGEN.format(seconds=stub_seconds))
+        yield root, stub_path
+
+
+def run_jobs(processor, jobs_dir, stub_path, concurrency):
+    """Process all pending jobs in ``jobs_dir`` like --one-shot does."""
+    # The Python interpreter takes the place of wine, the stub that of kindlegen.exe
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    processor.JobScheduler(executor, concurrency, jobs_dir, stub_path, sys.executable).run_pending()
+    executor.shutdown(wait=True)
+
+
+def run_batch(processor, root, stub_path, jobs, concurrency):
+    """Process a fresh batch of jobs; returns (seconds, completed jobs)."""
+    jobs_dir = os.path.join(root, f"kindlegen_jobs_{concurrency}")
+    create_jobs(jobs_dir, jobs)
+
+    start = time.perf_counter()
+    run_jobs(processor, jobs_dir, stub_path, concurrency)
+    elapsed = time.perf_counter() - start
+
+    completed = 0
+    for job in os.listdir(jobs_dir):
+        with open(os.path.join(jobs_dir, job, 'job.json'), 'r', encoding='utf-8') as f:
+            completed += json.load(f)['status'] == 'completed'
+    shutil.rmtree(jobs_dir)
+    return elapsed, completed
+
+
+def bench_throughput(args):
+    if os.name == 'nt':
+        print("The stub kindlegen is run through the Python interpreter in place of wine; not supported on Windows")
+        return 1
+    processor = load_processor()
+    logging.getLogger('kindlegen_processor').setLevel(logging.WARNING)
+
+    with stub_kindlegen(args.stub_seconds) as (root, stub_path):
+        baseline = None
+        for concurrency in args.concurrency:
+            elapsed, completed = run_batch(processor, root, stub_path, args.jobs, concurrency)
+            rate = args.jobs / elapsed
+            baseline = baseline or rate
+            print(f"concurrency={concurrency:3d}  jobs={args.jobs}  completed={completed}  "
+                  f"time={elapsed:6.2f}s  throughput={rate:6.2f} jobs/s  speedup={rate / baseline:4.2f}x")
+    return 0
+
+
+def bench_scheduling(args):
+    if os.name == 'nt':
+        print("The stub kindlegen is run through the Python interpreter in place of wine; not supported on Windows")
+        return 1
+    processor = load_processor()
+    logging.getLogger('kindlegen_processor').setLevel(logging.WARNING)
+
+    with stub_kindlegen(args.stub_seconds) as (root, stub_path):
+        jobs_dir = os.path.join(root, 'kindlegen_jobs')
+        create_jobs(jobs_dir, args.bulk, priority='bulk', prefix='bulk')
+        create_jobs(jobs_dir, args.interactive, priority='interactive', prefix='interactive')
+        processor.job_index = processor.JobIndex(jobs_dir)
+        processor.job_index.reindex()
+        try:
+            run_jobs(processor, jobs_dir, stub_path, args.concurrency)
+            waits = processor.job_index.waits_since(0)
+        finally:
+            processor.job_index = None
+
+    print(f"bulk={args.bulk}  interactive={args.interactive}  concurrency={args.concurrency}  "
+          f"stub={args.stub_seconds}s")
+    for priority in processor.PRIORITIES:
+        values = waits.get(priority, [])
+        if values:
+            print(f"  {priority:12s} mean wait={statistics.mean(values):6.2f}s  max wait={max(values):6.2f}s")
+    return 0
+
+
+def _time_wine(command, env, runs, before=None):
+    times = []
+    for _ in range(runs):
+        if before:
+            before()
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_wine_startup(args):
+    if not shutil.which(args.wine_path):
+        print(f"{args.wine_path} not found")
+        return 1
+    processor = load_processor()
+    # kindlegen without arguments only prints its usage
+    command = [args.wine_path, os.path.abspath(args.kindlegen_path)] if args.kindlegen_path \
+        else [args.wine_path, 'cmd', '/c', 'exit']
+
+    with tempfile.TemporaryDirectory() as root:
+        pool = processor.WinePool(1, root, args.wine_path)
+        pool.start()
+        slot = pool.slots.queue[0]
+        try:
+            # Without the pool the wineserver exits shortly after each job
+            cold = _time_wine(command, slot['env'], args.runs, before=lambda: pool.stop_server(slot))
+            pool.start_server(slot)
+            warm = _time_wine(command, slot['env'], args.runs)
+        finally:
+            pool.close()
+
+    cold_median = statistics.median(cold)
+    warm_median = statistics.median(warm)
+    print(f"{' '.join(command[1:])}: runs={args.runs}")
+    print(f"  wineserver per job:  median={cold_median:6.3f}s  min={min(cold):6.3f}s  max={max(cold):6.3f}s")
+    print(f"  persistent (pool):   median={warm_median:6.3f}s  min={min(warm):6.3f}s  max={max(warm):6.3f}s")
+    print(f"  start-up overhead saved per job: {cold_median - warm_median:6.3f}s")
+    return 0
+
+
+def setup_argparse():
+    """Setup command line arguments."""
+    parser = argparse.ArgumentParser(description='Benchmarks of the kindlegen job processor')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    throughput = subparsers.add_parser('throughput', help='Jobs per second vs worker pool size (stub kindlegen)')
+    throughput.add_argument('--jobs', type=int, default=16, help='Number of jobs per run')
+    throughput.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8],
+                            help='Worker pool sizes to measure')
+    throughput.add_argument('--stub-seconds', type=float, default=0.5,
+                            help='Time the stub kindlegen takes per job')
+    throughput.set_defaults(func=bench_throughput)
+
+    scheduling = subparsers.add_parser('scheduling', help='Queue wait per priority with bulk jobs queued first')
+    scheduling.add_argument('--bulk', type=int, default=16, help='Number of bulk jobs, queued first')
+    scheduling.add_argument('--interactive', type=int, default=4, help='Number of interactive jobs, queued last')
+    scheduling.add_argument('--concurrency', type=int, default=2, help='Worker pool size')
+    scheduling.add_argument('--stub-seconds', type=float, default=0.5,
+                            help='Time the stub kindlegen takes per job')
+    scheduling.set_defaults(func=bench_scheduling)
+
+    startup = subparsers.add_parser('wine-startup', help='Wine start-up time per job with and without a WinePool')
+    startup.add_argument('--wine-path', default='wine', help='Path to the wine executable')
+    startup.add_argument('--kindlegen-path', help='Time kindlegen.exe (usage output only) instead of cmd /c exit')
+    startup.add_argument('--runs', type=int, default=5, help='Runs per variant')
+    startup.set_defaults(func=bench_wine_startup)
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+    args = setup_argparse()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
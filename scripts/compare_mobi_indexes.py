@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Compare the headword indexes of two MOBI dictionaries.
+
+Checks a dictionary built by the native MOBI writer (dictionary/mobi_writer.py)
+against the same dictionary built by kindlegen: every headword kindlegen
+indexed must be found in the native book and lead to an entry with the same
+headword. Labels found only in the native book are listed separately; the
+native writer indexes inflected forms as labels, kindlegen keeps them in a
+separate inflection index.
+
+Usage:
+    python scripts/compare_mobi_indexes.py kindlegen.mobi native.mobi
+    python scripts/compare_mobi_indexes.py kindlegen.mobi native.mobi --show 50
+
+Exits with 1 if a headword is missing or leads to a different entry.
+"""
+
+import re
+import sys
+import struct
+import argparse
+from collections import defaultdict
+
+HEADWORD_PATTERN = re.compile(rb'<h\d[^>]*>(.*?)</h\d>', re.S)
+TAG_PATTERN = re.compile(rb'<[^>]*>')
+
+
+class MobiBook:
+    """Minimal reader of the PalmDB records, text and orthographic index of a MOBI file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        if self.data[60:68] != b'BOOKMOBI':
+            raise ValueError(f"Not a MOBI file: {path}")
+        count, = struct.unpack_from('>H', self.data, 76)
+        self.offsets = [struct.unpack_from('>I', self.data, 78 + 8 * i)[0] for i in range(count)]
+        self.offsets.append(len(self.data))
+
+        record0 = self.record(0)
+        self.compression, = struct.unpack_from('>H', record0, 0)
+        self.text_records, = struct.unpack_from('>H', record0, 8)
+        self.orth_index, = struct.unpack_from('>I', record0, 0x28)
+        header_length, = struct.unpack_from('>I', record0, 0x14)
+        self.extra_flags = 0
+        if header_length >= 0xE4:
+            self.extra_flags, = struct.unpack_from('>H', record0, 0xF2)
+        if self.orth_index == 0xFFFFFFFF:
+            raise ValueError(f"MOBI file has no orthographic index: {path}")
+        self._text = None
+
+    def record(self, number):
+        return self.data[self.offsets[number]:self.offsets[number + 1]]
+
+    def _trailing_size(self, record):
+        size = 0
+        flags = self.extra_flags >> 1
+        while flags:
+            if flags & 1:
+                value = 0
+                for byte in record[len(record) - size - 4:len(record) - size]:
+                    if byte & 0x80:
+                        value = 0
+                    value = (value << 7) | (byte & 0x7F)
+                size += value
+            flags >>= 1
+        if self.extra_flags & 1:
+            size += (record[len(record) - size - 1] & 0x3) + 1
+        return size
+
+    @property
+    def text(self):
+        if self._text is None:
+            parts = []
+            for number in range(1, self.text_records + 1):
+                record = self.record(number)
+                record = record[:len(record) - self._trailing_size(record)]
+                if self.compression == 2:
+                    record = palmdoc_decompress(record)
+                elif self.compression != 1:
+                    raise ValueError(f"Unsupported compression: {self.compression}")
+                parts.append(record)
+            self._text = b''.join(parts)
+        return self._text
+
+    def orth_entries(self):
+        """Yield ``(label, start, length)`` for every entry of the orthographic index."""
+        primary = self.record(self.orth_index)
+        header = _indx_header(primary)
+        control_bytes, tags = _tagx(primary, header['len'])
+        ordt = _ordt(primary)
+        for number in range(self.orth_index + 1, self.orth_index + 1 + header['count']):
+            record = self.record(number)
+            idxt, count = struct.unpack_from('>II', record, 20)
+            positions = [struct.unpack_from('>H', record, idxt + 4 + 2 * i)[0] for i in range(count)]
+            positions.append(idxt)
+            for start, end in zip(positions, positions[1:]):
+                length = record[start]
+                label = _decode_label(record[start + 1:start + 1 + length], ordt)
+                values = _tag_values(record, start + 1 + length, control_bytes, tags)
+                if 1 in values:
+                    yield label, values[1][0], values.get(2, [None])[0]
+
+    def headword_at(self, start, length):
+        """Headword of the entry at the given text position."""
+        end = start + length if length else start + 1024
+        entry = self.text[start:end]
+        match = HEADWORD_PATTERN.search(entry)
+        if match:
+            entry = match.group(1)
+        return TAG_PATTERN.sub(b'', entry).strip().decode('utf-8', 'replace')
+
+
+def palmdoc_decompress(data):
+    """Decompress a PalmDOC (LZ77) text record."""
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        c = data[i]
+        i += 1
+        if 1 <= c <= 8:
+            out += data[i:i + c]
+            i += c
+        elif c < 0x80:
+            out.append(c)
+        elif c >= 0xC0:
+            out += b' ' + bytes((c ^ 0x80,))
+        else:
+            c = (c << 8) | data[i]
+            i += 1
+            distance = (c >> 3) & 0x7FF
+            for _ in range((c & 7) + 3):
+                out.append(out[-distance])
+    return bytes(out)
+
+
+def _indx_header(record):
+    names = ('len', 'nul1', 'type', 'gen', 'start', 'count', 'code', 'lng', 'total', 'ordt', 'ligt', 'nligt', 'nctoc')
+    return dict(zip(names, struct.unpack_from('>13I', record, 4)))
+
+
+def _tagx(record, offset):
+    if record[offset:offset + 4] != b'TAGX':
+        raise ValueError("Index has no TAGX section")
+    length, control_bytes = struct.unpack_from('>II', record, offset + 4)
+    tags = [tuple(record[offset + i:offset + i + 4]) for i in range(12, length, 4)]
+    return control_bytes, tags
+
+
+def _ordt(record):
+    """Label character table of indexes whose labels are not plain UTF-8, or None."""
+    ordt_type, entries, _op1, op2, _tagx = struct.unpack_from('>5I', record, 0xA4)
+    if not entries:
+        return None
+    table = struct.unpack_from(f'>{entries}H', record, op2 + 4)
+    return ordt_type, table
+
+
+def _decode_label(label, ordt):
+    if ordt is None:
+        return label.decode('utf-8', 'replace')
+    ordt_type, table = ordt
+    width = 1 if ordt_type else 2
+    codes = struct.unpack(f'>{len(label) // width}{"B" if width == 1 else "H"}', label[:len(label) - len(label) % width])
+    return ''.join(chr(table[code]) if code < len(table) else chr(code) for code in codes)
+
+
+def _varlen(data, offset):
+    value = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte & 0x80:
+            return value, offset
+
+
+def _tag_values(record, offset, control_bytes, tags):
+    present = []
+    control_index = 0
+    position = offset + control_bytes
+    for tag, per_entry, mask, end_flag in tags:
+        if end_flag:
+            control_index += 1
+            continue
+        value = record[offset + control_index] & mask
+        if not value:
+            continue
+        if value == mask and bin(mask).count('1') > 1:
+            size, position = _varlen(record, position)
+            present.append((tag, None, size, per_entry))
+        else:
+            while not mask & 1:
+                mask >>= 1
+                value >>= 1
+            present.append((tag, value, None, per_entry))
+
+    values = {}
+    for tag, count, size, per_entry in present:
+        items = []
+        if count is not None:
+            for _ in range(count * per_entry):
+                value, position = _varlen(record, position)
+                items.append(value)
+        else:
+            end = position + size
+            while position < end:
+                value, position = _varlen(record, position)
+                items.append(value)
+        values[tag] = items
+    return values
+
+
+def index_headwords(book):
+    """Map every index label (lowercased) to the sorted headwords of its entries."""
+    headwords = defaultdict(list)
+    for label, start, length in book.orth_entries():
+        headwords[label.lower()].append(book.headword_at(start, length))
+    return {label: sorted(words) for label, words in headwords.items()}
+
+
+def setup_argparse():
+    """Setup command line arguments."""
+    parser = argparse.ArgumentParser(description='Compare the headword indexes of two MOBI dictionaries')
+    parser.add_argument('reference', help='MOBI file built by kindlegen')
+    parser.add_argument('candidate', help='MOBI file built by the native writer')
+    parser.add_argument('--show', type=int, default=20, help='Number of differences to print per category')
+    return parser.parse_args()
+
+
+def main():
+    """Main function."""
+    args = setup_argparse()
+    reference = index_headwords(MobiBook(args.reference))
+    candidate = index_headwords(MobiBook(args.candidate))
+
+    missing = sorted(label for label in reference if label not in candidate)
+    extra = sorted(label for label in candidate if label not in reference)
+    different = sorted(label for label in reference
+                       if label in candidate and reference[label] != candidate[label])
+
+    print(f"Reference labels: {len(reference)}, candidate labels: {len(candidate)}")
+    print(f"Matching lookups: {len(reference) - len(missing) - len(different)}")
+    print(f"Missing in candidate: {len(missing)}")
+    for label in missing[:args.show]:
+        print(f"    {label}")
+    print(f"Different entries: {len(different)}")
+    for label in different[:args.show]:
+        print(f"    {label}: {reference[label]} != {candidate[label]}")
+    print(f"Only in candidate (e.g. inflected forms): {len(extra)}")
+    for label in extra[:args.show]:
+        print(f"    {label}")
+    return 1 if missing or different else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,61 @@ Usage:
     python process_kindlegen_jobs.py
 
 The script will run continuously, checking for new jobs every few seconds.
+Up to --concurrency jobs (default 1) run at the same time, each kindlegen
+process in its own job directory. With --wine-pool every concurrent slot
+gets its own Wine prefix with a persistent wineserver, started up front and
+recycled after --wine-recycle-after jobs, so jobs do not pay Wine start-up.
+
+Several processors (e.g. on two hosts sharing the media directory) can
+work on the same queue: a job is claimed by creating job.lock with O_EXCL
+before kindlegen starts, and the owner keeps touching the lock while the
+job runs. A lock not touched for --lease-timeout seconds belongs to a dead
+processor and its job is taken over. job.json is always replaced
+atomically (temporary file + rename), so readers never see it half written.
+
+Job states are tracked in the SQLite index kindlegen_jobs/queue.sqlite3:
+the application registers new jobs there and the processor records every
+status change, so finding pending jobs and expired ones reads only those
+jobs instead of every job.json. Jobs missing from the index (e.g. created
+while it was locked) are added every --missing-scan-interval seconds by
+comparing a listing of the jobs directory with the indexed ids; a full
+rescan at start-up and every --reindex-interval seconds also corrects
+out-of-date states.
+--no-index scans the directory every time.
+
+A job may ask for a kindlegen compression level ("compression" in
+job.json, passed as -c<level>); the application uses -c0 for the quick
+preview of a two-phase build.
+
+Every kindlegen run has a wall-clock timeout of --job-timeout seconds plus
+--job-timeout-per-mb seconds per MB of input (at most --max-job-timeout).
+kindlegen runs in its own session (process group) with its CPU time limited
+to the timeout and, with --memory-limit, its data segment limited as well.
+A run over its timeout has its whole process group killed (with --wine-pool
+also every process of its Wine prefix, by restarting the prefix's
+wineserver) and the job ends in the "timed_out" state. The deadline is
+stored in job.json, so the application knows how long to wait for a
+running job. A pending job is waited for as long as some processor touches
+kindlegen_jobs/processor.alive, which every dispatch does.
+
+Pending jobs are dispatched by priority: jobs of interactive builds
+(creating or updating a dictionary) before those of admin bulk rebuilds,
+and within a priority the job with the smallest input first, so a small
+dictionary is not stuck behind a large one. Only as many jobs as there are
+free workers are handed to the pool at a time, so a job queued later can
+still overtake the waiting ones. The queue wait of every job is recorded in
+the index; --stats prints it per priority.
+
+With --redis-url the final status of every job without a callback (a build
+waiting for it synchronously) is also pushed to the Redis list
+kindlegen:done:<job_id>, which the waiting build blocks on (see
+src/dictionary/kindlegen_jobs.py); otherwise the build notices the updated
+job.json through inotify.
+
+With --celery-broker-url the processor also sends the Celery task named in
+the "callback" entry of job.json (dictionary.tasks.finish_dictionary_build),
+so the build is packaged as soon as kindlegen is done instead of on the
+task's next deferred retry.
 """
 
 import os
@@ -18,21 +73,608 @@ import time
 import logging
 import subprocess
 import argparse
+import queue
+import uuid
+import sqlite3
+import contextlib
+import socket
 import shutil
+import tempfile
+import threading
+import signal
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from pathlib import Path
 
-# Konfiguracja logowania
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('kindlegen_processor.log')
-    ]
-)
+try:
+    import resource
+except ImportError:
+    # Windows: no resource limits
+    resource = None
+
 logger = logging.getLogger('kindlegen_processor')
 
+def setup_logging():
+    """Konfiguracja logowania"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler('kindlegen_processor.log')
+        ]
+    )
+
+# Redis list receiving the final status of a job; must match COMPLETION_KEY
+# in src/dictionary/kindlegen_jobs.py
+COMPLETION_KEY = 'kindlegen:done:{job_id}'
+# Signals nobody waits for anymore expire after this many seconds
+COMPLETION_KEY_TTL = 3600
+
+# Redis client used to signal finished jobs (set up by setup_notifier)
+redis_client = None
+# Celery app used to send job callbacks (set up by setup_callbacks)
+celery_app = None
+# Wine prefixes kindlegen runs in (set up in main with --wine-pool)
+wine_pool = None
+
+LOCK_FILE = 'job.lock'
+# Touched in the jobs directory on every dispatch, so the application knows a
+# processor is alive and keeps queued jobs waiting; must match HEARTBEAT_FILE
+# in src/dictionary/kindlegen_jobs.py
+HEARTBEAT_FILE = 'processor.alive'
+# Identifies this processor in the locks it holds
+PROCESSOR_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# Seconds after which an untouched lock is considered abandoned (--lease-timeout)
+lease_timeout = 120
+
+# Limits of a kindlegen run (--job-timeout, --job-timeout-per-mb,
+# --max-job-timeout, --memory-limit in MB; 0 = no memory limit)
+job_timeout = 300
+job_timeout_per_mb = 60
+max_job_timeout = 3600
+memory_limit = 0
+# Seconds to wait for the output of a killed process group
+KILL_WAIT = 10
+
+# How often a running kindlegen checks that its job's lease is still held
+LEASE_CHECK_INTERVAL = 1
+
+class JobTimeout(Exception):
+    """A kindlegen run did not finish within its timeout."""
+
+    def __init__(self, timeout, reason=None):
+        super().__init__(reason or f"kindlegen did not finish within {timeout:.0f}s")
+        self.timeout = timeout
+
+class LeaseLost(Exception):
+    """Another processor took over a job while this one was running it."""
+
+# Dispatch order of job priorities; must match PRIORITIES in
+# src/dictionary/kindlegen_jobs.py. Jobs without one (queued by an older
+# application) count as interactive.
+PRIORITIES = ('interactive', 'bulk')
+
+# SQLite index of job states in the jobs directory; must match INDEX_FILE and
+# INDEX_SCHEMA in src/dictionary/kindlegen_jobs.py (job_waits is only
+# written by the processor)
+INDEX_FILE = 'queue.sqlite3'
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_waits (
+    job_id TEXT NOT NULL,
+    priority TEXT NOT NULL,
+    input_size INTEGER NOT NULL,
+    queue_wait REAL NOT NULL,
+    started_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_waits_started ON job_waits (started_at);
+"""
+# Must match FINAL_STATUSES in src/dictionary/kindlegen_jobs.py
+FINAL_STATUSES = ('completed', 'failed', 'timed_out')
+# Queue waits are kept for --stats this many days
+WAIT_HISTORY_DAYS = 30
+# Index of job states (set up in main unless --no-index)
+job_index = None
+
+class JobIndex:
+    """
+    Job states by job id, so pending and expired jobs can be looked up
+    without reading every job.json.
+
+    job.json stays authoritative: lookups re-read the jobs they return and
+    correct the index where it is out of date.
+    """
+
+    def __init__(self, jobs_dir):
+        self.jobs_dir = jobs_dir
+        self.path = os.path.join(jobs_dir, INDEX_FILE)
+        with self._connect() as conn:
+            conn.executescript(INDEX_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # One short-lived connection per operation: the index is shared with
+        # the pool threads, other processors and the application
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def update(self, job_id, status, created_at=None):
+        """Record the status of a job."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, status, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at",
+                (job_id, status, created_at or now, now))
+
+    def remove(self, job_ids):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(job_id,) for job_id in job_ids])
+
+    def with_status(self, statuses):
+        """Ids of jobs in one of the given states, oldest first."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT job_id FROM jobs WHERE status IN ({', '.join('?' * len(statuses))}) ORDER BY created_at",
+                tuple(statuses))
+            return [job_id for job_id, in rows]
+
+    def finished_before(self, timestamp):
+        """Ids of finished jobs created before ``timestamp``."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT job_id FROM jobs WHERE status IN ({', '.join('?' * len(FINAL_STATUSES))}) AND created_at < ?",
+                (*FINAL_STATUSES, timestamp))
+            return [job_id for job_id, in rows]
+
+    def record_wait(self, job_id, priority, input_size, queue_wait, started_at):
+        """Record how long a job waited in the queue before it started."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO job_waits (job_id, priority, input_size, queue_wait, started_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, priority, input_size, queue_wait, started_at))
+
+    def prune_waits(self, timestamp):
+        """Forget the queue waits of jobs started before ``timestamp``."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM job_waits WHERE started_at < ?", (timestamp,))
+
+    def waits_since(self, timestamp):
+        """Queue waits of jobs started after ``timestamp`` by priority, shortest first."""
+        waits = {}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT priority, queue_wait FROM job_waits WHERE started_at >= ? ORDER BY queue_wait",
+                (timestamp,))
+            for priority, queue_wait in rows:
+                waits.setdefault(priority, []).append(queue_wait)
+        return waits
+
+    def add_missing(self):
+        """
+        Index job directories the index does not know yet.
+
+        Only lists the jobs directory and the indexed ids; job.json is read
+        for the missing jobs alone.
+
+        Returns:
+            Number of added jobs
+        """
+        with self._connect() as conn:
+            known = {job_id for job_id, in conn.execute("SELECT job_id FROM jobs")}
+        added = 0
+        for job_id in os.listdir(self.jobs_dir):
+            if job_id in known:
+                continue
+            try:
+                with open(os.path.join(self.jobs_dir, job_id, 'job.json'), 'r', encoding='utf-8') as f:
+                    job_data = json.load(f)
+            except (OSError, ValueError):
+                # Not a job directory, or job.json not written yet
+                continue
+            self.update(job_id, job_data.get('status', 'pending'), job_data.get('created_at'))
+            added += 1
+        return added
+
+    def reindex(self):
+        """Rebuild the index from the job directories (full scan)."""
+        jobs = {}
+        for job_id in os.listdir(self.jobs_dir):
+            try:
+                with open(os.path.join(self.jobs_dir, job_id, 'job.json'), 'r', encoding='utf-8') as f:
+                    job_data = json.load(f)
+                jobs[job_id] = (job_data.get('status', 'pending'), job_data.get('created_at', 0))
+            except (OSError, ValueError):
+                continue
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO jobs (job_id, status, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at",
+                [(job_id, status, created_at, now) for job_id, (status, created_at) in jobs.items()])
+            # Rows of removed jobs; a job registered during the scan still has its directory
+            gone = [(job_id,) for job_id, in conn.execute("SELECT job_id FROM jobs")
+                    if job_id not in jobs and not os.path.isdir(os.path.join(self.jobs_dir, job_id))]
+            conn.executemany("DELETE FROM jobs WHERE job_id = ?", gone)
+        return len(jobs)
+
+def index_job(job_path, job_data):
+    """Record the status of a job in the index, if there is one."""
+    if job_index is None:
+        return
+    try:
+        job_index.update(os.path.basename(job_path), job_data.get('status'), job_data.get('created_at'))
+    except sqlite3.Error as e:
+        logger.warning(f"Could not update the job index for {job_path}: {str(e)}")
+
+def write_job(job_path, job_data):
+    """Atomically replace job.json of a job (temporary file + rename)."""
+    job_file = os.path.join(job_path, 'job.json')
+    fd, tmp_path = tempfile.mkstemp(dir=job_path, prefix='.job.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(job_data, f, ensure_ascii=False, indent=4)
+        for attempt in range(5):
+            try:
+                os.replace(tmp_path, job_file)
+                break
+            except PermissionError:
+                # Windows: job.json is open in another process
+                if attempt == 4:
+                    raise
+                time.sleep(0.1)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _lock_age(path):
+    return time.time() - os.stat(path).st_mtime
+
+class JobLease:
+    """
+    Exclusive claim of a job by this processor.
+
+    The lock file is created with O_CREAT | O_EXCL, so only one processor
+    can hold it; a heartbeat thread touches it every lease_timeout / 4
+    seconds. Locks older than lease_timeout are broken by renaming them to
+    a unique name first, so two processors cannot both take over the same
+    abandoned job.
+    """
+
+    def __init__(self, job_path):
+        self.job_path = job_path
+        self.lock_path = os.path.join(job_path, LOCK_FILE)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def acquire(cls, job_path):
+        """Claim a job; returns the lease, or None if another processor holds it."""
+        lease = cls(job_path)
+        if not lease._create():
+            if not lease._break_stale():
+                return None
+            if not lease._create():
+                return None
+        lease._thread = threading.Thread(target=lease._heartbeat, daemon=True,
+                                         name=f"lease-{os.path.basename(job_path)}")
+        lease._thread.start()
+        return lease
+
+    def _create(self):
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'owner': PROCESSOR_ID, 'claimed_at': time.time()}, f)
+        return True
+
+    def _break_stale(self):
+        try:
+            if _lock_age(self.lock_path) <= lease_timeout:
+                return False
+            stale_path = f"{self.lock_path}.{uuid.uuid4().hex}.stale"
+            os.rename(self.lock_path, stale_path)
+        except FileNotFoundError:
+            # Released or broken by someone else in the meantime
+            return True
+        if _lock_age(stale_path) <= lease_timeout:
+            # Another processor renewed the lock between the check and the rename: give it back
+            try:
+                os.link(stale_path, self.lock_path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        logger.warning(f"Taking over job with an expired lease: {self.job_path}")
+        return True
+
+    def owned(self):
+        """True if the lock still belongs to this processor."""
+        try:
+            with open(self.lock_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('owner') == PROCESSOR_ID
+        except (OSError, ValueError):
+            return False
+
+    def _heartbeat(self):
+        while not self._stop.wait(lease_timeout / 4):
+            if not self.owned():
+                self.lost = True
+                logger.warning(f"Lost the lease of {self.job_path} to another processor")
+                return
+            try:
+                os.utime(self.lock_path)
+            except OSError as e:
+                logger.warning(f"Could not renew the lease of {self.job_path}: {str(e)}")
+
+    def release(self):
+        """Stop the heartbeat and remove the lock if it is still ours."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.owned():
+            try:
+                os.remove(self.lock_path)
+            except OSError:
+                pass
+
+def limit_process(pid, timeout):
+    """
+    Limit the CPU time (to ``timeout``) and the data segment (--memory-limit) of a started process.
+
+    The data segment (RLIMIT_DATA) rather than the address space is limited,
+    as Wine reserves far more address space than it ever uses. Processes the
+    child starts later inherit the limits. Only on Linux (resource.prlimit).
+    """
+    if resource is None or not hasattr(resource, 'prlimit'):
+        return
+    try:
+        cpu_seconds = int(timeout) + 1
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 5))
+        if memory_limit:
+            limit = memory_limit * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_DATA, (limit, limit))
+    except (OSError, ValueError) as e:
+        # The process may have exited already
+        logger.warning(f"Could not set resource limits of process {pid}: {str(e)}")
+
+def kill_process_group(process):
+    """Kill a process started by run_process together with everything it started."""
+    try:
+        if os.name == 'nt':
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def _kill_and_reap(process):
+    kill_process_group(process)
+    try:
+        process.communicate(timeout=KILL_WAIT)
+    except subprocess.TimeoutExpired:
+        # A process outside the group keeps the pipes open
+        process.stdout.close()
+        process.stderr.close()
+        process.wait()
+
+def run_process(command, cwd, timeout, env=None, lease=None):
+    """
+    Run kindlegen in its own session with resource limits and a wall-clock timeout.
+
+    With a ``lease``, the process group is killed as soon as the lease is
+    lost, so a job taken over by another processor does not run twice.
+
+    Returns:
+        subprocess.CompletedProcess with text stdout/stderr
+
+    Raises:
+        JobTimeout: The process group was killed after ``timeout`` seconds or
+            the process exceeded its CPU time limit
+        LeaseLost: The process group was killed because the lease was lost
+    """
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, start_new_session=os.name != 'nt')
+    limit_process(process.pid, timeout)
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = max(0, deadline - time.monotonic())
+        try:
+            stdout, stderr = process.communicate(
+                timeout=min(LEASE_CHECK_INTERVAL, remaining) if lease is not None else remaining)
+            break
+        except subprocess.TimeoutExpired:
+            if lease is not None and lease.lost:
+                logger.warning(f"Lost the lease of {cwd} while kindlegen was running, killing its process group")
+                _kill_and_reap(process)
+                raise LeaseLost(cwd)
+            if time.monotonic() >= deadline:
+                logger.warning(f"kindlegen in {cwd} still running after {timeout:.0f}s, killing its process group")
+                _kill_and_reap(process)
+                raise JobTimeout(timeout)
+    if os.name != 'nt' and process.returncode == -signal.SIGXCPU:
+        kill_process_group(process)
+        raise JobTimeout(timeout, f"kindlegen exceeded its CPU time limit of {timeout:.0f}s")
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+class WinePool:
+    """
+    Pre-started Wine prefixes, one per concurrent kindlegen run.
+
+    Each slot has its own WINEPREFIX with a persistent wineserver (-p), so
+    a job only starts the kindlegen process itself instead of a wineserver
+    and the prefix's services. A slot is checked before every job (its
+    wineserver socket must exist) and recycled - wineserver killed and
+    started again - after ``recycle_after`` jobs or a failed run.
+    """
+
+    # Headless prefixes: no X display, no Mono/Gecko install prompts
+    WINE_ENV = {'DISPLAY': '', 'WINEDEBUG': '-all', 'WINEDLLOVERRIDES': 'mscoree,mshtml='}
+
+    def __init__(self, size, prefix_root, wine_path, recycle_after=50):
+        self.wine_path = wine_path
+        self.wineserver_path = self._wineserver_path(wine_path)
+        self.recycle_after = recycle_after
+        self.slots = queue.Queue()
+        self.prefixes = []
+        for number in range(size):
+            prefix = os.path.join(prefix_root, f"slot{number}")
+            env = os.environ.copy()
+            env.update(self.WINE_ENV, WINEPREFIX=prefix)
+            self.prefixes.append(prefix)
+            self.slots.put({'prefix': prefix, 'env': env, 'jobs': 0})
+
+    @staticmethod
+    def _wineserver_path(wine_path):
+        # wineserver usually lives next to wine
+        candidate = os.path.join(os.path.dirname(shutil.which(wine_path) or wine_path), 'wineserver')
+        if os.path.exists(candidate):
+            return candidate
+        return shutil.which('wineserver') or 'wineserver'
+
+    def start(self):
+        """Create missing prefixes and start their wineservers."""
+        for slot in list(self.slots.queue):
+            if not os.path.exists(os.path.join(slot['prefix'], 'system.reg')):
+                logger.info(f"Creating Wine prefix {slot['prefix']}")
+                os.makedirs(slot['prefix'], exist_ok=True)
+                subprocess.run([self.wine_path, 'wineboot', '--init'], env=slot['env'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+            self.start_server(slot)
+
+    def _server_socket(self, slot):
+        # Wine's server directory is named after the prefix's device and inode
+        st = os.stat(slot['prefix'])
+        return f"/tmp/.wine-{os.getuid()}/server-{st.st_dev:x}-{st.st_ino:x}/socket"
+
+    def healthy(self, slot):
+        """True if the slot's wineserver is running."""
+        try:
+            return os.path.exists(self._server_socket(slot))
+        except OSError:
+            return False
+
+    def start_server(self, slot):
+        # wineserver -p stays running after the last client exits; it forks to the background
+        subprocess.run([self.wineserver_path, '-p'], env=slot['env'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        subprocess.run([self.wine_path, 'cmd', '/c', 'exit'], env=slot['env'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    def stop_server(self, slot):
+        subprocess.run([self.wineserver_path, '-k'], env=slot['env'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    def recycle(self, slot):
+        """Restart the wineserver of a slot."""
+        logger.info(f"Recycling Wine prefix {slot['prefix']} after {slot['jobs']} jobs")
+        self.stop_server(slot)
+        self.start_server(slot)
+        slot['jobs'] = 0
+
+    def run(self, command, cwd, timeout, lease=None):
+        """
+        Run a Wine command in a free slot (waits for one), see run_process.
+
+        A run over its timeout also takes down every other process of the
+        slot's prefix, as the slot's wineserver is restarted.
+
+        Returns:
+            subprocess.CompletedProcess with text stdout/stderr
+        """
+        slot = self.slots.get()
+        try:
+            if not self.healthy(slot):
+                logger.warning(f"wineserver of {slot['prefix']} is not running, restarting it")
+                self.recycle(slot)
+            try:
+                result = run_process(command, cwd, timeout, env=slot['env'], lease=lease)
+            except Exception:
+                self.recycle(slot)
+                raise
+            slot['jobs'] += 1
+            if result.returncode > 1 or slot['jobs'] >= self.recycle_after:
+                self.recycle(slot)
+            return result
+        finally:
+            self.slots.put(slot)
+
+    def close(self):
+        """Stop all wineservers."""
+        for slot in list(self.slots.queue):
+            self.stop_server(slot)
+
+def setup_notifier(redis_url):
+    """Connect to the Redis used to signal finished jobs; returns False if it is unavailable."""
+    global redis_client
+    try:
+        import redis
+    except ImportError:
+        logger.warning("The redis package is not installed; finished jobs are signalled through job.json only")
+        return False
+    try:
+        client = redis.Redis.from_url(redis_url, socket_connect_timeout=5, socket_timeout=5)
+        client.ping()
+    except redis.RedisError as e:
+        logger.warning(f"Could not connect to Redis at {redis_url}: {str(e)}; "
+                       f"finished jobs are signalled through job.json only")
+        return False
+    redis_client = client
+    return True
+
+def notify_completion(job_path, job_data):
+    """Push the final status of a job to its completion list."""
+    # A job with a callback is finished by that Celery task; nobody blocks on its list
+    if redis_client is None or job_data.get('callback'):
+        return
+    key = COMPLETION_KEY.format(job_id=os.path.basename(job_path))
+    try:
+        pipeline = redis_client.pipeline()
+        pipeline.rpush(key, json.dumps({'status': job_data['status']}))
+        pipeline.expire(key, COMPLETION_KEY_TTL)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"Could not signal completion of {job_path}: {str(e)}")
+
+def setup_callbacks(broker_url):
+    """Set up sending of job callbacks to Celery; returns False if it is unavailable."""
+    global celery_app
+    try:
+        from celery import Celery
+    except ImportError:
+        logger.warning("The celery package is not installed; builds pick up finished jobs on their next retry")
+        return False
+    celery_app = Celery(broker=broker_url)
+    celery_app.conf.task_serializer = 'json'
+    return True
+
+def send_callback(job_path, job_data):
+    """Send the Celery task a job asked to be run when it is finished."""
+    callback = job_data.get('callback')
+    if celery_app is None or not callback:
+        return
+    try:
+        celery_app.send_task(callback['task'], args=callback.get('args', []))
+        logger.info(f"Sent callback {callback['task']} for {job_path}")
+    except Exception as e:
+        logger.warning(f"Could not send callback for {job_path}: {str(e)}")
+
 def setup_argparse():
     """Setup command line arguments."""
     parser = argparse.ArgumentParser(description='Process kindlegen jobs')
@@ -46,9 +688,86 @@ def setup_argparse():
                         help='Path to the wine executable')
     parser.add_argument('--one-shot', action='store_true',
                         help='Process pending jobs once and exit')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Maximum number of kindlegen processes running at the same time')
+    parser.add_argument('--job-timeout', type=int, default=300,
+                        help='Seconds a kindlegen run may take, plus --job-timeout-per-mb per MB of input')
+    parser.add_argument('--job-timeout-per-mb', type=int, default=60,
+                        help='Additional seconds a kindlegen run may take per MB of input')
+    parser.add_argument('--max-job-timeout', type=int, default=3600,
+                        help='Upper bound of the timeout of a kindlegen run')
+    parser.add_argument('--memory-limit', type=int, default=0,
+                        help='Data segment limit of a kindlegen run in MB (Linux; 0 = no limit)')
+    parser.add_argument('--lease-timeout', type=int, default=120,
+                        help='Seconds after which a job claimed by an unresponsive processor is taken over')
+    parser.add_argument('--no-index', action='store_true',
+                        help='Scan every job directory instead of using the job index')
+    parser.add_argument('--reindex-interval', type=int, default=300,
+                        help='Seconds between full rescans that correct job states in the index')
+    parser.add_argument('--missing-scan-interval', type=int, default=60,
+                        help='Seconds between scans for job directories missing from the index (0 = never)')
+    parser.add_argument('--wine-pool', action='store_true',
+                        help='Run kindlegen in pre-started Wine prefixes, one per concurrent job')
+    parser.add_argument('--wine-prefix-root', type=str,
+                        default=os.path.join(os.path.expanduser('~'), '.cache', 'kindle_dict', 'wine'),
+                        help='Directory holding the Wine prefixes of --wine-pool')
+    parser.add_argument('--wine-recycle-after', type=int, default=50,
+                        help='Restart the wineserver of a prefix after this many jobs')
+    parser.add_argument('--stats', type=float, nargs='?', const=24, metavar='HOURS',
+                        help='Print queue wait statistics per priority for the last HOURS (default 24) and exit')
+    parser.add_argument('--redis-url', type=str,
+                        help='Redis to signal finished jobs to, e.g. redis://localhost:6379/2')
+    parser.add_argument('--celery-broker-url', type=str,
+                        help='Celery broker to send job callbacks to, e.g. redis://localhost:6379/0')
     return parser.parse_args()
 
-def find_pending_jobs(jobs_dir):
+def lease_expired(job_path):
+    """True if a claimed job has no live lock (its processor died)."""
+    try:
+        return _lock_age(os.path.join(job_path, LOCK_FILE)) > lease_timeout
+    except FileNotFoundError:
+        return True
+
+def _runnable(job_path, job_data):
+    return job_data.get('status') == 'pending' or (job_data.get('status') == 'processing'
+                                                   and lease_expired(job_path))
+
+def find_indexed_jobs(jobs_dir):
+    """Find pending kindlegen jobs through the job index (reads only unfinished jobs)."""
+    pending_jobs = []
+    gone = []
+    try:
+        job_ids = job_index.with_status(('pending', 'processing'))
+    except sqlite3.Error as e:
+        logger.warning(f"Job index unavailable ({str(e)}), scanning the jobs directory")
+        return find_pending_jobs(jobs_dir, use_index=False)
+    
+    for job_id in job_ids:
+        job_path = os.path.join(jobs_dir, job_id)
+        try:
+            with open(os.path.join(job_path, 'job.json'), 'r', encoding='utf-8') as f:
+                job_data = json.load(f)
+        except FileNotFoundError:
+            # Removed by its build (e.g. after a timeout)
+            gone.append(job_id)
+            continue
+        except Exception as e:
+            logger.error(f"Error reading job file of {job_path}: {str(e)}")
+            continue
+        
+        if _runnable(job_path, job_data):
+            pending_jobs.append((job_path, job_data))
+        elif job_data.get('status') in FINAL_STATUSES:
+            index_job(job_path, job_data)
+    
+    if gone:
+        try:
+            job_index.remove(gone)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not update the job index: {str(e)}")
+    return pending_jobs
+
+def find_pending_jobs(jobs_dir, use_index=True):
     """Find pending kindlegen jobs in the specified directory."""
     pending_jobs = []
     
@@ -56,6 +775,9 @@ def find_pending_jobs(jobs_dir):
         logger.warning(f"Jobs directory does not exist: {jobs_dir}")
         return pending_jobs
     
+    if use_index and job_index is not None:
+        return find_indexed_jobs(jobs_dir)
+    
     for job_dir in os.listdir(jobs_dir):
         job_path = os.path.join(jobs_dir, job_dir)
         
@@ -70,15 +792,97 @@ def find_pending_jobs(jobs_dir):
             with open(job_file, 'r', encoding='utf-8') as f:
                 job_data = json.load(f)
             
-            if job_data.get('status') == 'pending':
+            if _runnable(job_path, job_data):
                 pending_jobs.append((job_path, job_data))
         except Exception as e:
             logger.error(f"Error reading job file {job_file}: {str(e)}")
     
     return pending_jobs
 
+def job_priority(job_data):
+    """Priority of a job; unknown ones count as interactive."""
+    priority = job_data.get('priority')
+    return priority if priority in PRIORITIES else PRIORITIES[0]
+
+def dispatch_order(job):
+    """
+    Sort key of pending jobs: priority, then smallest input first, then oldest.
+
+    Args:
+        job: (job_path, job_data) as returned by find_pending_jobs
+    """
+    _, job_data = job
+    return (PRIORITIES.index(job_priority(job_data)), job_data.get('input_size') or 0,
+            job_data.get('created_at', 0))
+
+def timeout_for(job_data):
+    """Wall-clock timeout of a job in seconds, scaled by the size of its input."""
+    input_mb = (job_data.get('input_size') or 0) / 1024 / 1024
+    return min(max_job_timeout, job_timeout + job_timeout_per_mb * input_mb)
+
+def record_start(job_path, job_data):
+    """
+    Mark a claimed job as processing and record how long it waited in the queue.
+
+    Returns:
+        Timeout of the run in seconds; its deadline is stored in job.json
+    """
+    started_at = time.time()
+    timeout = timeout_for(job_data)
+    fields = {'processor': PROCESSOR_ID, 'timeout': timeout, 'deadline': started_at + timeout}
+    if 'started_at' in job_data:
+        # Taken over from a dead processor; its wait was recorded then
+        update_job_status(job_path, 'processing', **fields)
+        return timeout
+    
+    queue_wait = max(0.0, started_at - job_data.get('created_at', started_at))
+    priority = job_priority(job_data)
+    input_size = job_data.get('input_size') or 0
+    update_job_status(job_path, 'processing', started_at=started_at, queue_wait=queue_wait, **fields)
+    logger.info(f"Starting {priority} job {os.path.basename(job_path)} "
+                f"({input_size / 1024 / 1024:.1f} MB) after {queue_wait:.1f}s in the queue")
+    if job_index is not None:
+        try:
+            job_index.record_wait(os.path.basename(job_path), priority, input_size, queue_wait, started_at)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not record the queue wait of {job_path}: {str(e)}")
+    return timeout
+
 def process_job(job_path, job_data, kindlegen_path, wine_path):
-    """Process a kindlegen job."""
+    """
+    Claim a kindlegen job and process it, unless another processor has it.
+
+    Returns:
+        True or False for a job processed with or without success, None if
+        the job was not claimed (held by another processor or already done)
+    """
+    lease = JobLease.acquire(job_path)
+    if lease is None:
+        logger.info(f"Job is being processed by another processor: {job_path}")
+        return None
+    try:
+        # It may have been finished by another processor since it was found
+        job_file = os.path.join(job_path, 'job.json')
+        with open(job_file, 'r', encoding='utf-8') as f:
+            job_data = json.load(f)
+        if job_data.get('status') not in ('pending', 'processing'):
+            return None
+        timeout = record_start(job_path, job_data)
+        return run_job(job_path, job_data, kindlegen_path, wine_path, timeout, lease)
+    except FileNotFoundError:
+        # Removed by its build in the meantime
+        return None
+    finally:
+        lease.release()
+
+def run_job(job_path, job_data, kindlegen_path, wine_path, timeout, lease=None):
+    """
+    Run kindlegen for a claimed job, for at most ``timeout`` seconds.
+
+    Returns:
+        True or False for success or failure, None if the lease was lost
+        (job.json then belongs to the new owner and is left alone)
+    """
     logger.info(f"Processing job in {job_path}")
     
     opf_filename = job_data.get('opf_file')
@@ -93,70 +897,162 @@ def process_job(job_path, job_data, kindlegen_path, wine_path):
         # Determine if we're on Windows or not
         is_windows = os.name == 'nt'
         
-        # Zapamiętaj bieżący katalog
-        original_dir = os.getcwd()
+        # Construct command based on OS, używając tylko nazwy pliku zamiast pełnej ścieżki
+        # (kindlegen jest uruchamiany w katalogu zadania, patrz cwd poniżej)
+        if is_windows:
+            # On Windows, run kindlegen directly
+            command = [kindlegen_path, opf_filename]
+        else:
+            # On Linux/macOS, use wine
+            command = [wine_path, kindlegen_path, opf_filename]
         
-        try:
-            # Przejdź do katalogu zadania, aby używać względnych ścieżek
-            os.chdir(job_path)
-            
-            # Construct command based on OS, używając tylko nazwy pliku zamiast pełnej ścieżki
-            if is_windows:
-                # On Windows, run kindlegen directly
-                command = [kindlegen_path, opf_filename]
-            else:
-                # On Linux/macOS, use wine
-                command = [wine_path, kindlegen_path, opf_filename]
-            
-            # Add output file if specified
-            if output_file:
-                command.extend(['-o', output_file])
-            
-            logger.info(f"Running command from directory {job_path}: {' '.join(command)}")
-            
-            # Run kindlegen
-            result = subprocess.run(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=False
-            )
-            
-            # Log output
-            logger.info(f"Command output: {result.stdout}")
-            if result.stderr:
-                logger.warning(f"Command error: {result.stderr}")
+        # Compression level requested by the application (-c0 for preview builds)
+        if job_data.get('compression') is not None:
+            command.append(f"-c{int(job_data['compression'])}")
+        
+        # Add output file if specified
+        if output_file:
+            command.extend(['-o', output_file])
+        
+        logger.info(f"Running command from directory {job_path}: {' '.join(command)}")
+        
+        # Run kindlegen; jobs may run concurrently, so the working directory
+        # is set for the subprocess only
+        if wine_pool is not None and not is_windows:
+            result = wine_pool.run(command, job_path, timeout, lease)
+        else:
+            result = run_process(command, job_path, timeout, lease=lease)
+        
+        if lease is not None and lease.lost:
+            logger.warning(f"Lost the lease of {job_path}, discarding the result of this run")
+            return None
+        
+        # Log output
+        logger.info(f"Command output ({job_path}): {result.stdout}")
+        if result.stderr:
+            logger.warning(f"Command error ({job_path}): {result.stderr}")
+        
+        # Check if successful
+        if result.returncode <= 1:  # 0 = success, 1 = success with warnings
+            mobi_file = output_file if output_file else os.path.splitext(job_data.get('opf_file'))[0] + '.mobi'
+            mobi_path = os.path.join(job_path, mobi_file)
             
-            # Check if successful
-            if result.returncode <= 1:  # 0 = success, 1 = success with warnings
-                mobi_file = output_file if output_file else os.path.splitext(job_data.get('opf_file'))[0] + '.mobi'
-                mobi_path = os.path.join(job_path, mobi_file)
-                
-                if os.path.exists(mobi_path) and os.path.getsize(mobi_path) > 0:
-                    update_job_status(job_path, 'completed', output=mobi_file)
-                    logger.info(f"Job completed successfully: {mobi_path}")
-                    return True
-                else:
-                    update_job_status(job_path, 'failed', f"MOBI file not found or empty: {mobi_path}")
-                    logger.error(f"MOBI file not found or empty: {mobi_path}")
-                    return False
+            if os.path.exists(mobi_path) and os.path.getsize(mobi_path) > 0:
+                update_job_status(job_path, 'completed', output=mobi_file)
+                logger.info(f"Job completed successfully: {mobi_path}")
+                return True
             else:
-                update_job_status(job_path, 'failed', f"kindlegen failed with code {result.returncode}: {result.stdout}")
-                logger.error(f"kindlegen failed with code {result.returncode}")
+                update_job_status(job_path, 'failed', f"MOBI file not found or empty: {mobi_path}")
+                logger.error(f"MOBI file not found or empty: {mobi_path}")
                 return False
-                
-        finally:
-            # Wróć do oryginalnego katalogu
-            os.chdir(original_dir)
+        else:
+            update_job_status(job_path, 'failed', f"kindlegen failed with code {result.returncode}: {result.stdout}")
+            logger.error(f"kindlegen failed with code {result.returncode}")
+            return False
     
+    except LeaseLost:
+        logger.warning(f"Job {job_path} was taken over by another processor, leaving it to them")
+        return None
+    except JobTimeout as e:
+        if lease is not None and lease.lost:
+            return None
+        update_job_status(job_path, 'timed_out', str(e))
+        logger.error(f"Job timed out: {job_path}: {str(e)}")
+        return False
     except Exception as e:
+        if lease is not None and lease.lost:
+            return None
         update_job_status(job_path, 'failed', f"Exception: {str(e)}")
         logger.error(f"Exception processing job: {str(e)}", exc_info=True)
         return False
 
-def update_job_status(job_path, status, error=None, output=None):
-    """Update the status of a job."""
+class JobScheduler:
+    """
+    Hands pending jobs to the worker pool in dispatch_order.
+
+    Only as many jobs as there are idle workers are submitted, so the pool
+    never holds a backlog of its own and every free worker takes the best
+    job pending at that moment. Jobs held by another processor are not
+    tried again for retry_delay seconds.
+    """
+
+    def __init__(self, executor, capacity, jobs_dir, kindlegen_path, wine_path, retry_delay=5):
+        self.executor = executor
+        self.capacity = max(1, capacity)
+        self.jobs_dir = jobs_dir
+        self.kindlegen_path = kindlegen_path
+        self.wine_path = wine_path
+        self.retry_delay = retry_delay
+        # Futures of submitted jobs by job path
+        self.running = {}
+        # Jobs not claimed on the last try, by job path: time of the next try
+        self.deferred = {}
+
+    def _reap(self):
+        now = time.monotonic()
+        for job_path, future in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[job_path]
+            if not future.cancelled() and future.exception() is None and future.result() is None:
+                self.deferred[job_path] = now + self.retry_delay
+        for job_path, retry_at in list(self.deferred.items()):
+            if retry_at <= now:
+                del self.deferred[job_path]
+
+    def dispatch(self):
+        """
+        Submit the best pending jobs to the idle workers.
+
+        Returns:
+            Number of newly submitted jobs
+        """
+        self._reap()
+        touch_heartbeat(self.jobs_dir)
+        idle = self.capacity - len(self.running)
+        if idle <= 0:
+            return 0
+        
+        pending_jobs = sorted(
+            ((job_path, job_data) for job_path, job_data in find_pending_jobs(self.jobs_dir)
+             if job_path not in self.running and job_path not in self.deferred),
+            key=dispatch_order)
+        for job_path, job_data in pending_jobs[:idle]:
+            self.running[job_path] = self.executor.submit(
+                process_job, job_path, job_data, self.kindlegen_path, self.wine_path)
+        return min(idle, len(pending_jobs))
+
+    def wait(self, timeout=None):
+        """Wait until a running job finishes (or ``timeout`` seconds pass)."""
+        if self.running:
+            wait(list(self.running.values()), timeout=timeout, return_when=FIRST_COMPLETED)
+        elif timeout:
+            time.sleep(timeout)
+
+    def run_pending(self):
+        """
+        Process pending jobs until none are left (one-shot mode).
+
+        Returns:
+            Number of submitted jobs
+        """
+        submitted = 0
+        while True:
+            submitted += self.dispatch()
+            if not self.running:
+                return submitted
+            # Not longer than retry_delay, so the heartbeat stays fresh during long jobs
+            self.wait(self.retry_delay)
+
+def touch_heartbeat(jobs_dir):
+    """Tell the application that a processor is alive (see HEARTBEAT_FILE)."""
+    try:
+        Path(jobs_dir, HEARTBEAT_FILE).touch()
+    except OSError as e:
+        logger.warning(f"Could not touch the processor heartbeat: {str(e)}")
+
+def update_job_status(job_path, status, error=None, output=None, **fields):
+    """Update the status of a job; ``fields`` are stored in job.json as well."""
     job_file = os.path.join(job_path, 'job.json')
     
     try:
@@ -172,10 +1068,15 @@ def update_job_status(job_path, status, error=None, output=None):
         if output:
             job_data['output_file'] = output
         
-        with open(job_file, 'w', encoding='utf-8') as f:
-            json.dump(job_data, f, ensure_ascii=False, indent=4)
+        job_data.update(fields)
+        
+        write_job(job_path, job_data)
+        index_job(job_path, job_data)
         
         logger.info(f"Updated job status to {status}: {job_file}")
+        if status in FINAL_STATUSES:
+            notify_completion(job_path, job_data)
+            send_callback(job_path, job_data)
         return True
     
     except Exception as e:
@@ -196,6 +1097,29 @@ def cleanup_old_jobs(jobs_dir, max_age_hours=24):
     current_time = time.time()
     max_age_seconds = max_age_hours * 3600
     
+    if job_index is not None:
+        # Z indeksem czytamy tylko zakończone zadania starsze niż max_age_hours
+        try:
+            expired = job_index.finished_before(current_time - max_age_seconds)
+        except sqlite3.Error as e:
+            logger.warning(f"Job index unavailable ({str(e)}), skipping cleanup")
+            return
+        for job_dir_name in expired:
+            job_dir = os.path.join(jobs_dir, job_dir_name)
+            if os.path.isdir(job_dir):
+                logger.info(f"Removing old job directory: {job_dir}")
+                try:
+                    shutil.rmtree(job_dir)
+                except Exception as e:
+                    logger.warning(f"Could not remove job directory {job_dir}: {str(e)}")
+                    continue
+        try:
+            job_index.remove(expired)
+            job_index.prune_waits(current_time - WAIT_HISTORY_DAYS * 86400)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not update the job index: {str(e)}")
+        return
+    
     for job_dir_name in os.listdir(jobs_dir):
         job_dir = os.path.join(jobs_dir, job_dir_name)
         
@@ -211,7 +1135,7 @@ def cleanup_old_jobs(jobs_dir, max_age_hours=24):
                 job_data = json.load(f)
             
             # Sprawdzamy, czy zadanie zostało zakończone (sukces lub błąd)
-            if job_data.get('status') in ['completed', 'failed']:
+            if job_data.get('status') in FINAL_STATUSES:
                 # Sprawdzamy, czy zadanie jest wystarczająco stare
                 created_at = job_data.get('created_at', 0)
                 age_seconds = current_time - created_at
@@ -226,12 +1150,42 @@ def cleanup_old_jobs(jobs_dir, max_age_hours=24):
         except Exception as e:
             logger.warning(f"Error processing job file {job_file}: {str(e)}")
 
+def _percentile(values, fraction):
+    # values are sorted
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def print_wait_stats(jobs_dir, hours):
+    """Print queue wait statistics per priority from the job index."""
+    if not os.path.exists(os.path.join(jobs_dir, INDEX_FILE)):
+        print(f"No job index in {jobs_dir}")
+        return 1
+    try:
+        waits = JobIndex(jobs_dir).waits_since(time.time() - hours * 3600)
+    except sqlite3.Error as e:
+        print(f"Could not read the job index: {str(e)}")
+        return 1
+    
+    print(f"Queue wait of jobs started in the last {hours:g} hours:")
+    for priority in sorted(waits, key=lambda p: PRIORITIES.index(p) if p in PRIORITIES else len(PRIORITIES)):
+        values = waits[priority]
+        print(f"  {priority:12s} jobs={len(values):5d}  mean={sum(values) / len(values):8.1f}s  "
+              f"p50={_percentile(values, 0.5):8.1f}s  p95={_percentile(values, 0.95):8.1f}s  "
+              f"max={values[-1]:8.1f}s")
+    if not waits:
+        print("  no jobs")
+    return 0
+
 def main():
     """Main function."""
     args = setup_argparse()
     
-    # Resolve paths
     media_root = os.path.abspath(args.media_root)
+    if args.stats is not None:
+        return print_wait_stats(os.path.join(media_root, 'kindlegen_jobs'), args.stats)
+    
+    setup_logging()
+    
+    # Resolve paths
     kindlegen_path = os.path.abspath(args.kindlegen_path)
     jobs_dir = os.path.join(media_root, 'kindlegen_jobs')
     
@@ -241,10 +1195,42 @@ def main():
     logger.info(f"Kindlegen path: {kindlegen_path}")
     logger.info(f"Wine path: {args.wine_path}")
     logger.info(f"Check interval: {args.interval} seconds")
+    logger.info(f"Concurrency: {args.concurrency}")
+    logger.info(f"Processor id: {PROCESSOR_ID} (lease timeout {args.lease_timeout}s)")
+    logger.info(f"Job timeout: {args.job_timeout}s + {args.job_timeout_per_mb}s/MB, "
+                f"at most {args.max_job_timeout}s; memory limit: {args.memory_limit or 'none'} MB")
+    if args.redis_url and setup_notifier(args.redis_url):
+        logger.info(f"Signalling finished jobs via Redis: {args.redis_url}")
+    if args.celery_broker_url and setup_callbacks(args.celery_broker_url):
+        logger.info(f"Sending job callbacks via Celery broker: {args.celery_broker_url}")
     
     # Create jobs directory if it doesn't exist
     os.makedirs(jobs_dir, exist_ok=True)
     
+    global wine_pool, lease_timeout, job_index, job_timeout, job_timeout_per_mb, max_job_timeout, memory_limit
+    lease_timeout = args.lease_timeout
+    job_timeout = args.job_timeout
+    job_timeout_per_mb = args.job_timeout_per_mb
+    max_job_timeout = args.max_job_timeout
+    memory_limit = args.memory_limit
+    if not args.no_index:
+        try:
+            job_index = JobIndex(jobs_dir)
+            logger.info(f"Indexed {job_index.reindex()} jobs in {job_index.path}")
+        except sqlite3.Error as e:
+            logger.warning(f"Could not open the job index ({str(e)}), scanning the jobs directory instead")
+            job_index = None
+    if args.wine_pool and os.name != 'nt':
+        wine_pool = WinePool(max(1, args.concurrency), os.path.abspath(args.wine_prefix_root),
+                             args.wine_path, args.wine_recycle_after)
+        logger.info(f"Starting {args.concurrency} Wine prefixes in {args.wine_prefix_root}")
+        wine_pool.start()
+    
+    # Kindlegen runs in subprocesses; the pool threads only wait for them
+    executor = ThreadPoolExecutor(max_workers=max(1, args.concurrency), thread_name_prefix='kindlegen')
+    scheduler = JobScheduler(executor, args.concurrency, jobs_dir, kindlegen_path, args.wine_path,
+                             retry_delay=args.interval)
+    
     # Process jobs once or continuously
     if args.one_shot:
         logger.info("Running in one-shot mode")
@@ -252,46 +1238,71 @@ def main():
         # Czyścimy stare katalogi zadań
         cleanup_old_jobs(jobs_dir)
         
-        # Przetwarzamy oczekujące zadania
-        pending_jobs = find_pending_jobs(jobs_dir)
-        logger.info(f"Found {len(pending_jobs)} pending jobs")
-        
-        for job_path, job_data in pending_jobs:
-            process_job(job_path, job_data, kindlegen_path, args.wine_path)
+        # Przetwarzamy oczekujące zadania, łącznie z tymi, które pojawią się w trakcie
+        submitted = scheduler.run_pending()
+        logger.info(f"Processed {submitted} pending jobs")
+        executor.shutdown(wait=True)
         
         logger.info("One-shot processing completed")
     else:
         logger.info("Running in continuous mode")
         
-        # Licznik do okresowego czyszczenia
-        cleanup_counter = 0
-        cleanup_interval = 12  # Czyszczenie co 12 cykli (przy domyślnym interwale 5s to będzie co minutę)
+        # Czyszczenie co 12 interwałów (przy domyślnym interwale 5s to będzie co minutę)
+        cleanup_interval = 12 * args.interval
+        last_cleanup = time.monotonic()
+        last_reindex = time.monotonic()
+        last_missing_scan = time.monotonic()
         
         try:
             while True:
-                # Przetwarzamy oczekujące zadania
-                pending_jobs = find_pending_jobs(jobs_dir)
+                # Wolnym wątkom przekazujemy najpilniejsze oczekujące zadania
+                submitted = scheduler.dispatch()
                 
-                if pending_jobs:
-                    logger.info(f"Found {len(pending_jobs)} pending jobs")
-                    
-                    for job_path, job_data in pending_jobs:
-                        process_job(job_path, job_data, kindlegen_path, args.wine_path)
+                if submitted:
+                    logger.info(f"Started {submitted} pending jobs ({len(scheduler.running)} running)")
                 
                 # Okresowo czyścimy stare katalogi zadań
-                cleanup_counter += 1
-                if cleanup_counter >= cleanup_interval:
+                if time.monotonic() - last_cleanup >= cleanup_interval:
                     cleanup_old_jobs(jobs_dir)
-                    cleanup_counter = 0
+                    last_cleanup = time.monotonic()
+                
+                # Okresowo dopisujemy do indeksu zadania, których w nim brakuje
+                if job_index is not None and args.reindex_interval and \
+                        time.monotonic() - last_reindex >= args.reindex_interval:
+                    try:
+                        job_index.reindex()
+                    except sqlite3.Error as e:
+                        logger.warning(f"Could not rebuild the job index: {str(e)}")
+                    last_reindex = time.monotonic()
+                    last_missing_scan = last_reindex
+                
+                # Częściej (bez czytania job.json znanych zadań) szukamy zadań niezapisanych w indeksie
+                if job_index is not None and args.missing_scan_interval and \
+                        time.monotonic() - last_missing_scan >= args.missing_scan_interval:
+                    try:
+                        added = job_index.add_missing()
+                        if added:
+                            logger.info(f"Indexed {added} jobs missing from the job index")
+                    except sqlite3.Error as e:
+                        logger.warning(f"Could not update the job index: {str(e)}")
+                    last_missing_scan = time.monotonic()
                 
-                time.sleep(args.interval)
+                # Czekamy na nowe zadania albo na zwolnienie się wątku
+                scheduler.wait(args.interval)
         
         except KeyboardInterrupt:
             logger.info("Received keyboard interrupt, shutting down")
+            # Zadania, które jeszcze się nie zaczęły, pozostają "pending"
+            executor.shutdown(wait=True, cancel_futures=True)
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}", exc_info=True)
+            executor.shutdown(wait=True, cancel_futures=True)
+            if wine_pool is not None:
+                wine_pool.close()
             return 1
     
+    if wine_pool is not None:
+        wine_pool.close()
     return 0
 
 if __name__ == "__main__":
@@ -133,6 +133,10 @@ echo -e "${YELLOW}docker-compose -f docker-compose.prod.yml exec web python mana
 echo -e "${YELLOW}Konfiguracja usługi systemowej kindlegen-processor...${NC}"
 KINDLEGEN_SERVICE_FILE="/etc/systemd/system/kindlegen-processor.service"
 
+# Procesor wysyła sygnały zakończenia do Redis i zadania pakowania do Celery
+echo -e "${YELLOW}Instalacja pakietów Python procesora kindlegen (celery, redis)...${NC}"
+python3 -m pip install --user celery redis
+
 # Tworzenie pliku usługi systemowej
 echo -e "${YELLOW}Tworzenie pliku usługi systemowej...${NC}"
 sudo tee $KINDLEGEN_SERVICE_FILE > /dev/null << EOL
@@ -143,7 +147,7 @@ After=network.target
 [Service]
 User=$USER
 WorkingDirectory=$PWD/kindle_dict
-ExecStart=/usr/bin/python3 $PWD/kindle_dict/scripts/process_kindlegen_jobs.py --media-root=/opt/kindle_dict/media --kindlegen-path=$PWD/kindle_dict/src/tools/kindlegen.exe
+ExecStart=/usr/bin/python3 $PWD/kindle_dict/scripts/process_kindlegen_jobs.py --media-root=/opt/kindle_dict/media --kindlegen-path=$PWD/kindle_dict/src/tools/kindlegen.exe --redis-url=redis://localhost:6379/2 --celery-broker-url=redis://localhost:6379/0
 Restart=on-failure
 
 [Install]
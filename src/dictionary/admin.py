@@ -4,7 +4,9 @@
 Admin configuration for the Dictionary app.
 """
 
+import json
 from django.contrib import admin
+from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 from django.contrib import messages
 from .models import Dictionary, DictionarySuggestion, SMTPConfiguration, ContactMessage, CaptchaConfiguration, Task, UserSettings
@@ -15,16 +17,18 @@ class DictionaryAdmin(admin.ModelAdmin):
     list_display = ('name', 'creator_name', 'updater_name', 'language_code', 'status', 'is_public', 'build_version', 'created_at', 'built_at')
     list_filter = ('status', 'is_public', 'language_code')
     search_fields = ('name', 'description', 'creator_name', 'updater_name')
-    readonly_fields = ('id', 'created_at', 'updated_at', 'built_at')
+    readonly_fields = ('id', 'created_at', 'updated_at', 'built_at', 'mobi_is_preview', 'build_report_display')
+    # build_backend stays out of the admin until the native MOBI writer has
+    # been checked against kindlegen builds on a Kindle
     fieldsets = (
         (None, {
-            'fields': ('id', 'name', 'description', 'creator_name', 'updater_name', 'language_code', 'is_public')
+            'fields': ('id', 'name', 'description', 'creator_name', 'updater_name', 'language_code', 'is_public', 'merge_duplicates')
         }),
         (_('Files'), {
-            'fields': ('source_file', 'html_file', 'opf_file', 'jpg_file', 'mobi_file', 'json_file', 'zip_file')
+            'fields': ('source_file', 'html_file', 'opf_file', 'jpg_file', 'mobi_file', 'mobi_is_preview', 'json_file', 'zip_file')
         }),
         (_('Status & Version'), {
-            'fields': ('status', 'status_message', 'build_version')
+            'fields': ('status', 'status_message', 'build_version', 'build_report_display')
         }),
         (_('Dates'), {
             'fields': ('created_at', 'updated_at', 'built_at')
@@ -32,12 +36,22 @@ class DictionaryAdmin(admin.ModelAdmin):
     )
     actions = ['rebuild_dictionaries']
     
+    def build_report_display(self, obj):
+        """Parse report of the last build, pretty-printed"""
+        if not obj.build_report:
+            return '-'
+        return format_html('<pre>{}</pre>', json.dumps(obj.build_report, indent=2, ensure_ascii=False))
+    
+    build_report_display.short_description = _("Build Report")
+    
     def rebuild_dictionaries(self, request, queryset):
         """Admin action to rebuild selected dictionaries"""
         from .tasks import process_dictionary
+        from .kindlegen_jobs import PRIORITY_BULK
         
+        # Mass rebuilds yield the kindlegen processor to builds users are waiting for
         for dictionary in queryset:
-            process_dictionary.delay(str(dictionary.id))
+            process_dictionary.delay(str(dictionary.id), priority=PRIORITY_BULK)
         
         self.message_user(request, _("Selected dictionaries are being rebuilt."))
     
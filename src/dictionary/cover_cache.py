@@ -0,0 +1,102 @@
+# src/dictionary/cover_cache.py
+
+"""
+Rendering of dictionary cover images with an on-disk cache.
+
+A cover depends only on the dictionary title and on the cover template, so
+rebuilding a dictionary whose name did not change reuses the JPEG rendered
+by an earlier build: it is hard-linked into the build directory (or copied
+where the cache is on another filesystem) without touching Pillow.
+
+Cached covers are named ``<sha256 of title>-v<COVER_VERSION>.jpg`` and are
+evicted like parse cache artifacts (see parse_cache.prune_cache). The font
+and the blank template are loaded once per process.
+"""
+
+import os
+import hashlib
+import logging
+import functools
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .fileutils import link_or_copy
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever render_cover changes the image it produces
+COVER_VERSION = 1
+
+COVER_SIZE = (600, 800)  # Portrait mode dimensions
+SUFFIX = '.jpg'
+
+
+@functools.lru_cache(maxsize=None)
+def _font():
+    return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=None)
+def _template():
+    return Image.new('RGB', COVER_SIZE, color=(255, 255, 255))
+
+
+def render_cover(title, output_path):
+    """Render the cover image of a dictionary to ``output_path``."""
+    img = _template().copy()
+    draw = ImageDraw.Draw(img)
+    font = _font()
+
+    # Center the title
+    bbox = font.getbbox(title)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    position = ((COVER_SIZE[0] - text_width) / 2, (COVER_SIZE[1] - text_height) / 2)
+    draw.text(position, title, fill=(0, 0, 0), font=font)
+
+    img.save(output_path, format='JPEG')
+
+
+def cover_path(cache_dir, title):
+    """Path of the cached cover for a title and the current cover version."""
+    digest = hashlib.sha256(title.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f"{digest}-v{COVER_VERSION}{SUFFIX}")
+
+
+def get_cover(title, output_path, cache_dir=None):
+    """
+    Place the cover image for ``title`` at ``output_path``.
+
+    Args:
+        title: Dictionary title drawn on the cover
+        output_path: Path of the JPEG file to create
+        cache_dir: Cover cache directory; without it the cover is always rendered
+
+    Returns:
+        True if the cover came from the cache, False if it was rendered
+    """
+    if not cache_dir:
+        render_cover(title, output_path)
+        return False
+
+    path = cover_path(cache_dir, title)
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+            link_or_copy(path, output_path)
+            return True
+        except OSError as e:
+            # Evicted in the meantime: render it again below
+            logger.warning(f"Could not reuse cached cover {path}: {str(e)}")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        render_cover(title, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    link_or_copy(path, output_path)
+    return False
@@ -5,133 +5,283 @@ Module for dictionary creation functionality.
 Adapted from createdict.py script to work with Django models.
 """
 
+import io
 import os
 import re
 import json
 import zipfile
 import tempfile
 import shutil
-from PIL import Image, ImageDraw, ImageFont
+import collections
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from django.conf import settings
 from django.core.files import File
+from .entries import Entry, EntryGroup
+from .parse_report import ParseReport
+from . import parse_cache
+from . import cover_cache
+from .fileutils import link_or_copy
+from . import mobi_cache
+from . import kindlegen_jobs
+from .source_reader import iter_source_lines, read_source_text
+from .tokenizer import tokenize_line
 
 def read_file_preserving_cr(file_path):
     """
     Czyta plik zachowując oryginalne znaki \r jako separatory,
     ale normalizując końce linii pliku.
+
+    Kodowanie pliku jest wykrywane automatycznie (UTF-8, UTF-16, cp1250,
+    ISO-8859-2) - patrz source_reader.detect_encoding.
     """
-    import logging
-    logger = logging.getLogger(__name__)
-    
-    # KROK 1: Czytaj jako binary
-    with open(file_path, 'rb') as f:
-        raw_bytes = f.read()
-    
-    # KROK 2: Dekoduj do tekstu
-    try:
-        content = raw_bytes.decode('utf-8')
-    except UnicodeDecodeError:
-        # Fallback dla plików w innych kodowaniach
-        content = raw_bytes.decode('utf-8', errors='ignore')
-    
-    logger.info(f"Raw content preview: {repr(content[:200])}")
-    
-    # KROK 3: Zamień tylko \r\n na \n (końce linii Windows)
-    # ALE zostaw jednotne \r jako separatory
-    content = content.replace('\r\n', '\n')
-    
-    logger.info(f"After CRLF normalization: {repr(content[:200])}")
-    
-    return content
+    return read_source_text(file_path)
 
-def parse_line(line):
+def parse_line(line, entry_class=Entry):
     """Parse a line of dictionary content to extract term, inflections and description."""
-    match = re.match(r'^(.*?)\s*\|\s*(\{.*?\})?\s+(.*)$', line)
-    if match:
-        term = match.group(1).strip()
-        inflections = match.group(2)
-        description = match.group(3).strip()
-        if inflections:
-            # Remove curly braces and split by comma
-            inflections = inflections.strip('{}').split(',')
-            inflections = [inf.strip() for inf in inflections]
-        else:
-            inflections = []
-        return {'term': term, 'inflections': inflections, 'description': description}
-    else:
+    tokens = tokenize_line(line)
+    if tokens is None:
         return None
+    return entry_class(*tokens)
 
-def process_dictionary_content(content, base_filename, work_dir, language_info, build_version=1):
-    import logging
-    logger = logging.getLogger(__name__)
-
-    """
-    Process dictionary content and generate all necessary files.
-    
-    Args:
-        content: The content of the dictionary file
-        base_filename: Base name for output files
-        work_dir: Working directory path
-        language_info: Dictionary with language settings
-    
-    Returns:
-        Dictionary with paths to generated files
+def iter_entries(lines, report=None, first_line=1):
     """
-    # Process entries        
+    Parse dictionary source lines into entries.
 
-    lines = content.split('\n')
-    logger.info(f"Split into {len(lines)} lines")
+    Entries are yielded in source order as soon as they are complete: simple
+    entries immediately, ``~`` groups once the next top-level entry (or the end
+    of the input) closes them, with their ``+`` members in ``children``.
 
-    entries = []
+    Args:
+        lines: Iterable of source lines
+        report: Optional ParseReport that receives line statistics and the
+            numbers of skipped lines
+        first_line: Line number of the first line (for chunks of a source)
+    """
+    if report is None:
+        report = ParseReport()
     current_group = None
-    
-    for i, line in enumerate(lines):
-        line = line.strip()        
 
-        logger.info(f'Processing line: {line}')
+    for line_number, line in enumerate(lines, first_line):
+        report.lines += 1
+        line = line.strip()
 
         if not line:
+            report.blank += 1
             continue  # Skip empty lines
 
         # Check for leading character
         if line.startswith('~'):
             # Group entry
             line_content = line[1:].strip()
-            entry = parse_line(line_content)
+            entry = parse_line(line_content, EntryGroup)
             if entry is None:
+                report.add_invalid(line_number, line)
                 continue  # Skip invalid lines
-            entry['children'] = []
-            entries.append(entry)
+            report.groups += 1
+            if current_group is not None:
+                yield current_group
             current_group = entry
         elif line.startswith('+'):
             # Member of a group
             if current_group is None:
+                report.add_orphan(line_number, line)
                 continue  # Skip orphaned group members
             line_content = line[1:].strip()
             entry = parse_line(line_content)
             if entry is None:
+                report.add_invalid(line_number, line)
                 continue  # Skip invalid lines
-            current_group['children'].append(entry)
+            report.members += 1
+            current_group.children.append(entry)
         else:
             # Simple entry
             entry = parse_line(line)
             if entry is None:
+                report.add_invalid(line_number, line)
                 continue  # Skip invalid lines
-            entries.append(entry)
-            current_group = None  # Reset current group
+            report.entries += 1
+            if current_group is not None:
+                yield current_group
+                current_group = None  # Reset current group
+            yield entry
+
+    if current_group is not None:
+        yield current_group
+
+def validate_lines(lines):
+    """
+    Check dictionary source lines without rendering anything.
+
+    Returns:
+        ParseReport for the source
+    """
+    report = ParseReport()
+    for _entry in iter_entries(lines, report):
+        pass
+    return report
+
+def _merge_entries(entries, report):
+    """Merge entries sharing a headword into the first of them."""
+    first = entries[0]
+    inflections = dict.fromkeys(inf for entry in entries for inf in entry.inflections)
+    description = '<br>'.join(entry.description for entry in entries)
+    if not any(isinstance(entry, EntryGroup) for entry in entries):
+        return Entry(first.term, inflections, description)
+    children = [child for entry in entries for child in entry.children]
+    return EntryGroup(first.term, inflections, description, list(merge_duplicate_entries(children, report)))
+
+def merge_duplicate_entries(entries, report=None):
+    """
+    Merge entries with the same headword into one entry.
+
+    Headwords are compared by ``term.lower()``, the value kindlegen indexes as
+    ``idx:orth``. Each headword keeps the position and spelling of its first
+    occurrence; the descriptions of the duplicates are appended as further
+    paragraphs and their inflections are added without repetitions. If any of
+    the duplicates is a ``~`` group, the result is a group with all their
+    members, which are merged the same way.
+
+    The whole input is consumed before the first entry is yielded, using one
+    hash lookup per entry and memory proportional to the number of headwords.
+
+    Args:
+        entries: Iterable of top-level entries
+        report: Optional ParseReport that receives the merged headwords
+    """
+    first_by_term = {}
+    duplicates = {}  # only headwords that occur more than once
+    for entry in entries:
+        key = entry.term.lower()
+        first = first_by_term.setdefault(key, entry)
+        if first is not entry:
+            duplicates.setdefault(key, [first]).append(entry)
+
+    for key, entry in first_by_term.items():
+        same_term = duplicates.get(key)
+        if same_term is None:
+            yield entry
+            continue
+        if report is not None:
+            report.add_merged_term(entry.term, len(same_term) - 1)
+        yield _merge_entries(same_term, report)
+
+def _starts_top_level_entry(line):
+    """True if ``line`` is a valid simple or ``~`` entry, i.e. resets the current group."""
+    line = line.strip()
+    if not line or line.startswith('+'):
+        return False
+    if line.startswith('~'):
+        line = line[1:].strip()
+    return tokenize_line(line) is not None
+
+def iter_source_chunks(lines, chunk_lines):
+    """
+    Split source lines into lists of roughly ``chunk_lines`` lines.
+
+    A chunk only ever ends right before a line that starts a new top-level
+    entry, so a ``~`` group is never separated from its ``+`` members and
+    parsing every chunk on its own gives the same entries as parsing the
+    whole input at once.
+
+    Yields:
+        (line number of the first line, list of lines)
+    """
+    chunk = []
+    first_line = 1
+    for line in lines:
+        if len(chunk) >= chunk_lines and _starts_top_level_entry(line):
+            yield first_line, chunk
+            first_line += len(chunk)
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield first_line, chunk
+
+def process_dictionary_content(content, base_filename, work_dir, language_info, build_version=1,
+                               workers=1, chunk_lines=20000, cache_path=None, report=None,
+                               merge_duplicates=False, html_part_max_bytes=0, compact_html=False,
+                               cover_cache_dir=None):
+    import logging
+    logger = logging.getLogger(__name__)
+
+    """
+    Process dictionary content and generate all necessary files.
+    
+    Args:
+        content: The content of the dictionary file, either as a string or
+            as an iterable of lines (e.g. from iter_source_lines)
+        base_filename: Base name for output files
+        work_dir: Working directory path
+        language_info: Dictionary with language settings
+        workers: Number of processes used to parse and render the entries;
+            1 keeps everything in the current process
+        chunk_lines: Approximate number of source lines per worker chunk
+        cache_path: Parse cache artifact for this source (see parse_cache);
+            entries are loaded from it if it exists and written to it otherwise
+        report: Optional ParseReport that receives the source statistics;
+            it is also logged once when parsing is done
+        merge_duplicates: Merge entries with the same headword (see
+            merge_duplicate_entries); always parses in the current process
+        html_part_max_bytes: Split the HTML into several documents of at most
+            this many bytes (see HtmlPartWriter); 0 writes a single document
+        compact_html: Write the HTML without indentation and with duplicate
+            inflections removed (see append_compact_entry_html)
+        cover_cache_dir: Cover cache directory (see cover_cache); the cover
+            is reused from it if the title was rendered before
     
-    logger.info(f"Processed {len(entries)} total entries")
+    Returns:
+        Dictionary with paths to generated files
+    """
+    if isinstance(content, str):
+        content = content.split('\n')
 
     # Generate files
     file_paths = {}
     
-    # Generate HTML content
-    html_content = generate_html(entries, base_filename, language_info)
-    html_path = os.path.join(work_dir, f"{base_filename}.html")
-    with open(html_path, 'w', encoding=language_info['output_encoding']) as f:
-        f.write(html_content)
-    file_paths['html'] = html_path
+    # Parse and render entries straight into the HTML file(s)
+    if report is None:
+        report = ParseReport()
+    cached_entries = parse_cache.load_entries(cache_path, report) if cache_path else None
+    with HtmlPartWriter(work_dir, base_filename, language_info['output_encoding'], html_part_max_bytes,
+                        compact=compact_html) as html_writer:
+        entry_count = None
+        if cached_entries is not None:
+            logger.info(f"Using parsed entries from cache: {cache_path}")
+            if merge_duplicates:
+                cached_entries = merge_duplicate_entries(cached_entries, report)
+            try:
+                entry_count = write_entries(html_writer, cached_entries)
+            except parse_cache.CacheError as e:
+                # Damaged artifact: drop it and render from the source instead
+                logger.warning(f"Discarding parse cache artifact {cache_path}: {str(e)}")
+                os.remove(cache_path)
+                html_writer.reset()
+
+        if (entry_count is None and workers > 1 and not merge_duplicates
+                and not multiprocessing.current_process().daemon):
+            entry_count = write_entries_parallel(html_writer, content, workers, chunk_lines,
+                                              cache_path=cache_path, report=report)
+        elif entry_count is None:
+            entries = iter_entries(content, report)
+            if cache_path:
+                entries = parse_cache.store_entries(entries, cache_path, report)
+            if merge_duplicates:
+                entries = merge_duplicate_entries(entries, report)
+            entry_count = write_entries(html_writer, entries)
+    html_paths = html_writer.paths
+    file_paths['html'] = html_paths[0]
+    for number, path in enumerate(html_paths[1:], 2):
+        file_paths[f'html_{number}'] = path
+    if len(html_paths) > 1:
+        logger.info(f"Split the HTML of {base_filename} into {len(html_paths)} parts")
+
+    # One summary per build instead of a log record per source line
+    log = logger.warning if report.problems else logger.info
+    log(f"Processed {entry_count} top-level entries of {base_filename}; "
+        f"parse report: {json.dumps(report.as_dict(), ensure_ascii=False)}")
     
     # Copy CSS file
     css_source_path = os.path.join(settings.BASE_DIR, 'static', 'css', 'styles.css')
@@ -140,7 +290,7 @@ def process_dictionary_content(content, base_filename, work_dir, language_info,
     file_paths['css'] = css_dest_path
     
     # Generate OPF content
-    opf_content = generate_opf(base_filename, language_info)
+    opf_content = generate_opf(base_filename, language_info, [os.path.basename(path) for path in html_paths])
     opf_path = os.path.join(work_dir, f"{base_filename}.opf")
     with open(opf_path, 'w', encoding=language_info['output_encoding']) as f:
         f.write(opf_content)
@@ -148,7 +298,8 @@ def process_dictionary_content(content, base_filename, work_dir, language_info,
     
     # Generate JPG cover image
     jpg_path = os.path.join(work_dir, f"{base_filename}.jpg")
-    generate_cover_image(base_filename, jpg_path)
+    if cover_cache.get_cover(base_filename, jpg_path, cover_cache_dir):
+        logger.info(f"Using cover image from cache for {base_filename}")
     file_paths['jpg'] = jpg_path
     
     # Generate JSON metadata file
@@ -179,10 +330,7 @@ def process_dictionary_content(content, base_filename, work_dir, language_info,
     
     return file_paths
 
-def generate_html(entries, base_filename, settings):
-    """Generate HTML content for the dictionary."""
-    # Header
-    html_header = f'''<?xml version="1.0" encoding="utf-8"?>
+_HTML_HEADER = '''<?xml version="1.0" encoding="utf-8"?>
 <html 
     xmlns:idx="https://kindlegen.s3.amazonaws.com/AmazonKindlePublishingGuidelines.pdf"
     xmlns:mbp="https://kindlegen.s3.amazonaws.com/AmazonKindlePublishingGuidelines.pdf"
@@ -201,59 +349,320 @@ def generate_html(entries, base_filename, settings):
         <mbp:pagebreak/>	
 '''
 
-    # Entries
-    html_entries = ''
-    for entry in entries:
-        html_entries += generate_entry_html(entry)
-
-    # Footer
-    html_footer = '''    </mbp:frameset>
+_HTML_FOOTER = '''    </mbp:frameset>
   </body>
 </html>
 '''
 
-    return html_header + html_entries + html_footer
+# Header and footer of compact documents: the same markup without indentation
+_COMPACT_HTML_HEADER = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<html xmlns:idx="https://kindlegen.s3.amazonaws.com/AmazonKindlePublishingGuidelines.pdf"'
+    ' xmlns:mbp="https://kindlegen.s3.amazonaws.com/AmazonKindlePublishingGuidelines.pdf"'
+    ' xmlns:xlink="http://www.w3.org/1999/xlink">'
+    '<head><meta http-equiv="Content-Type" content="text/html; charset=utf-8">'
+    '<link rel="stylesheet" href="styles.css" type="text/css"></head>'
+    '<body><mbp:pagebreak/><mbp:frameset>'
+    '<mbp:slave-frame display="bottom" device="all" breadth="auto" leftmargin="0" rightmargin="0"'
+    ' bottommargin="0" topmargin="0"></mbp:slave-frame><mbp:pagebreak/>\n'
+)
+
+_COMPACT_HTML_FOOTER = '</mbp:frameset></body></html>\n'
+
+def html_header_footer(compact=False):
+    """Header and footer of an HTML document in the normal or compact layout."""
+    if compact:
+        return _COMPACT_HTML_HEADER, _COMPACT_HTML_FOOTER
+    return _HTML_HEADER, _HTML_FOOTER
+
+# Rendered fragments collected by write_html before each write to the file
+WRITE_BATCH_PARTS = 8192
+
+def write_html(f, entries, base_filename, settings, compact=False):
+    """
+    Write the dictionary HTML document to an open text file.
+
+    Entries are rendered one at a time into a list of fragments, which is
+    written with a single join every WRITE_BATCH_PARTS fragments, so
+    ``entries`` may be a generator and the document never has to exist in
+    memory as a whole. ``compact`` selects the compact layout.
+
+    Returns:
+        Number of top-level entries written
+    """
+    header, footer = html_header_footer(compact)
+    append_html = append_compact_entry_html if compact else append_entry_html
+    f.write(header)
+    count = 0
+    parts = []
+    for entry in entries:
+        append_html(parts, entry)
+        count += 1
+        if len(parts) >= WRITE_BATCH_PARTS:
+            f.write(''.join(parts))
+            parts.clear()
+    f.write(''.join(parts))
+    f.write(footer)
+    return count
+
+# Characters of rendered entries collected before they are encoded and written
+PART_BATCH_CHARS = 256 * 1024
 
-def generate_entry_html(entry, indent=0):
-    """Generate HTML for a dictionary entry."""
+def html_part_filename(base_filename, number):
+    """File name of the ``number``-th (1-based) HTML part of a dictionary."""
+    return f"{base_filename}.html" if number == 1 else f"{base_filename}-{number}.html"
+
+class HtmlPartWriter:
+    """
+    Writes rendered entries to one or more HTML documents in ``work_dir``.
+
+    A new part is started before an entry that would make the current part
+    larger than ``max_bytes`` (0 means no limit), so a ``~`` group always
+    stays in one part together with its members. Every part is a complete
+    document with the usual header and footer; the first one is
+    ``<base>.html``, the next ones ``<base>-2.html``, ``<base>-3.html``...
+
+    kindlegen needs much less memory and time for several medium-sized
+    documents than for a single huge one.
+
+    With ``compact`` the parts use the compact header and footer, and
+    write_entries renders entries with append_compact_entry_html.
+    """
+
+    def __init__(self, work_dir, base_filename, encoding='utf-8', max_bytes=0, compact=False):
+        self.work_dir = work_dir
+        self.base_filename = base_filename
+        self.encoding = encoding
+        self.max_bytes = max_bytes
+        self.compact = compact
+        self.paths = []
+        header, footer = html_header_footer(compact)
+        self._header = header.encode(encoding)
+        self._footer = footer.encode(encoding)
+        self._file = None
+        self._size = 0
+        self._entries = 0
+        self._pending = []
+        self._pending_chars = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def write_entry(self, html):
+        """Write the HTML of one top-level entry (with its members)."""
+        self._pending.append(html)
+        self._pending_chars += len(html)
+        if self._pending_chars >= PART_BATCH_CHARS:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        data = ''.join(self._pending).encode(self.encoding)
+        if self._file is not None and (not self.max_bytes
+                                       or self._size + len(data) + len(self._footer) <= self.max_bytes):
+            # The whole batch fits into the current part
+            self._file.write(data)
+            self._size += len(data)
+            self._entries += len(self._pending)
+        else:
+            for html in self._pending:
+                self._write_single(html.encode(self.encoding))
+        self._pending = []
+        self._pending_chars = 0
+
+    def _write_single(self, data):
+        if self._file is None or (self.max_bytes and self._entries
+                                  and self._size + len(data) + len(self._footer) > self.max_bytes):
+            self._start_part()
+        self._file.write(data)
+        self._size += len(data)
+        self._entries += 1
+
+    def _start_part(self):
+        self._finish_part()
+        path = os.path.join(self.work_dir, html_part_filename(self.base_filename, len(self.paths) + 1))
+        self._file = open(path, 'wb')
+        self._file.write(self._header)
+        self._size = len(self._header)
+        self._entries = 0
+        self.paths.append(path)
+
+    def _finish_part(self):
+        if self._file is not None:
+            self._file.write(self._footer)
+            self._file.close()
+            self._file = None
+
+    def reset(self):
+        """Delete everything written so far."""
+        self._pending = []
+        self._pending_chars = 0
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for path in self.paths:
+            os.remove(path)
+        self.paths = []
+
+    def close(self):
+        """Finish the last part; a dictionary without entries still gets one document."""
+        self._flush()
+        if self._file is None and not self.paths:
+            self._start_part()
+        self._finish_part()
+
+def write_entries(html_writer, entries):
+    """
+    Render entries into an HtmlPartWriter.
+
+    Returns:
+        Number of top-level entries written
+    """
+    count = 0
+    for entry in entries:
+        html_writer.write_entry(generate_entry_html(entry, compact=html_writer.compact))
+        count += 1
+    return count
+
+def _render_chunk(first_line, lines, encode, compact=False):
+    """Parse and render one chunk of source lines (runs in a worker process)."""
+    report = ParseReport()
+    entries = list(iter_entries(lines, report, first_line))
+    html = [generate_entry_html(entry, compact=compact) for entry in entries]
+    return html, parse_cache.encode_entries(entries) if encode else None, report
+
+def write_entries_parallel(html_writer, lines, workers, chunk_lines, cache_path=None, report=None):
+    """
+    Like write_entries, but parse and render the source in a process pool.
+
+    The source is split by iter_source_chunks; chunks are rendered in
+    ``workers`` processes and their entries are written in source order. At
+    most two chunks per worker are in flight, so memory stays bounded. With
+    ``cache_path`` the workers also serialize their entries, which are
+    written to a new parse cache artifact. The reports of the chunks are
+    merged into ``report``.
+
+    Returns:
+        Number of top-level entries written
+    """
+    if report is None:
+        report = ParseReport()
+    count = 0
+    cache_writer = parse_cache.CacheWriter(cache_path) if cache_path else contextlib.nullcontext()
+    with cache_writer, ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = collections.deque()
+
+        def write_next():
+            html, data, chunk_report = in_flight.popleft().result()
+            for entry_html in html:
+                html_writer.write_entry(entry_html)
+            if data is not None:
+                cache_writer.write(data)
+            report.merge(chunk_report)
+            return len(html)
+
+        for first_line, chunk in iter_source_chunks(lines, chunk_lines):
+            in_flight.append(pool.submit(_render_chunk, first_line, chunk, cache_path is not None,
+                                         html_writer.compact))
+            if len(in_flight) >= 2 * workers:
+                count += write_next()
+        while in_flight:
+            count += write_next()
+        if cache_path:
+            cache_writer.write(parse_cache.encode_report(report))
+    return count
+
+def generate_html(entries, base_filename, settings, compact=False):
+    """Generate HTML content for the dictionary."""
+    buffer = io.StringIO()
+    write_html(buffer, entries, base_filename, settings, compact)
+    return buffer.getvalue()
+
+# Paragraph separators in descriptions: a literal "\\n", a carriage return or <br>
+PARAGRAPH_BREAK_PATTERN = re.compile(r'(\\n|\r|<br>|<BR>)')
+
+def append_entry_html(parts, entry, indent=0):
+    """Append the HTML fragments of a dictionary entry (and its members) to ``parts``."""
     indent_str = '    ' * indent
-    term = entry['term']
-    inflections = entry['inflections']
-    description = entry['description']
-    idx_infl = ''
-    if inflections:
-        idx_infl = '\n' + indent_str + '                <idx:infl>\n'
-        for inf in inflections:
-            idx_infl += indent_str + f'                    <idx:iform value="{inf}"/>\n'
-        idx_infl += indent_str + '                </idx:infl>\n'
-    else:
-        idx_infl = ''
+    term = entry.term
+    append = parts.append
 
     # Use <h2> for all entries
-    header_tag = 'h2'
+    append(f'{indent_str}        <idx:entry name="word" scriptable="yes">\n'
+           f'{indent_str}            <idx:orth value="{term.lower()}">\n'
+           f'{indent_str}                <h2>{term}</h2>')
+    if entry.inflections:
+        append(f'\n{indent_str}                <idx:infl>\n')
+        for inf in entry.inflections:
+            append(f'{indent_str}                    <idx:iform value="{inf}"/>\n')
+        append(f'{indent_str}                </idx:infl>\n')
 
     # Process description to handle multiple paragraphs
     # Replace linebreaks with </p><p> to create separate paragraphs
-    # processed_description = description.replace('\\n', '</p><p>') # old version
-    processed_description = re.sub(r'(\\n|\r|<br>|<BR>)', '</p><p>', description)
-    
-    # Build entry
-    entry_html = indent_str + f'''        <idx:entry name="word" scriptable="yes">
-{indent_str}            <idx:orth value="{term.lower()}">
-{indent_str}                <{header_tag}>{term}</{header_tag}>{idx_infl}{indent_str}            </idx:orth>
-{indent_str}            <p>{processed_description}</p>
-'''
+    processed_description = PARAGRAPH_BREAK_PATTERN.sub('</p><p>', entry.description)
+    append(f'{indent_str}            </idx:orth>\n'
+           f'{indent_str}            <p>{processed_description}</p>\n')
+
     # Process children if any
-    if 'children' in entry and entry['children']:
-        for child in entry['children']:
-            entry_html += generate_entry_html(child, indent=indent+2)
-    entry_html += indent_str + f'''        </idx:entry>
-'''
-    return entry_html
+    for child in entry.children:
+        append_entry_html(parts, child, indent + 2)
+    append(f'{indent_str}        </idx:entry>\n')
+
+def append_compact_entry_html(parts, entry):
+    """
+    Compact variant of append_entry_html: the same elements without
+    indentation and line breaks (only a top-level entry ends with one), and
+    every inflection listed once, leaving out forms equal to the headword.
+    """
+    _append_compact_entry(parts, entry)
+    parts.append('\n')
 
-def generate_opf(base_filename, settings):
-    """Generate OPF content for the dictionary."""
+def _append_compact_entry(parts, entry):
+    term = entry.term
+    orth = term.lower()
+    append = parts.append
+    append(f'<idx:entry name="word" scriptable="yes"><idx:orth value="{orth}"><h2>{term}</h2>')
+    inflections = [inf for inf in dict.fromkeys(entry.inflections) if inf != orth]
+    if inflections:
+        append('<idx:infl>')
+        for inf in inflections:
+            append(f'<idx:iform value="{inf}"/>')
+        append('</idx:infl>')
+    processed_description = PARAGRAPH_BREAK_PATTERN.sub('</p><p>', entry.description)
+    append(f'</idx:orth><p>{processed_description}</p>')
+    for child in entry.children:
+        _append_compact_entry(parts, child)
+    append('</idx:entry>')
+
+def generate_entry_html(entry, indent=0, compact=False):
+    """Generate HTML for a dictionary entry (see append_compact_entry_html for ``compact``)."""
+    parts = []
+    if compact:
+        append_compact_entry_html(parts, entry)
+    else:
+        append_entry_html(parts, entry, indent)
+    return ''.join(parts)
+
+def generate_opf(base_filename, settings, html_files=None):
+    """
+    Generate OPF content for the dictionary.
+
+    ``html_files`` are the names of the HTML parts in reading order
+    (default: the single ``<base>.html``); each gets a manifest item and a
+    spine entry.
+    """
     current_date = datetime.now().strftime("%m/%d/%Y")
+    if not html_files:
+        html_files = [html_part_filename(base_filename, 1)]
+    html_ids = ['dictionary'] + [f'dictionary-{number}' for number in range(2, len(html_files) + 1)]
+    html_items = ''.join(f'     <item id="{html_id}" href="{html_file}" media-type="text/x-oeb1-document"/>\n'
+                         for html_id, html_file in zip(html_ids, html_files))
+    spine_items = ''.join(f'    <itemref idref="{html_id}"/>\n' for html_id in html_ids)
     opf_content = f'''<?xml version="1.0" encoding="utf-8"?>
 <!DOCTYPE package SYSTEM "oeb1.ent">
 <package unique-identifier="uid" xmlns:dc="Dublin Core">
@@ -274,14 +683,12 @@ def generate_opf(base_filename, settings):
     </x-metadata>
 </metadata>
 <manifest>
-     <item id="dictionary" href="{base_filename}.html" media-type="text/x-oeb1-document"/>
-     <item id="css" href="styles.css" media-type="text/css"/>
+{html_items}     <item id="css" href="styles.css" media-type="text/css"/>
      <item id="cover" href="{base_filename}.jpg" media-type="image/jpeg"/>
 </manifest>
 <!-- list of the html files in the correct order  -->
 <spine>
-    <itemref idref="dictionary"/>
-</spine>
+{spine_items}</spine>
 <tours/>
 <guide> <reference type="search" title="Dictionary Search" onclick="index_search()"/> </guide>
 </package>
@@ -289,42 +696,186 @@ def generate_opf(base_filename, settings):
     return opf_content
 
 def generate_cover_image(title, output_path):
-    """Generate a cover image for the dictionary."""
-    img_width, img_height = 600, 800  # Portrait mode dimensions
-    img = Image.new('RGB', (img_width, img_height), color=(255, 255, 255))
-    draw = ImageDraw.Draw(img)
+    """Generate a cover image for the dictionary (see cover_cache.render_cover)."""
+    cover_cache.render_cover(title, output_path)
+
+class BuildArtifact(File):
+    """
+    Generated file that storage may move into place instead of copying.
+
+    Like Django's TemporaryUploadedFile it exposes temporary_file_path(), so
+    FileSystemStorage renames it (builds run on the media filesystem).
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+def kindlegen_jobs_dir():
+    """Directory the external kindlegen processor takes jobs from."""
+    return os.path.join(settings.MEDIA_ROOT, 'kindlegen_jobs')
+
+def create_build_dir(dictionary_instance):
+    """
+    Create the working directory of a build on the media filesystem.
+
+    Builds with the kindlegen backend are written straight into a new job
+    directory, so submitting the job only adds job.json; native builds use
+    DICTIONARY_BUILD_DIR. Either way the artifacts end up in FileField
+    storage by rename, not by copy.
+
+    Returns:
+        Path to the new directory; the caller removes it
+    """
+    import time
+    import uuid
+    from .models import safe_filename_part
+
+    if dictionary_instance.build_backend == 'native':
+        os.makedirs(settings.DICTIONARY_BUILD_DIR, exist_ok=True)
+        return tempfile.mkdtemp(prefix=f"{dictionary_instance.pk}-", dir=settings.DICTIONARY_BUILD_DIR)
+
+    # Tworzymy unikalny katalog dla tego zadania
+    job_id = f"{safe_filename_part(dictionary_instance.name)}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+    job_dir = os.path.join(kindlegen_jobs_dir(), job_id)
+    os.makedirs(job_dir)
+    return job_dir
+
+def submit_kindlegen_job(opf_file, output_file=None, callback=None,
+                         priority=kindlegen_jobs.PRIORITY_INTERACTIVE, compression=None):
+    """
+    Hand the files in the directory of ``opf_file`` to the external kindlegen processor.
+
+    Args:
+        opf_file: Path to the OPF file
+        output_file: Optional output file name
+        callback: Optional Celery task the processor sends when the job is
+            finished, as ``{'task': <task name>, 'args': [...]}``
+        priority: One of kindlegen_jobs.PRIORITIES; interactive jobs run
+            before bulk ones (admin rebuilds)
+        compression: kindlegen compression level (its -c0, -c1, -c2);
+            None = the kindlegen default
+
+    Returns:
+        Path to the job directory
+    """
+    import logging
+    import time
+    import uuid
+    logger = logging.getLogger(__name__)
+
+    # Get directory and base filename
+    directory = os.path.dirname(os.path.abspath(opf_file))
+    base_filename = os.path.splitext(os.path.basename(opf_file))[0]
+
+    # Używamy tylko alternatywnego podejścia - pliki muszą być w katalogu media
+    logger.info("Using external kindlegen processor")
+
+    media_dir = kindlegen_jobs_dir()
+    if os.path.dirname(directory) == os.path.abspath(media_dir):
+        # Built in a job directory (create_build_dir): the files are already in place
+        job_dir = directory
+    else:
+        # Tworzymy unikalny katalog dla tego zadania i dowiązujemy do niego pliki
+        job_id = f"{base_filename}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+        job_dir = os.path.join(media_dir, job_id)
+        os.makedirs(job_dir)
+        for file in os.listdir(directory):
+            src_file = os.path.join(directory, file)
+            if os.path.isfile(src_file):
+                link_or_copy(src_file, os.path.join(job_dir, file))
+
+    # Tworzymy plik zadania
+    job_data = {
+        'opf_file': os.path.basename(opf_file),
+        'output_file': output_file if output_file else f"{base_filename}.mobi",
+        'status': 'pending',
+        'priority': priority,
+        'input_size': kindlegen_jobs.input_size(job_dir),
+        'created_at': time.time()
+    }
+    if callback:
+        job_data['callback'] = callback
+    if compression is not None:
+        job_data['compression'] = compression
+
+    kindlegen_jobs.write_job(job_dir, job_data)
+    kindlegen_jobs.register_job(job_dir, job_data)
+
+    logger.info(f"Created kindlegen job in {job_dir}")
+    return job_dir
+
+def collect_kindlegen_job(job_dir, job, mobi_path):
+    """
+    Move the MOBI file of a finished kindlegen job to ``mobi_path`` and remove the job.
+
+    Nothing is moved if the job ran in the build directory itself.
+
+    Args:
+        job_dir: Job directory returned by submit_kindlegen_job
+        job: Final contents of its job.json (see kindlegen_jobs.wait_for_job)
+        mobi_path: Where to put the MOBI file
+
+    Returns:
+        ``mobi_path``, or None if the job failed
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    job_file = os.path.join(job_dir, 'job.json')
+    if job.get('status') != 'completed':
+        logger.error(f"Job {job.get('status')}: {job.get('error', 'Unknown error')}")
+        return None
 
-    # Use default font
-    font = ImageFont.load_default()
+    logger.info(f"Job completed successfully: {job_file}")
 
-    # Calculate text size and position
-    text = title
-    bbox = font.getbbox(text)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-    position = ((img_width - text_width) / 2, (img_height - text_height) / 2)
+    mobi_file = os.path.join(job_dir, job.get('output_file'))
+    if not (os.path.exists(mobi_file) and os.path.getsize(mobi_file) > 0):
+        logger.error(f"MOBI file not found or empty: {mobi_file}")
+        return None
+    if os.path.abspath(mobi_file) == os.path.abspath(mobi_path):
+        # The job directory is the build directory, which its owner removes
+        return mobi_path
 
-    # Draw text onto image
-    draw.text(position, text, fill=(0, 0, 0), font=font)
+    # Przenosimy plik MOBI do katalogu roboczego
+    shutil.move(mobi_file, mobi_path)
+    logger.info(f"Moved MOBI file to {mobi_path}")
 
-    # Save image
-    img.save(output_path)
+    # Usuwamy katalog zadania po przeniesieniu pliku MOBI
+    try:
+        # Oznaczamy zadanie jako do usunięcia
+        job['cleanup'] = True
+        kindlegen_jobs.write_job(job_dir, job)
 
-def run_kindlegen(opf_file, output_file=None):
+        # Próbujemy usunąć katalog zadania
+        shutil.rmtree(job_dir)
+        logger.info(f"Removed job directory: {job_dir}")
+    except Exception as e:
+        logger.warning(f"Could not remove job directory {job_dir}: {str(e)}")
+
+    return mobi_path
+
+def run_kindlegen(opf_file, output_file=None, priority=kindlegen_jobs.PRIORITY_INTERACTIVE):
     """
     Run kindlegen to generate a MOBI file from the OPF file.
+
+    Submits a job to the external processor and blocks until it is done.
+    A pending job is cancelled once no processor has been seen for
+    KINDLEGEN_JOB_TIMEOUT seconds; a running one is waited for until its
+    deadline (see kindlegen_jobs.give_up_at).
     
     Args:
         opf_file: Path to the OPF file
         output_file: Optional output file name
+        priority: Job priority, see submit_kindlegen_job
     
     Returns:
         Path to the generated MOBI file or None if generation failed
+
+    Raises:
+        kindlegen_jobs.JobTimedOut: The job was cancelled or ran over its deadline
     """
     import logging
     import time
-    import json
-    import shutil
     logger = logging.getLogger(__name__)
     
     # Get directory and base filename
@@ -338,208 +889,456 @@ def run_kindlegen(opf_file, output_file=None):
     logger.info(f"Expected MOBI output path: {mobi_path}")
     
     try:
-        # Używamy tylko alternatywnego podejścia - kopiujemy pliki do katalogu media
-        logger.info("Using external kindlegen processor")
-        
-        from django.conf import settings
-        media_dir = os.path.join(settings.MEDIA_ROOT, 'kindlegen_jobs')
-        os.makedirs(media_dir, exist_ok=True)
-        
-        # Tworzymy unikalny katalog dla tego zadania
-        job_id = f"{base_filename}_{int(time.time())}"
-        job_dir = os.path.join(media_dir, job_id)
-        os.makedirs(job_dir, exist_ok=True)
-        
-        # Kopiujemy wszystkie pliki z katalogu tymczasowego do katalogu zadania
-        for file in os.listdir(directory):
-            src_file = os.path.join(directory, file)
-            if os.path.isfile(src_file):
-                shutil.copy2(src_file, os.path.join(job_dir, file))
-        
-        # Tworzymy plik zadania
-        job_file = os.path.join(job_dir, 'job.json')
-        job_data = {
-            'opf_file': os.path.basename(opf_file),
-            'output_file': output_file if output_file else f"{base_filename}.mobi",
-            'status': 'pending',
-            'created_at': time.time()
-        }
-        
-        with open(job_file, 'w', encoding='utf-8') as f:
-            json.dump(job_data, f, ensure_ascii=False, indent=4)
-        
-        logger.info(f"Created kindlegen job in {job_dir}")
-        
-        # Czekamy na zakończenie zadania (maksymalnie 60 sekund)
-        max_wait = 60
-        wait_interval = 2
-        waited = 0
-        
-        while waited < max_wait:
-            time.sleep(wait_interval)
-            waited += wait_interval
-            
-            # Sprawdzamy, czy plik job.json został zaktualizowany
-            try:
-                with open(job_file, 'r', encoding='utf-8') as f:
-                    updated_job = json.load(f)
-                
-                if updated_job.get('status') == 'completed':
-                    logger.info(f"Job completed successfully: {job_file}")
-                    
-                    # Kopiujemy plik MOBI z powrotem do katalogu tymczasowego
-                    mobi_file = os.path.join(job_dir, updated_job.get('output_file'))
-                    if os.path.exists(mobi_file) and os.path.getsize(mobi_file) > 0:
-                        shutil.copy2(mobi_file, mobi_path)
-                        logger.info(f"Copied MOBI file to {mobi_path}")
-                        
-                        # Usuwamy katalog zadania po skopiowaniu pliku MOBI
-                        try:
-                            # Oznaczamy zadanie jako do usunięcia
-                            updated_job['cleanup'] = True
-                            with open(job_file, 'w', encoding='utf-8') as f:
-                                json.dump(updated_job, f, ensure_ascii=False, indent=4)
-                            
-                            # Próbujemy usunąć katalog zadania
-                            shutil.rmtree(job_dir)
-                            logger.info(f"Removed job directory: {job_dir}")
-                        except Exception as e:
-                            logger.warning(f"Could not remove job directory {job_dir}: {str(e)}")
-                        
-                        return mobi_path
-                    else:
-                        logger.error(f"MOBI file not found or empty: {mobi_file}")
-                        return None
-                
-                elif updated_job.get('status') == 'failed':
-                    logger.error(f"Job failed: {updated_job.get('error', 'Unknown error')}")
-                    return None
-                
-                logger.info(f"Waiting for job completion... ({waited}/{max_wait}s)")
-            
-            except Exception as e:
-                logger.warning(f"Error checking job status: {str(e)}")
-        
-        logger.error(f"Timed out waiting for job completion after {max_wait}s")
-        return None
+        submitted_at = time.time()
+        job_dir = submit_kindlegen_job(opf_file, output_file, priority=priority)
+
+        # Czekamy na sygnał zakończenia zadania od procesora (Redis lub inotify); uruchomione
+        # zadanie ma termin wyznaczony przez procesor, oczekujące - dopóki procesor działa
+        while True:
+            job = kindlegen_jobs.read_job(job_dir)
+            remaining = kindlegen_jobs.give_up_at(job_dir, job, submitted_at,
+                                                  settings.KINDLEGEN_JOB_TIMEOUT) - time.time()
+            if remaining <= 0:
+                waited = int(time.time() - submitted_at)
+                kindlegen_jobs.cancel_job(job_dir, "Build stopped waiting for the job")
+                logger.error(f"Timed out waiting for job completion after {waited}s")
+                raise kindlegen_jobs.JobTimedOut(f"No kindlegen processor finished the job within {waited}s")
+            job = kindlegen_jobs.wait_for_job(job_dir, remaining, settings.KINDLEGEN_REDIS_URL)
+            if job is not None:
+                break
+
+        if job.get('status') == 'timed_out':
+            raise kindlegen_jobs.JobTimedOut(job.get('error') or "kindlegen job timed out")
+        return collect_kindlegen_job(job_dir, job, mobi_path)
     
+    except kindlegen_jobs.JobTimedOut:
+        raise
     except Exception as e:
         logger.error(f"Exception during MOBI generation: {str(e)}", exc_info=True)
         return None
 
-def create_dictionary_files(dictionary_instance):
+def run_native_mobi_writer(source_path, file_paths, base_filename, language_info,
+                           cache_path=None, merge_duplicates=False):
+    """
+    Build the MOBI file with the native writer (see mobi_writer) instead of kindlegen.
+
+    The entries are read back from the parse cache artifact written while the
+    HTML was generated, or parsed from the source again if there is none.
+
+    Args:
+        source_path: Path to the dictionary source file
+        file_paths: Files generated by process_dictionary_content
+        base_filename: Base name for output files
+        language_info: Dictionary with language settings
+        cache_path: Parse cache artifact for this source
+        merge_duplicates: Merge entries with the same headword
+
+    Returns:
+        Path to the generated MOBI file or None if generation failed
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    from . import mobi_writer
+
+    mobi_path = os.path.join(os.path.dirname(file_paths['opf']), f"{base_filename}.mobi")
+    try:
+        entries = parse_cache.load_entries(cache_path) if cache_path else None
+        if entries is None:
+            entries = iter_entries(iter_source_lines(source_path))
+        if merge_duplicates:
+            entries = merge_duplicate_entries(entries)
+        mobi_writer.write_mobi(entries, mobi_path, base_filename, language_info, file_paths.get('jpg'))
+        return mobi_path
+    except Exception as e:
+        logger.error(f"Exception during native MOBI generation: {str(e)}", exc_info=True)
+        return None
+
+def prepare_dictionary_build(dictionary_instance, work_dir):
+    """
+    First build stage: generate the HTML, OPF, CSS, cover and metadata files.
+
+    Args:
+        dictionary_instance: A Dictionary model instance
+        work_dir: Directory the files are written to
+
+    Returns:
+        Build description (JSON-serializable, so it can be handed to a later
+        stage running in another task): ``work_dir``, ``base_filename``,
+        ``language_info``, ``cache_path``, ``source_path`` and ``file_paths``
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    # Source lines are read lazily while the HTML is being written
+    source_path = dictionary_instance.source_file.path
+    lines = iter_source_lines(source_path)
+    report = ParseReport()
+
+    # Entries parsed from an identical source are reused from the cache
+    cache_file = None
+    if settings.PARSE_CACHE_ENABLED:
+        cache_file = parse_cache.cache_path(settings.PARSE_CACHE_DIR, parse_cache.source_digest(source_path))
+
+    # Large sources are parsed and rendered in a process pool
+    workers = 1
+    if settings.DICTIONARY_PARALLEL_MIN_SIZE and os.path.getsize(source_path) >= settings.DICTIONARY_PARALLEL_MIN_SIZE:
+        workers = settings.DICTIONARY_PARALLEL_WORKERS or os.cpu_count() or 1
+
+    # Large sources are rendered without cosmetic whitespace
+    compact_html = bool(settings.DICTIONARY_COMPACT_HTML_MIN_SIZE
+                        and os.path.getsize(source_path) >= settings.DICTIONARY_COMPACT_HTML_MIN_SIZE)
+
+    # The dictionary's display name may contain characters that are reserved
+    # on Windows / break Wine's path translation (e.g. ``"``). Derive a
+    # filesystem-safe base name for every file we generate and for the
+    # kindlegen job directory.
+    from .models import safe_filename_part
+    base_filename = safe_filename_part(dictionary_instance.name)
+
+    # Set up language info
+    language_info = {
+        'css_path': 'styles.css',
+        'language_code': dictionary_instance.language_code,
+        'creator_name': dictionary_instance.creator_name,
+        'updater_name': dictionary_instance.updater_name,
+        'output_encoding': 'utf-8',
+        'dictionary_in_language': 'pl',  # Default, could be customized later
+        'dictionary_out_language': 'pl',  # Default, could be customized later
+    }
+
+    # Add original build date if this is an update
+    if dictionary_instance.created_at:
+        language_info['original_build_date'] = dictionary_instance.created_at.isoformat()
+        logger.info(f"Using original build date from model: {language_info['original_build_date']}")
+
+    # Process dictionary content
+    file_paths = process_dictionary_content(
+        lines,
+        base_filename,
+        work_dir,
+        language_info,
+        dictionary_instance.build_version,
+        workers=workers,
+        chunk_lines=settings.DICTIONARY_PARALLEL_CHUNK_LINES,
+        cache_path=cache_file,
+        report=report,
+        merge_duplicates=dictionary_instance.merge_duplicates,
+        html_part_max_bytes=settings.DICTIONARY_HTML_PART_MAX_BYTES,
+        compact_html=compact_html,
+        cover_cache_dir=settings.COVER_CACHE_DIR if settings.COVER_CACHE_ENABLED else None
+    )
+    dictionary_instance.build_report = report.as_dict()
+    if cache_file:
+        parse_cache.prune_cache(settings.PARSE_CACHE_DIR, settings.PARSE_CACHE_MAX_BYTES,
+                                settings.PARSE_CACHE_MAX_AGE_DAYS)
+    if settings.COVER_CACHE_ENABLED:
+        parse_cache.prune_cache(settings.COVER_CACHE_DIR, settings.COVER_CACHE_MAX_BYTES,
+                                settings.COVER_CACHE_MAX_AGE_DAYS, suffix=cover_cache.SUFFIX)
+
+    return {
+        'work_dir': work_dir,
+        'base_filename': base_filename,
+        'language_info': language_info,
+        'cache_path': cache_file,
+        'source_path': source_path,
+        'file_paths': file_paths,
+    }
+
+def kindlegen_cache_key(build):
+    """Key of a prepared build in the kindlegen MOBI cache, or None if the cache is disabled."""
+    if not settings.KINDLEGEN_CACHE_ENABLED:
+        return None
+    return mobi_cache.input_digest(build['file_paths'], settings.KINDLEGEN_VERSION)
+
+def cached_kindlegen_mobi(dictionary_instance, build, cache_key):
+    """
+    Take the MOBI file of a build from the kindlegen cache.
+
+    Records the outcome as ``kindlegen_cache`` in the build report.
+
+    Returns:
+        Path to the MOBI file in the build directory, or None on a miss
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    if not cache_key:
+        return None
+    mobi_path = os.path.join(build['work_dir'], f"{build['base_filename']}.mobi")
+    hit = mobi_cache.get_mobi(settings.KINDLEGEN_CACHE_DIR, cache_key, mobi_path)
+    if dictionary_instance.build_report is not None:
+        dictionary_instance.build_report['kindlegen_cache'] = 'hit' if hit else 'miss'
+    if not hit:
+        return None
+    logger.info(f"Using MOBI file from the kindlegen cache: {cache_key}")
+    return mobi_path
+
+def cache_kindlegen_mobi(cache_key, mobi_path):
+    """Add the MOBI file kindlegen produced for a build to the kindlegen cache."""
+    if not cache_key or not mobi_path:
+        return
+    mobi_cache.put_mobi(settings.KINDLEGEN_CACHE_DIR, cache_key, mobi_path)
+    parse_cache.prune_cache(settings.KINDLEGEN_CACHE_DIR, settings.KINDLEGEN_CACHE_MAX_BYTES,
+                            settings.KINDLEGEN_CACHE_MAX_AGE_DAYS, suffix=mobi_cache.SUFFIX)
+
+def record_kindlegen_job(dictionary_instance, job, key='kindlegen_job'):
+    """Record the outcome, priority and queue wait of a finished kindlegen job as ``key`` in the build report."""
+    if dictionary_instance.build_report is None or job is None:
+        return
+    dictionary_instance.build_report[key] = {
+        'status': job.get('status'),
+        'priority': job.get('priority', kindlegen_jobs.PRIORITY_INTERACTIVE),
+        'input_size': job.get('input_size'),
+        'queue_wait': job.get('queue_wait'),
+    }
+
+def build_kindlegen_mobi(dictionary_instance, build, priority=kindlegen_jobs.PRIORITY_INTERACTIVE):
+    """Build the MOBI file of a prepared build with kindlegen, unless the kindlegen cache has it."""
+    cache_key = kindlegen_cache_key(build)
+    mobi_path = cached_kindlegen_mobi(dictionary_instance, build, cache_key)
+    if mobi_path is None:
+        mobi_path = run_kindlegen(build['file_paths']['opf'], priority=priority)
+        cache_kindlegen_mobi(cache_key, mobi_path)
+    return mobi_path
+
+def create_final_build(dictionary_instance, build):
+    """
+    Copy a prepared build into a new job directory for the compressed final kindlegen pass.
+
+    The source files are hard-linked (see link_or_copy), so the
+    preview build can be packaged - its files renamed into storage - while
+    the final job still waits in the queue.
+
+    Returns:
+        Build description like prepare_dictionary_build's, in the new directory
+    """
+    job_dir = create_build_dir(dictionary_instance)
+    file_paths = {}
+    for key, path in build['file_paths'].items():
+        file_paths[key] = os.path.join(job_dir, os.path.basename(path))
+        link_or_copy(path, file_paths[key])
+    return dict(build, work_dir=job_dir, file_paths=file_paths)
+
+def build_native_mobi(dictionary_instance, build):
+    """Build the MOBI file of a prepared build with the native writer (see run_native_mobi_writer)."""
+    return run_native_mobi_writer(build['source_path'], build['file_paths'], build['base_filename'],
+                                  build['language_info'], cache_path=build['cache_path'],
+                                  merge_duplicates=dictionary_instance.merge_duplicates)
+
+def create_zip_package(build, file_paths):
+    """
+    Create the ZIP package of a build from ``file_paths`` (including the MOBI file, if any).
+
+    Returns:
+        Path to the ZIP file in the build directory
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    # Teraz tworzymy plik ZIP, który będzie zawierał również plik MOBI
+    zip_path = os.path.join(build['work_dir'], f"{build['base_filename']}.zip")
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for file_key, file_path in file_paths.items():
+            if os.path.exists(file_path):
+                zipf.write(file_path, os.path.basename(file_path))
+
+    # Upewnijmy się, że plik MOBI został dodany do pliku ZIP
+    if 'mobi' in file_paths and os.path.exists(file_paths['mobi']):
+        with zipfile.ZipFile(zip_path, 'a') as zipf:
+            mobi_filename = os.path.basename(file_paths['mobi'])
+            if mobi_filename not in zipf.namelist():
+                zipf.write(file_paths['mobi'], mobi_filename)
+                logger.info(f"Added MOBI file to ZIP: {mobi_filename}")
+    return zip_path
+
+def package_dictionary_build(dictionary_instance, build, mobi_path=None, preview=False):
+    """
+    Last build stage: create the ZIP package and save all files to the model.
+
+    Args:
+        dictionary_instance: A Dictionary model instance
+        build: Build description returned by prepare_dictionary_build
+        mobi_path: Generated MOBI file, if there is one
+        preview: The MOBI file is an uncompressed preview, to be replaced
+            by publish_final_mobi
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    file_paths = dict(build['file_paths'])
+    if mobi_path and os.path.exists(mobi_path):
+        file_paths['mobi'] = mobi_path
+    file_paths['zip'] = create_zip_package(build, file_paths)
+    dictionary_instance.mobi_is_preview = preview and 'mobi' in file_paths
+    if dictionary_instance.build_report is not None:
+        # Dalsze części podzielonego HTML są tylko w pakiecie ZIP
+        dictionary_instance.build_report['html_parts'] = sum(
+            1 for key in file_paths if key == 'html' or key.startswith('html_'))
+
+    # Save files to model
+    logger.info(f"Saving files to dictionary model. Available files: {list(file_paths.keys())}")
+
+    for file_key, file_path in file_paths.items():
+        if os.path.exists(file_path):
+            logger.info(f"Saving {file_key} file: {file_path}")
+            with open(file_path, 'rb') as f:
+                # Storage renames the file into place (see BuildArtifact)
+                if file_key == 'html':
+                    dictionary_instance.html_file.save(os.path.basename(file_path), BuildArtifact(f), save=False)
+                elif file_key == 'opf':
+                    dictionary_instance.opf_file.save(os.path.basename(file_path), BuildArtifact(f), save=False)
+                elif file_key == 'jpg':
+                    dictionary_instance.jpg_file.save(os.path.basename(file_path), BuildArtifact(f), save=False)
+                elif file_key == 'json':
+                    dictionary_instance.json_file.save(os.path.basename(file_path), BuildArtifact(f), save=False)
+                elif file_key == 'zip':
+                    dictionary_instance.zip_file.save(os.path.basename(file_path), BuildArtifact(f), save=False)
+                elif file_key == 'mobi':
+                    logger.info(f"Saving MOBI file: {file_path} (size: {os.path.getsize(file_path)} bytes)")
+                    dictionary_instance.mobi_file.save(os.path.basename(file_path), BuildArtifact(f), save=False)
+        else:
+            logger.warning(f"File {file_path} does not exist, skipping")
+
+    # Nie aktualizujemy numeru wersji z pliku JSON, ponieważ chcemy zachować wartość ustawioną w widoku
+    # Numer wersji jest już zapisany w pliku JSON i zostanie zachowany w modelu
+
+    # Save the instance
+    dictionary_instance.save()
+
+def publish_final_mobi(dictionary_instance, build, mobi_path):
+    """
+    Replace the preview MOBI file of a dictionary and its ZIP package with the final build.
+
+    The files are saved under new names and the model switches to them in a
+    single conditional UPDATE, so a download gets either the preview or the
+    final file, never a partly written one. Nothing is replaced if another
+    build of the dictionary has started since the preview was published.
+
+    Args:
+        dictionary_instance: A Dictionary model instance
+        build: Build description returned by create_final_build
+        mobi_path: Compressed MOBI file, or None if the final pass failed
+
+    Returns:
+        True if the final files were published
+    """
+    import logging
+    import time
+    from django.utils import timezone
+    logger = logging.getLogger(__name__)
+
+    report = dictionary_instance.build_report or {}
+    if report.get('preview_build') != build['preview_build']:
+        logger.info(f"Dictionary {dictionary_instance.pk} was rebuilt in the meantime, discarding final build")
+        return False
+    if not mobi_path or not os.path.exists(mobi_path):
+        abandon_final_build(dictionary_instance, build, "Final kindlegen pass failed")
+        return False
+
+    file_paths = dict(build['file_paths'])
+    file_paths['mobi'] = mobi_path
+    zip_path = create_zip_package(build, file_paths)
+
+    previous = {'mobi_file': dictionary_instance.mobi_file.name, 'zip_file': dictionary_instance.zip_file.name}
+    for field_name, path in (('mobi_file', mobi_path), ('zip_file', zip_path)):
+        with open(path, 'rb') as f:
+            getattr(dictionary_instance, field_name).save(os.path.basename(path), BuildArtifact(f), save=False)
+    published = {'mobi_file': dictionary_instance.mobi_file.name, 'zip_file': dictionary_instance.zip_file.name}
+
+    report = dict(report)
+    if build.get('build_started_at'):
+        report['time_to_final_mobi'] = round(time.time() - build['build_started_at'], 3)
+    updated = type(dictionary_instance)._default_manager.filter(pk=dictionary_instance.pk, **previous).update(
+        mobi_is_preview=False, build_report=report, updated_at=timezone.now(), **published)
+
+    # Usuwamy pliki, których model już (albo jeszcze) nie wskazuje
+    storage = dictionary_instance.mobi_file.storage
+    for name in (previous if updated else published).values():
+        if name and name not in (published if updated else previous).values():
+            storage.delete(name)
+    if not updated:
+        logger.info(f"Files of dictionary {dictionary_instance.pk} changed in the meantime, discarding final build")
+        dictionary_instance.refresh_from_db()
+        return False
+    dictionary_instance.mobi_is_preview = False
+    dictionary_instance.build_report = report
+    logger.info(f"Published final MOBI file of dictionary {dictionary_instance.pk}: {published['mobi_file']}")
+    return True
+
+def abandon_final_build(dictionary_instance, build, reason):
+    """
+    Keep the preview MOBI file of a two-phase build for good.
+
+    The dictionary stops being marked as waiting for the compressed build
+    (``mobi_is_preview``) and ``reason`` is recorded in the build report as
+    ``final_build_error``, unless the dictionary has been rebuilt since.
+
+    Args:
+        dictionary_instance: A Dictionary model instance
+        build: Build description returned by create_final_build
+        reason: Why the final build was given up
+    """
+    import logging
+    from django.utils import timezone
+    logger = logging.getLogger(__name__)
+
+    report = dictionary_instance.build_report or {}
+    if report.get('preview_build') != build['preview_build']:
+        # Not published yet (finish_dictionary_build then publishes it as final) or rebuilt since
+        return
+    report = dict(report, final_build_error=reason)
+    updated = type(dictionary_instance)._default_manager.filter(
+        pk=dictionary_instance.pk, mobi_file=dictionary_instance.mobi_file.name).update(
+        mobi_is_preview=False, build_report=report, updated_at=timezone.now())
+    if updated:
+        dictionary_instance.mobi_is_preview = False
+        dictionary_instance.build_report = report
+    logger.warning(f"{reason}, keeping the preview MOBI of {dictionary_instance.pk}")
+
+def mark_build_failed(dictionary_instance, error):
+    """Record a failed build on the dictionary."""
+    import logging
+    logger = logging.getLogger(__name__)
+    logger.error(f"Error creating dictionary files: {str(error)}")
+
+    # Update dictionary status
+    dictionary_instance.status = 'failed'
+    dictionary_instance.status_message = str(error)
+    dictionary_instance.save(update_fields=['status', 'status_message', 'build_report', 'updated_at'])
+
+def create_dictionary_files(dictionary_instance, priority=kindlegen_jobs.PRIORITY_INTERACTIVE):
     """
     Create all necessary files for a dictionary and update the dictionary instance.
+
+    Runs all build stages in the calling process and waits for kindlegen;
+    see tasks.process_dictionary for the variant that does not block while
+    the external processor is working.
     
     Args:
         dictionary_instance: A Dictionary model instance
+        priority: Priority of the kindlegen job, see submit_kindlegen_job
     
     Returns:
         True if successful, False otherwise
     """
-    import logging
-    logger = logging.getLogger(__name__)
+    work_dir = None
     try:
-        # Get source file content
-        content = read_file_preserving_cr(dictionary_instance.source_file.path)
-
-        # The dictionary's display name may contain characters that are reserved
-        # on Windows / break Wine's path translation (e.g. ``"``). Derive a
-        # filesystem-safe base name for every file we generate and for the
-        # kindlegen job directory.
-        from .models import safe_filename_part
-        base_filename = safe_filename_part(dictionary_instance.name)
-
-        # Create a temporary working directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Set up language info
-            language_info = {
-                'css_path': 'styles.css',
-                'language_code': dictionary_instance.language_code,
-                'creator_name': dictionary_instance.creator_name,
-                'updater_name': dictionary_instance.updater_name,
-                'output_encoding': 'utf-8',
-                'dictionary_in_language': 'pl',  # Default, could be customized later
-                'dictionary_out_language': 'pl',  # Default, could be customized later
-            }
-
-            # Add original build date if this is an update
-            if dictionary_instance.created_at:
-                language_info['original_build_date'] = dictionary_instance.created_at.isoformat()
-                logger.info(f"Using original build date from model: {language_info['original_build_date']}")
-
-            # Process dictionary content
-            file_paths = process_dictionary_content(
-                content,
-                base_filename,
-                temp_dir,
-                language_info,
-                dictionary_instance.build_version
-            )
-
-            # Generate MOBI file
-            mobi_path = run_kindlegen(file_paths['opf'])
-            if mobi_path and os.path.exists(mobi_path):
-                file_paths['mobi'] = mobi_path
-
-            # Teraz tworzymy plik ZIP, który będzie zawierał również plik MOBI
-            zip_path = os.path.join(temp_dir, f"{base_filename}.zip")
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                for file_key, file_path in file_paths.items():
-                    if os.path.exists(file_path):
-                        zipf.write(file_path, os.path.basename(file_path))
-            file_paths['zip'] = zip_path
-            
-            # Upewnijmy się, że plik MOBI został dodany do pliku ZIP
-            if 'mobi' in file_paths and os.path.exists(file_paths['mobi']):
-                with zipfile.ZipFile(zip_path, 'a') as zipf:
-                    mobi_filename = os.path.basename(file_paths['mobi'])
-                    if mobi_filename not in zipf.namelist():
-                        zipf.write(file_paths['mobi'], mobi_filename)
-                        logger.info(f"Added MOBI file to ZIP: {mobi_filename}")
-            
-            # Save files to model
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.info(f"Saving files to dictionary model. Available files: {list(file_paths.keys())}")
-            
-            for file_key, file_path in file_paths.items():
-                if os.path.exists(file_path):
-                    logger.info(f"Saving {file_key} file: {file_path}")
-                    with open(file_path, 'rb') as f:
-                        if file_key == 'html':
-                            dictionary_instance.html_file.save(os.path.basename(file_path), File(f), save=False)
-                        elif file_key == 'opf':
-                            dictionary_instance.opf_file.save(os.path.basename(file_path), File(f), save=False)
-                        elif file_key == 'jpg':
-                            dictionary_instance.jpg_file.save(os.path.basename(file_path), File(f), save=False)
-                        elif file_key == 'json':
-                            dictionary_instance.json_file.save(os.path.basename(file_path), File(f), save=False)
-                        elif file_key == 'zip':
-                            dictionary_instance.zip_file.save(os.path.basename(file_path), File(f), save=False)
-                        elif file_key == 'mobi':
-                            logger.info(f"Saving MOBI file: {file_path} (size: {os.path.getsize(file_path)} bytes)")
-                            dictionary_instance.mobi_file.save(os.path.basename(file_path), File(f), save=False)
-                else:
-                    logger.warning(f"File {file_path} does not exist, skipping")
-            
-            # Nie aktualizujemy numeru wersji z pliku JSON, ponieważ chcemy zachować wartość ustawioną w widoku
-            # Numer wersji jest już zapisany w pliku JSON i zostanie zachowany w modelu
-            
-            # Save the instance
-            dictionary_instance.save()
-            
-            return True
+        # Working directory on the media filesystem, see create_build_dir
+        work_dir = create_build_dir(dictionary_instance)
+        build = prepare_dictionary_build(dictionary_instance, work_dir)
+
+        # Generate MOBI file
+        if dictionary_instance.build_backend == 'native':
+            mobi_path = build_native_mobi(dictionary_instance, build)
+        else:
+            mobi_path = build_kindlegen_mobi(dictionary_instance, build, priority=priority)
+
+        package_dictionary_build(dictionary_instance, build, mobi_path)
+        return True
     
     except Exception as e:
-        # Log the error
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f"Error creating dictionary files: {str(e)}")
-        
-        # Update dictionary status
-        dictionary_instance.status = 'failed'
-        dictionary_instance.status_message = str(e)
-        dictionary_instance.save(update_fields=['status', 'status_message', 'updated_at'])
-        
+        mark_build_failed(dictionary_instance, e)
         return False
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,53 @@
+# src/dictionary/entries.py
+
+"""
+Compact in-memory representation of parsed dictionary entries.
+
+Entries use ``__slots__`` instead of per-instance dicts and keep their
+inflections in tuples of interned strings, so a dictionary with many
+repeated inflected forms stores each form only once.
+"""
+
+import sys
+
+
+def intern_inflections(inflections):
+    """Return ``inflections`` as a tuple of interned strings."""
+    return tuple([sys.intern(inf) for inf in inflections])
+
+
+class Entry:
+    """A simple dictionary entry (or a member of a group)."""
+
+    __slots__ = ('term', 'inflections', 'description')
+
+    # Simple entries never have members; EntryGroup overrides this with a slot.
+    children = ()
+
+    def __init__(self, term, inflections, description):
+        self.term = term
+        self.inflections = intern_inflections(inflections)
+        self.description = description
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return (self.term == other.term
+                and self.inflections == other.inflections
+                and self.description == other.description
+                and self.children == other.children)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.term!r}, {self.inflections!r}, {self.description!r})"
+
+
+class EntryGroup(Entry):
+    """A ``~`` group entry with its ``+`` members in ``children``."""
+
+    __slots__ = ('children',)
+
+    def __init__(self, term, inflections, description, children=None):
+        super().__init__(term, inflections, description)
+        self.children = children if children is not None else []
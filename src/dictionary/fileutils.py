@@ -0,0 +1,16 @@
+# src/dictionary/fileutils.py
+
+"""
+File helpers shared by the build stages and the on-disk caches.
+"""
+
+import os
+import shutil
+
+
+def link_or_copy(source, destination):
+    """Hard-link ``source`` to ``destination``, copying it if linking is not possible."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
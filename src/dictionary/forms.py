@@ -11,10 +11,53 @@ from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import Group
 from .models import Dictionary, DictionarySuggestion, SMTPConfiguration, ContactMessage, CaptchaConfiguration, Task
 from django.core.validators import FileExtensionValidator
+from django.conf import settings
+from .dictionary_creator import validate_lines
+from .source_reader import iter_uploaded_lines
 
+# Line numbers listed in a source validation error
+MAX_REPORTED_LINES = 10
 
 APPROVABLE_GROUP_NAMES = ['Dictionary Creator', 'Dictionary Edit', 'Dictionary Admin']
 
+
+def _line_numbers(samples, count):
+    numbers = ', '.join(str(number) for number, _text in samples[:MAX_REPORTED_LINES])
+    return numbers + ', ...' if count > MAX_REPORTED_LINES else numbers
+
+
+def check_dictionary_source(form, content, source_file):
+    """
+    Reject sources the dictionary builder would skip lines of.
+
+    Parses the pasted content and/or the uploaded file in validation mode
+    (see dictionary_creator.validate_lines) and adds errors to the
+    corresponding form field, so a broken source never reaches the build queue.
+    """
+    sources = []
+    if content:
+        sources.append(('content', content.split('\n')))
+    if source_file:
+        sources.append(('source_file', iter_uploaded_lines(source_file)))
+
+    for field, lines in sources:
+        report = validate_lines(lines)
+        if report.is_acceptable(settings.DICTIONARY_SOURCE_MAX_PROBLEMS):
+            continue
+        if report.total_entries == 0:
+            form.add_error(field, _("Źródło nie zawiera żadnych poprawnych wpisów."))
+            continue
+        if report.invalid:
+            form.add_error(field, _("Wiersze w niepoprawnym formacie (%(count)d): %(lines)s.") % {
+                'count': report.invalid,
+                'lines': _line_numbers(report.invalid_samples, report.invalid),
+            })
+        if report.orphans:
+            form.add_error(field, _("Wiersze '+' bez poprzedzającej grupy '~' (%(count)d): %(lines)s.") % {
+                'count': report.orphans,
+                'lines': _line_numbers(report.orphan_samples, report.orphans),
+            })
+
 class DictionaryForm(forms.ModelForm):
     """Form for uploading a new dictionary"""
     
@@ -37,7 +80,7 @@ class DictionaryForm(forms.ModelForm):
     
     class Meta:
         model = Dictionary
-        fields = ['name', 'description', 'creator_name', 'notification_email', 'language_code', 'is_public', 'source_file']
+        fields = ['name', 'description', 'creator_name', 'notification_email', 'language_code', 'is_public', 'merge_duplicates', 'source_file']
         widgets = {
             'name': forms.TextInput(attrs={'class': 'form-control'}),
             'description': forms.Textarea(attrs={'class': 'form-control', 'rows': 5}),
@@ -45,6 +88,7 @@ class DictionaryForm(forms.ModelForm):
             'notification_email': forms.EmailInput(attrs={'class': 'form-control'}),
             'language_code': forms.TextInput(attrs={'class': 'form-control'}),
             'is_public': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
+            'merge_duplicates': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
         }
         labels = {
             'name': _('Nazwa'),
@@ -53,10 +97,12 @@ class DictionaryForm(forms.ModelForm):
             'notification_email': _('Adres e-mail do powiadomień'),
             'language_code': _('Kod języka'),
             'is_public': _('Publiczny'),
+            'merge_duplicates': _('Scal powtórzone hasła'),
         }
         help_texts = {
             'notification_email': _('Opcjonalny adres e-mail, na który zostanie wysłane powiadomienie o utworzeniu słownika.'),
             'language_code': _('Np. pl dla polskiego, en dla angielskiego.'),
+            'merge_duplicates': _('Wpisy o tym samym haśle zostaną połączone w jeden: opisy jako kolejne akapity, odmiany bez powtórzeń.'),
         }
     
     def clean(self):
@@ -68,6 +114,8 @@ class DictionaryForm(forms.ModelForm):
         if not content and not source_file:
             raise forms.ValidationError(_("Musisz albo podać zawartość, albo przesłać plik."))
         
+        check_dictionary_source(self, content, source_file)
+        
         return cleaned_data
 
 
@@ -238,7 +286,7 @@ class DictionaryUpdateForm(forms.ModelForm):
     
     class Meta:
         model = Dictionary
-        fields = ['name', 'description', 'creator_name', 'updater_name', 'notification_email', 'language_code', 'is_public', 'source_file']
+        fields = ['name', 'description', 'creator_name', 'updater_name', 'notification_email', 'language_code', 'is_public', 'merge_duplicates', 'source_file']
         widgets = {
             'name': forms.TextInput(attrs={'class': 'form-control'}),
             'description': forms.Textarea(attrs={'class': 'form-control', 'rows': 5}),
@@ -247,6 +295,7 @@ class DictionaryUpdateForm(forms.ModelForm):
             'notification_email': forms.EmailInput(attrs={'class': 'form-control'}),
             'language_code': forms.TextInput(attrs={'class': 'form-control'}),
             'is_public': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
+            'merge_duplicates': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
         }
         labels = {
             'name': _('Nazwa'),
@@ -256,12 +305,14 @@ class DictionaryUpdateForm(forms.ModelForm):
             'notification_email': _('Adres e-mail do powiadomień'),
             'language_code': _('Kod języka'),
             'is_public': _('Publiczny'),
+            'merge_duplicates': _('Scal powtórzone hasła'),
         }
         help_texts = {
             'creator_name': _('Autor oryginalnego słownika (tylko do odczytu).'),
             'updater_name': _('Osoba, która dokonała ostatniej modyfikacji słownika.'),
             'notification_email': _('Opcjonalny adres e-mail, na który zostanie wysłane powiadomienie o aktualizacji słownika.'),
             'language_code': _('Np. pl dla polskiego, en dla angielskiego.'),
+            'merge_duplicates': _('Wpisy o tym samym haśle zostaną połączone w jeden: opisy jako kolejne akapity, odmiany bez powtórzeń.'),
         }
     
     def clean(self):
@@ -273,6 +324,8 @@ class DictionaryUpdateForm(forms.ModelForm):
         if not content and not source_file:
             raise forms.ValidationError(_("Musisz albo podać zawartość, albo przesłać plik."))
         
+        check_dictionary_source(self, content, source_file)
+        
         return cleaned_data
 
 
@@ -434,6 +487,8 @@ class DictionaryChangeForm(forms.Form):
         if not content and not source_file:
             raise forms.ValidationError(_("Musisz albo podać zawartość, albo przesłać plik."))
         
+        check_dictionary_source(self, content, source_file)
+        
         return cleaned_data
 
 
@@ -0,0 +1,348 @@
+# src/dictionary/kindlegen_jobs.py
+
+"""
+Waiting for jobs of the external kindlegen processor (scripts/process_kindlegen_jobs.py).
+
+The processor updates ``job.json`` in the job directory when a job has
+finished. If it runs with ``--redis-url`` it also pushes the final status
+to the Redis list ``kindlegen:done:<job_id>``, which wait_for_job blocks on,
+so a build continues as soon as kindlegen is done. Without Redis the job
+directory is watched with inotify (Linux) and ``job.json`` is re-read only
+when it has been written; on other systems it is polled.
+
+Both sides replace ``job.json`` atomically (write_job here, the function of
+the same name in the processor), so it is never read half written. New jobs
+are also registered in the processor's SQLite queue index (register_job), so
+it does not have to scan every job directory to find them.
+
+A running job has a deadline in job.json, set by the processor from the
+size of its input; a job over it is killed and ends "timed_out". A build
+waits for a pending job as long as a processor is alive (it touches
+HEARTBEAT_FILE on every pass of its loop), cancels it once none has been
+seen for a while (cancel_job), and waits for a running one until its
+deadline (give_up_at).
+
+Every job carries a priority (PRIORITIES, most urgent first) and the size
+of its kindlegen input (input_size); the processor runs interactive jobs
+before bulk ones and smaller jobs first within a priority.
+"""
+
+import os
+import json
+import time
+import math
+import errno
+import select
+import ctypes
+import ctypes.util
+import sqlite3
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+JOB_FILE = 'job.json'
+# Must match FINAL_STATUSES in scripts/process_kindlegen_jobs.py
+FINAL_STATUSES = ('completed', 'failed', 'timed_out')
+
+# Seconds a build keeps waiting for a running job after its deadline, for
+# the processor to record the timeout
+DEADLINE_GRACE = 60
+
+# Touched in the jobs directory by a running processor; must match
+# HEARTBEAT_FILE in scripts/process_kindlegen_jobs.py
+HEARTBEAT_FILE = 'processor.alive'
+
+# Job priorities in dispatch order; must match PRIORITIES in
+# scripts/process_kindlegen_jobs.py
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+# Files kindlegen reads; their total size estimates how long a job takes
+INPUT_EXTENSIONS = ('.opf', '.html', '.css', '.jpg')
+
+# Redis list the processor pushes the final status of a job to; must match
+# COMPLETION_KEY in scripts/process_kindlegen_jobs.py
+COMPLETION_KEY = 'kindlegen:done:{job_id}'
+
+# Queue index in the jobs directory; must match INDEX_FILE and INDEX_SCHEMA
+# in scripts/process_kindlegen_jobs.py
+INDEX_FILE = 'queue.sqlite3'
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+# Used only where neither Redis nor inotify is available
+POLL_INTERVAL = 1.0
+
+# Longest single BLPOP; job.json is re-read between them, so a job whose
+# signal never comes (processor without --redis-url) is still noticed
+REDIS_WAIT_SLICE = 30
+
+# Redis clients by URL, reused by every wait in this process
+_redis_clients = {}
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def completion_key(job_id):
+    """Redis list that receives the final status of a job."""
+    return COMPLETION_KEY.format(job_id=job_id)
+
+
+def read_job(job_dir):
+    """Return the contents of a job's job.json, or None if it cannot be read (yet)."""
+    try:
+        with open(os.path.join(job_dir, JOB_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_job(job_dir, job):
+    """Atomically replace job.json of a job (temporary file + rename)."""
+    fd, tmp_path = tempfile.mkstemp(dir=job_dir, prefix='.job.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, os.path.join(job_dir, JOB_FILE))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def input_size(job_dir):
+    """Total size in bytes of the kindlegen input files in a job directory."""
+    size = 0
+    with os.scandir(job_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(INPUT_EXTENSIONS):
+                size += entry.stat().st_size
+    return size
+
+
+def register_job(job_dir, job):
+    """
+    Add a new job to the processor's queue index.
+
+    Failures are only logged: the processor finds jobs missing from the
+    index on its next full rescan.
+    """
+    jobs_dir, job_id = os.path.split(job_dir)
+    try:
+        conn = sqlite3.connect(os.path.join(jobs_dir, INDEX_FILE), timeout=10)
+        try:
+            with conn:
+                conn.executescript(INDEX_SCHEMA)
+                conn.execute("INSERT OR REPLACE INTO jobs (job_id, status, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                             (job_id, job['status'], job['created_at'], time.time()))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not register job {job_id} in the queue index: {str(e)}")
+
+
+class JobTimedOut(Exception):
+    """A kindlegen job ran over its deadline or was cancelled before it started."""
+
+
+def processor_seen_at(jobs_dir):
+    """When a processor last went through its loop (time.time()), or None if never."""
+    try:
+        return os.path.getmtime(os.path.join(jobs_dir, HEARTBEAT_FILE))
+    except OSError:
+        return None
+
+
+def give_up_at(job_dir, job, submitted_at, queue_timeout):
+    """
+    Time after which a build stops waiting for its job.
+
+    A queued job is not given up because of a long queue: only when no
+    processor has been seen for ``queue_timeout`` seconds (counted from the
+    submission at the earliest).
+
+    Args:
+        job_dir: Job directory
+        job: Current contents of job.json (or None)
+        submitted_at: When the job was submitted (time.time())
+        queue_timeout: Seconds to wait for a processor while the job is pending
+
+    Returns:
+        time.time() value; the deadline of a running job, plus DEADLINE_GRACE
+    """
+    if job is not None and job.get('deadline'):
+        return job['deadline'] + DEADLINE_GRACE
+    seen_at = processor_seen_at(os.path.dirname(os.path.normpath(job_dir)))
+    return max(submitted_at, seen_at or 0) + queue_timeout
+
+
+def cancel_job(job_dir, reason):
+    """
+    Mark a job nobody waits for anymore as timed out, unless it has been started.
+
+    The processor re-reads job.json after claiming a job, so a cancelled job
+    is not run.
+
+    Returns:
+        True if the job was cancelled
+    """
+    job = read_job(job_dir)
+    if job is None or job.get('status') != 'pending':
+        return False
+    job['status'] = 'timed_out'
+    job['error'] = reason
+    job['updated_at'] = time.time()
+    write_job(job_dir, job)
+    register_job(job_dir, job)
+    logger.info(f"Cancelled kindlegen job {job_dir}: {reason}")
+    return True
+
+
+def _finished(job):
+    return job is not None and job.get('status') in FINAL_STATUSES
+
+
+class InotifyWatch:
+    """
+    inotify watch for files written or renamed into a directory.
+
+    Uses libc through ctypes, so it needs no extra package; create it with
+    InotifyWatch.open(), which returns None where inotify is not available.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def open(cls, directory):
+        if not hasattr(select, 'poll') or not os.path.exists('/proc/sys/fs/inotify'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        watch = cls(fd)
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            logger.warning(f"inotify_add_watch failed for {directory}: {os.strerror(ctypes.get_errno())}")
+            watch.close()
+            return None
+        return watch
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for events and consume them.
+
+        Returns:
+            True if a file in the directory was written or renamed into it
+        """
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(max(0, int(timeout * 1000))):
+            return False
+        try:
+            return bool(os.read(self.fd, 64 * 1024))
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return False
+            raise
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _wait_redis(redis_url, job_id, timeout):
+    """
+    Block on the completion list of a job.
+
+    Returns:
+        True if the processor signalled completion, False on timeout, None
+        if Redis cannot be used
+    """
+    try:
+        import redis
+    except ImportError:
+        return None
+    try:
+        client = _redis_clients.get(redis_url)
+        if client is None:
+            # The socket must outlive the longest blocking call
+            client = redis.Redis.from_url(redis_url, socket_connect_timeout=2,
+                                          socket_timeout=REDIS_WAIT_SLICE + 5)
+            _redis_clients[redis_url] = client
+        # BLPOP takes whole seconds
+        result = client.blpop([completion_key(job_id)], timeout=max(1, math.ceil(timeout)))
+        return result is not None
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for kindlegen job notifications ({str(e)}), "
+                       f"watching the job directory instead")
+        return None
+
+
+def wait_for_job(job_dir, timeout, redis_url=None):
+    """
+    Wait until the processor has finished the job in ``job_dir``.
+
+    Args:
+        job_dir: Job directory (its name is the job id)
+        timeout: Maximum number of seconds to wait
+        redis_url: Redis the processor publishes completions to (optional)
+
+    Returns:
+        Final contents of job.json, or None if the job did not finish in time
+    """
+    deadline = time.monotonic() + timeout
+    job = read_job(job_dir)
+    if _finished(job):
+        return job
+
+    if redis_url:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            signalled = _wait_redis(redis_url, os.path.basename(job_dir), min(REDIS_WAIT_SLICE, remaining))
+            if signalled is None:
+                # Redis unavailable: watch the job directory instead
+                break
+            job = read_job(job_dir)
+            if _finished(job):
+                return job
+            if signalled:
+                logger.warning(f"Job {job_dir} signalled completion but job.json is not final yet")
+
+    watch = InotifyWatch.open(job_dir)
+    if watch is None:
+        logger.info(f"inotify not available, polling {job_dir} every {POLL_INTERVAL}s")
+    try:
+        while True:
+            # Read after the watch exists, so a write in between is not missed
+            job = read_job(job_dir)
+            if _finished(job):
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if watch is not None:
+                watch.wait(remaining)
+            else:
+                time.sleep(min(POLL_INTERVAL, remaining))
+    finally:
+        if watch is not None:
+            watch.close()
@@ -0,0 +1,31 @@
+# src/dictionary/management/commands/purge_parse_cache.py
+
+"""
+Remove artifacts from the parsed-entry cache (see dictionary/parse_cache.py).
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dictionary import parse_cache
+
+
+class Command(BaseCommand):
+    help = 'Remove cached parsed dictionary entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, metavar='DAYS',
+                            help='Only remove artifacts not used for this many days '
+                                 '(temporary files are always kept for an hour)')
+        parser.add_argument('--prune', action='store_true',
+                            help='Only apply the configured size and age limits '
+                                 '(PARSE_CACHE_MAX_BYTES, PARSE_CACHE_MAX_AGE_DAYS)')
+
+    def handle(self, *args, **options):
+        cache_dir = settings.PARSE_CACHE_DIR
+        if options['prune']:
+            removed = parse_cache.prune_cache(cache_dir, settings.PARSE_CACHE_MAX_BYTES,
+                                              settings.PARSE_CACHE_MAX_AGE_DAYS)
+        else:
+            removed = parse_cache.purge_cache(cache_dir, options['older_than'])
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} file(s) from {cache_dir}"))
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.15 on 2026-10-18 06:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0016_backfill_email_verified_for_existing_users'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dictionary',
+            name='build_report',
+            field=models.JSONField(blank=True, help_text='Source statistics from the last build: entries, skipped lines and examples of problems.', null=True, verbose_name='Build Report'),
+        ),
+    ]
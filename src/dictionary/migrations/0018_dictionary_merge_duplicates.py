@@ -0,0 +1,18 @@
+# Generated by Django 5.2.15 on 2026-10-18 06:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0017_dictionary_build_report'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dictionary',
+            name='merge_duplicates',
+            field=models.BooleanField(default=False, help_text='Merge entries with the same headword into one entry when building the dictionary.', verbose_name='Merge Duplicate Headwords'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.15 on 2026-10-18 07:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0018_dictionary_merge_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dictionary',
+            name='build_backend',
+            field=models.CharField(choices=[('kindlegen', 'kindlegen'), ('native', 'Native MOBI writer (experimental)')], default='kindlegen', help_text='Tool that builds the MOBI file: kindlegen under Wine or the built-in MOBI writer.', max_length=20, verbose_name='Build Backend'),
+        ),
+    ]
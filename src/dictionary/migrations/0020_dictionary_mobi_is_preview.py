@@ -0,0 +1,18 @@
+# Generated by Django 5.2.15 on 2026-10-18 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dictionary', '0019_dictionary_build_backend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dictionary',
+            name='mobi_is_preview',
+            field=models.BooleanField(default=False, help_text='The MOBI file is the uncompressed preview; the compressed final build replaces it when ready.', verbose_name='Preview MOBI'),
+        ),
+    ]
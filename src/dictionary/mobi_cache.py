@@ -0,0 +1,108 @@
+# src/dictionary/mobi_cache.py
+
+"""
+Content-addressed cache of MOBI files produced by kindlegen.
+
+A MOBI file depends only on what kindlegen reads - the OPF, the HTML parts,
+the stylesheet and the cover - and on the kindlegen version. A build whose
+inputs hash to a key already in the cache (admin mass rebuilds, updates
+that do not change the content) takes the MOBI file from the cache instead
+of submitting a kindlegen job, so Wine is not started at all.
+
+The ``<dc:Date>`` of the OPF is left out of the key, as it changes on every
+build; a reused MOBI file carries the date of the build that produced it.
+
+Cached files are named ``<sha256 of inputs>-v<CACHE_VERSION>.mobi``, are
+hard-linked in and out of the cache like covers (see cover_cache) and are
+evicted like parse cache artifacts (see parse_cache.prune_cache).
+"""
+
+import os
+import re
+import hashlib
+import logging
+
+from .fileutils import link_or_copy
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the key stops describing the MOBI file completely
+CACHE_VERSION = 1
+
+SUFFIX = '.mobi'
+
+# Files kindlegen reads (see process_dictionary_content); json is app metadata
+INPUT_KEYS = ('opf', 'css', 'jpg')
+
+OPF_DATE_PATTERN = re.compile(rb'<dc:Date>.*?</dc:Date>')
+
+
+def _input_files(file_paths):
+    keys = [key for key in file_paths if key in INPUT_KEYS or key == 'html' or key.startswith('html_')]
+    return sorted((key, file_paths[key]) for key in keys)
+
+
+def input_digest(file_paths, kindlegen_version):
+    """
+    Hash of everything kindlegen reads for a build.
+
+    Args:
+        file_paths: Files generated by process_dictionary_content
+        kindlegen_version: Version of the kindlegen used by the processor
+
+    Returns:
+        Hex SHA-256 digest
+    """
+    digest = hashlib.sha256(f"kindlegen {kindlegen_version}\0".encode('utf-8'))
+    for key, path in _input_files(file_paths):
+        digest.update(f"{key} {os.path.basename(path)}\0".encode('utf-8'))
+        if key == 'opf':
+            with open(path, 'rb') as f:
+                data = OPF_DATE_PATTERN.sub(b'', f.read())
+            digest.update(len(data).to_bytes(8, 'little'))
+            digest.update(data)
+            continue
+        digest.update(os.path.getsize(path).to_bytes(8, 'little'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, digest):
+    """Path of the cached MOBI file for an input digest."""
+    return os.path.join(cache_dir, f"{digest}-v{CACHE_VERSION}{SUFFIX}")
+
+
+def get_mobi(cache_dir, digest, output_path):
+    """
+    Place the cached MOBI file for ``digest`` at ``output_path``.
+
+    Returns:
+        True on a cache hit, False if kindlegen has to run
+    """
+    path = cache_path(cache_dir, digest)
+    if not os.path.exists(path):
+        return False
+    try:
+        os.utime(path)
+        link_or_copy(path, output_path)
+        return True
+    except OSError as e:
+        # Evicted in the meantime
+        logger.warning(f"Could not reuse cached MOBI file {path}: {str(e)}")
+        return False
+
+
+def put_mobi(cache_dir, digest, mobi_path):
+    """Add a MOBI file produced by kindlegen to the cache."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, digest)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        link_or_copy(mobi_path, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not cache MOBI file {mobi_path}: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,423 @@
+# src/dictionary/mobi_writer.py
+
+"""
+Native MOBI dictionary writer, an alternative to running kindlegen under Wine.
+
+The parsed entries are written straight into a MOBI 6 book with an
+orthographic (headword) index, the structure the Kindle looks words up in:
+
+    record 0        PalmDOC + MOBI headers, EXTH metadata, full title
+    text records    uncompressed MobiML text in 4096-byte records
+    orth index      primary INDX record followed by the INDX data records
+    cover           the JPEG cover (optional)
+    FLIS, FCIS, EOF
+
+Each index entry maps a label (a headword or one of its inflected forms,
+normalised by normalize_label) to the byte range of its entry in the text.
+Inflections are stored as additional labels pointing at the same entry
+instead of kindlegen's compressed inflection index, so lookups of inflected
+forms work the same way while the index is larger than kindlegen's.
+
+Like kindlegen, the index stores its labels through an ORDT character table
+rather than as UTF-8: each character is written as its position in the
+table, and the table lists the characters in collation order, so the order
+the Kindle binary-searches in is alphabetical ('ą' between 'a' and 'b', not
+after 'z').
+"""
+
+import os
+import re
+import time
+import struct
+import unicodedata
+import tempfile
+import logging
+
+from .dictionary_creator import PARAGRAPH_BREAK_PATTERN
+
+logger = logging.getLogger(__name__)
+
+RECORD_SIZE = 4096
+TEXT_ENCODING = 65001  # utf-8
+NULL_INDEX = 0xFFFFFFFF
+
+MOBI_HEADER_LENGTH = 0xE8
+INDX_HEADER_LENGTH = 192
+
+# Data records of the index stay below this size, so the 16-bit entry
+# offsets in their IDXT tables never overflow
+INDEX_RECORD_MAX_BYTES = 0xF000
+
+# Labels are stored with a one-byte length
+MAX_LABEL_BYTES = 255
+
+# Labels use one byte per character while the ORDT table has at most this
+# many characters, two bytes per character otherwise
+ORDT_ONE_BYTE_CHARACTERS = 256
+
+# Letters without a Unicode decomposition sort by the letter in their name,
+# e.g. 'ł' (LATIN SMALL LETTER L WITH STROKE) right after 'l'
+LETTER_WITH_PATTERN = re.compile(r'LATIN SMALL LETTER (\w) WITH ')
+
+# Index tags: 1 = start of the entry in the text, 2 = its length
+TAGX = (b'TAGX' + struct.pack('>II', 12 + 4 * 3, 1)
+        + bytes((1, 1, 1, 0)) + bytes((2, 1, 2, 0)) + bytes((0, 0, 0, 1)))
+
+# Windows locale identifiers used by the MOBI header for the dictionary languages
+LANGUAGE_IDS = {
+    'cs': 0x05, 'da': 0x06, 'de': 0x07, 'el': 0x08, 'en': 0x09, 'es': 0x0A, 'fi': 0x0B,
+    'fr': 0x0C, 'hu': 0x0E, 'it': 0x10, 'ja': 0x11, 'ko': 0x12, 'nl': 0x13, 'no': 0x14,
+    'pl': 0x15, 'pt': 0x16, 'ro': 0x18, 'ru': 0x19, 'hr': 0x1A, 'sk': 0x1B, 'sv': 0x1D,
+    'tr': 0x1F, 'uk': 0x22, 'lt': 0x27, 'lv': 0x26, 'et': 0x25, 'zh': 0x04,
+}
+
+FLIS = (b'FLIS\0\0\0\x08\0\x41\0\0\0\0\0\0\xff\xff\xff\xff\0\x01\0\x03\0\0\0\x03\0\0\0\x01'
+        + b'\xff' * 4)
+EOF = b'\xe9\x8e\r\n'
+
+_TEXT_HEADER = '<html><head><guide></guide></head><body>'
+_TEXT_FOOTER = '<mbp:pagebreak/></body></html>'
+
+
+def language_id(language_code):
+    """MOBI locale identifier of an ISO 639-1 language code (0 if unknown)."""
+    return LANGUAGE_IDS.get((language_code or '').split('-')[0].lower(), 0)
+
+
+def encode_varlen(value):
+    """Encode an index tag value as 7-bit groups, the last one marked with 0x80."""
+    data = bytearray((value & 0x7F | 0x80,))
+    value >>= 7
+    while value:
+        data.insert(0, value & 0x7F)
+        value >>= 7
+    return bytes(data)
+
+
+def normalize_label(text):
+    """Index label of a headword or inflected form: NFC, without surrounding spaces, lowercased."""
+    return unicodedata.normalize('NFC', text).strip().lower()
+
+
+def collation_key(char):
+    """Sort key of a label character: its base letter first, then the character itself."""
+    base = unicodedata.normalize('NFD', char)[0]
+    if base == char:
+        match = LETTER_WITH_PATTERN.match(unicodedata.name(char, ''))
+        if match:
+            base = match.group(1).lower()
+    return base, char
+
+
+class LabelTable:
+    """
+    ORDT character table of the index labels.
+
+    ``characters`` lists every character used in a label in collation order;
+    a label is encoded as the positions of its characters, one byte each if
+    there are at most ORDT_ONE_BYTE_CHARACTERS characters, two bytes
+    (big-endian) otherwise. Comparing encoded labels byte by byte therefore
+    compares them in collation order.
+    """
+
+    def __init__(self, labels):
+        self.characters = sorted(set(''.join(labels)), key=collation_key)
+        self.codes = {char: code for code, char in enumerate(self.characters)}
+        self.width = 1 if len(self.characters) <= ORDT_ONE_BYTE_CHARACTERS else 2
+
+    def encode(self, label):
+        """Encoded label, cut to MAX_LABEL_BYTES at a character boundary."""
+        label = label[:MAX_LABEL_BYTES // self.width]
+        if self.width == 1:
+            return bytes(self.codes[char] for char in label)
+        return b''.join(struct.pack('>H', self.codes[char]) for char in label)
+
+    def records(self):
+        """
+        The ORDT1 and ORDT2 sections of the primary index record: the low
+        byte of every code and the UTF-16 code unit of every character.
+        """
+        ordt1 = b'ORDT' + bytes(code & 0xFF for code in range(len(self.characters)))
+        ordt2 = b'ORDT' + b''.join(struct.pack('>H', ord(char)) for char in self.characters)
+        return _pad(ordt1), _pad(ordt2)
+
+
+def _pad(data, alignment=4):
+    return data + b'\0' * (-len(data) % alignment)
+
+
+class TextWriter:
+    """
+    Writes the book text to a temporary file and collects index entries.
+
+    ``index`` holds ``(label, start, length)`` tuples, where ``start`` and
+    ``length`` are byte offsets of an entry in the uncompressed text.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+        self.index = []
+        self._write(_TEXT_HEADER)
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self.f.write(data)
+        self.position += len(data)
+
+    def write_entry(self, entry):
+        start = self.position
+        description = PARAGRAPH_BREAK_PATTERN.sub('</p><p>', entry.description)
+        self._write(f'<h2>{entry.term}</h2><p>{description}</p>')
+        for child in entry.children:
+            self.write_entry(child)
+        length = self.position - start
+
+        labels = dict.fromkeys(normalize_label(label) for label in (entry.term, *entry.inflections))
+        for label in labels:
+            if label:
+                self.index.append((label, start, length))
+
+    def close(self):
+        self._write(_TEXT_FOOTER)
+        return self.position
+
+
+def _index_entry(label, start, length):
+    return bytes((len(label),)) + label + b'\x03' + encode_varlen(start) + encode_varlen(length)
+
+
+def _indx_record(entries, record_type, index_records=0, total=0, tagx=b'', label_table=None):
+    """An INDX record: header, optional TAGX, entries, their IDXT table and the optional ORDT tables."""
+    offsets = []
+    position = INDX_HEADER_LENGTH + len(tagx)
+    for entry in entries:
+        offsets.append(position)
+        position += len(entry)
+    body = _pad(tagx + b''.join(entries))
+    idxt_offset = INDX_HEADER_LENGTH + len(body)
+    idxt = _pad(b'IDXT' + b''.join(struct.pack('>H', offset) for offset in offsets))
+
+    header = bytearray(INDX_HEADER_LENGTH)
+    header[0:4] = b'INDX'
+    struct.pack_into('>IIII', header, 4, INDX_HEADER_LENGTH, 0, record_type, 0)
+    if record_type == 0:
+        # Primary record: number of data records, encoding, language, number of entries
+        struct.pack_into('>IIIII', header, 20, idxt_offset, index_records, TEXT_ENCODING, NULL_INDEX, total)
+        struct.pack_into('>I', header, 180, INDX_HEADER_LENGTH)
+    else:
+        struct.pack_into('>II', header, 20, idxt_offset, len(offsets))
+        header[28:36] = b'\xff' * 8
+    record = bytes(header) + body + idxt
+    if label_table is not None:
+        # ORDT type (1 = one byte per label character), table size and offsets
+        ordt1, ordt2 = label_table.records()
+        struct.pack_into('>IIII', header, 0xA4, 1 if label_table.width == 1 else 0,
+                         len(label_table.characters), len(record), len(record) + len(ordt1))
+        record = bytes(header) + body + idxt + ordt1 + ordt2
+    if len(record) > 0x10000:
+        raise ValueError("Index record too large")
+    return record
+
+
+def build_orth_index(index):
+    """
+    Build the records of the orthographic index.
+
+    Labels are encoded through a LabelTable, entries are sorted by their
+    encoded labels (the order the Kindle binary-searches in) and split into
+    data records; the primary record lists the last label and the entry count
+    of every data record and carries the ORDT tables.
+
+    Labels with characters outside the Basic Multilingual Plane, which the
+    ORDT table cannot hold, are left out of the index.
+
+    Returns:
+        List of record bytes, the primary record first
+    """
+    labels = [label for label, _start, _length in index]
+    skipped = [label for label in labels if any(ord(char) > 0xFFFF for char in label)]
+    if skipped:
+        logger.warning(f"Leaving {len(skipped)} labels with characters outside the BMP out of the index, "
+                       f"e.g. {skipped[0]!r}")
+        skipped = set(skipped)
+        index = [item for item in index if item[0] not in skipped]
+        labels = [label for label in labels if label not in skipped]
+    label_table = LabelTable(labels)
+    index = sorted((label_table.encode(label), start, length) for label, start, length in index)
+
+    data_records = []
+    geometry = []
+    entries = []
+    size = INDX_HEADER_LENGTH + 8
+    last_label = b''
+    for label, start, length in index:
+        entry = _index_entry(label, start, length)
+        if entries and size + len(entry) + 2 > INDEX_RECORD_MAX_BYTES:
+            data_records.append(_indx_record(entries, 1))
+            geometry.append(bytes((len(last_label),)) + last_label + struct.pack('>H', len(entries)))
+            entries = []
+            size = INDX_HEADER_LENGTH + 8
+        entries.append(entry)
+        size += len(entry) + 2
+        last_label = label
+    if entries:
+        data_records.append(_indx_record(entries, 1))
+        geometry.append(bytes((len(last_label),)) + last_label + struct.pack('>H', len(entries)))
+
+    primary = _indx_record(geometry, 0, len(data_records), len(index), TAGX, label_table)
+    return [primary] + data_records
+
+
+def _exth(title, language_info, has_cover):
+    records = [
+        (100, language_info['creator_name']),
+        (503, title),
+        (524, language_info['language_code']),
+        (531, language_info['dictionary_in_language']),
+        (532, language_info['dictionary_out_language']),
+    ]
+    data = b''.join(struct.pack('>II', kind, 8 + len(value.encode('utf-8'))) + value.encode('utf-8')
+                    for kind, value in records)
+    count = len(records)
+    if has_cover:
+        # Cover and thumbnail: offset of the image from the first resource record
+        data += struct.pack('>III', 201, 12, 0) + struct.pack('>III', 202, 12, 0)
+        count += 2
+    return _pad(b'EXTH' + struct.pack('>II', 12 + len(data), count) + data)
+
+
+def _record0(title, language_info, text_length, text_records, first_nontext,
+             orth_index, first_resource, last_content, flis, fcis):
+    record = bytearray(16 + MOBI_HEADER_LENGTH)
+    # PalmDOC header: no compression, no encryption
+    struct.pack_into('>HHIHHHH', record, 0, 1, 0, text_length, text_records, RECORD_SIZE, 0, 0)
+
+    struct.pack_into('>4sIIII', record, 0x10, b'MOBI', MOBI_HEADER_LENGTH, 2, TEXT_ENCODING,
+                     int(time.time()) & 0xFFFFFFFF)
+    struct.pack_into('>II', record, 0x24, 6, orth_index)
+    record[0x2C:0x50] = b'\xff' * 36  # inflection, names, keys and extra indexes
+    language = language_id(language_info['language_code'])
+    struct.pack_into('>I', record, 0x50, first_nontext)
+    struct.pack_into('>IIII', record, 0x5C, language, language_id(language_info['dictionary_in_language']),
+                     language_id(language_info['dictionary_out_language']), 6)
+    struct.pack_into('>I', record, 0x6C, first_resource)
+    struct.pack_into('>I', record, 0x80, 0x50)  # EXTH present
+    struct.pack_into('>IIIII', record, 0xA4, NULL_INDEX, NULL_INDEX, 0, 0, 0)
+    struct.pack_into('>HHI', record, 0xC0, 1, last_content, 1)
+    struct.pack_into('>IIII', record, 0xC8, fcis, 1, flis, 1)
+    struct.pack_into('>II', record, 0xE0, NULL_INDEX, 0)
+    struct.pack_into('>II', record, 0xE8, NULL_INDEX, NULL_INDEX)
+    struct.pack_into('>HHI', record, 0xF0, 0, 1, NULL_INDEX)  # multibyte trailing entries, no NCX
+
+    full_name = title.encode('utf-8')
+    exth = _exth(title, language_info, first_resource != NULL_INDEX)
+    title_offset = len(record) + len(exth)
+    struct.pack_into('>II', record, 0x54, title_offset, len(full_name))
+    return _pad(bytes(record) + exth + full_name + b'\0\0')
+
+
+def _fcis(text_length):
+    return (b'FCIS\x00\x00\x00\x14\x00\x00\x00\x10\x00\x00\x00\x01\x00\x00\x00\x00'
+            + struct.pack('>I', text_length)
+            + b'\x00\x00\x00\x00\x00\x00\x00\x20\x00\x00\x00\x08\x00\x01\x00\x01\x00\x00\x00\x00')
+
+
+def _iter_text_records(f, text_length):
+    """
+    Yield the text in RECORD_SIZE records, each followed by its multibyte
+    trailing entry: the bytes of a character continued in the next record
+    and their count.
+    """
+    f.seek(0)
+    data = f.read(RECORD_SIZE)
+    while data:
+        following = f.read(RECORD_SIZE)
+        overlap = b''
+        for byte in following[:3]:
+            if byte & 0xC0 != 0x80:
+                break
+            overlap += bytes((byte,))
+        yield data + overlap + bytes((len(overlap),))
+        data = following
+
+
+def _palmdb_header(title, record_sizes):
+    name = title.encode('ascii', 'replace')[:31].replace(b' ', b'_')
+    now = int(time.time()) & 0xFFFFFFFF
+    count = len(record_sizes)
+    header = struct.pack('>32sHHIIIIII4s4sIIH', name, 0, 0, now, now, 0, 0, 0, 0,
+                         b'BOOK', b'MOBI', 2 * count - 1, 0, count)
+    offset = len(header) + 8 * count + 2
+    for number, size in enumerate(record_sizes):
+        header += struct.pack('>IB', offset, 0) + (2 * number).to_bytes(3, 'big')
+        offset += size
+    return header + b'\0\0'
+
+
+def write_mobi(entries, output_path, title, language_info, cover_path=None):
+    """
+    Write a MOBI dictionary with an orthographic index for the given entries.
+
+    Args:
+        entries: Iterable of top-level Entry objects (see iter_entries)
+        output_path: Path of the MOBI file to write
+        title: Title of the dictionary
+        language_info: Dictionary with language settings (as for generate_opf)
+        cover_path: Optional JPEG cover image
+
+    Returns:
+        Number of labels in the orthographic index
+    """
+    with tempfile.TemporaryFile() as text_file:
+        text = TextWriter(text_file)
+        for entry in entries:
+            text.write_entry(entry)
+        text_length = text.close()
+        if not text.index:
+            raise ValueError("The dictionary has no entries")
+
+        text_records = -(-text_length // RECORD_SIZE)
+        index_records = build_orth_index(text.index)
+        cover = None
+        if cover_path and os.path.exists(cover_path):
+            with open(cover_path, 'rb') as f:
+                cover = f.read()
+
+        first_nontext = text_records + 1
+        orth_index = first_nontext
+        first_resource = orth_index + len(index_records) if cover else NULL_INDEX
+        flis = orth_index + len(index_records) + (1 if cover else 0)
+        fcis = flis + 1
+        if fcis + 2 > 0xFFFF:
+            raise ValueError("The dictionary is too large for a MOBI file")
+
+        record0 = _record0(title, language_info, text_length, text_records, first_nontext,
+                           orth_index, first_resource, text_records, flis, fcis)
+        tail = index_records + ([cover] if cover else []) + [FLIS, _fcis(text_length), EOF]
+
+        # Sizes of the text records: the text plus the trailing entry of each
+        record_sizes = [len(record0)]
+        text_sizes = []
+        for record in _iter_text_records(text_file, text_length):
+            text_sizes.append(len(record))
+        record_sizes += text_sizes + [len(record) for record in tail]
+
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_palmdb_header(title, record_sizes))
+                f.write(record0)
+                for record in _iter_text_records(text_file, text_length):
+                    f.write(record)
+                for record in tail:
+                    f.write(record)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    logger.info(f"Wrote MOBI dictionary {output_path}: {text_length} bytes of text, "
+                f"{len(text.index)} index labels in {len(index_records) - 1} index records")
+    return len(text.index)
@@ -91,6 +91,22 @@ class Dictionary(models.Model):
         default=False,
         verbose_name=_("Public")
     )
+    merge_duplicates = models.BooleanField(
+        default=False,
+        verbose_name=_("Merge Duplicate Headwords"),
+        help_text=_("Merge entries with the same headword into one entry when building the dictionary.")
+    )
+    BUILD_BACKEND_CHOICES = (
+        ('kindlegen', _('kindlegen')),
+        ('native', _('Native MOBI writer (experimental)')),
+    )
+    build_backend = models.CharField(
+        max_length=20,
+        choices=BUILD_BACKEND_CHOICES,
+        default='kindlegen',
+        verbose_name=_("Build Backend"),
+        help_text=_("Tool that builds the MOBI file: kindlegen under Wine or the built-in MOBI writer.")
+    )
     
     # Files
     source_file = models.FileField(
@@ -133,6 +149,11 @@ class Dictionary(models.Model):
         blank=True,
         verbose_name=_("ZIP Package")
     )
+    mobi_is_preview = models.BooleanField(
+        default=False,
+        verbose_name=_("Preview MOBI"),
+        help_text=_("The MOBI file is the uncompressed preview; the compressed final build replaces it when ready.")
+    )
     
     # Status and dates
     STATUS_CHOICES = (
@@ -151,6 +172,12 @@ class Dictionary(models.Model):
         blank=True,
         verbose_name=_("Status Message")
     )
+    build_report = models.JSONField(
+        null=True,
+        blank=True,
+        verbose_name=_("Build Report"),
+        help_text=_("Source statistics from the last build: entries, skipped lines and examples of problems.")
+    )
     
     created_at = models.DateTimeField(
         default=timezone.now,
@@ -174,6 +201,11 @@ class Dictionary(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def html_parts(self):
+        """Number of HTML documents of the last build; only the first is in html_file, all are in the ZIP."""
+        return (self.build_report or {}).get('html_parts', 1)
+
 class SMTPConfiguration(models.Model):
     """Model to store SMTP configuration for email sending"""
     
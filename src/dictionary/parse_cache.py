@@ -0,0 +1,288 @@
+# src/dictionary/parse_cache.py
+
+"""
+Cache of parsed dictionary entries keyed by the source file content.
+
+Rebuilding a dictionary whose source did not change (admin rebuilds,
+metadata-only edits, retries after a kindlegen failure) loads the entries
+from a compact binary artifact instead of decoding and tokenizing the
+source again.
+
+Artifact layout::
+
+    b'KDPC' <u16 format version> <u16 marshal version>
+    block*  where block = <u32 byte length, little-endian> <marshal data>
+
+Each block holds a list of up to BLOCK_ENTRIES top-level entries as plain
+tuples, ``(term, inflections, description)`` for simple entries and
+``(term, inflections, description, members)`` for groups, so an artifact is
+decoded by marshal in C rather than field by field in Python. The last block
+holds the ParseReport of the source as a dict, so a build served from the
+cache still records its diagnostics.
+
+Artifacts are named ``<sha256 of source>-p<PARSER_VERSION>.entries``.
+Least recently used artifacts are evicted once the cache exceeds its size
+limit or an artifact has not been used for the configured number of days.
+"""
+
+import os
+import mmap
+import marshal
+import time
+import struct
+import hashlib
+import logging
+
+from .entries import Entry, EntryGroup
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever tokenize_line or iter_entries change the entries they produce,
+# so artifacts written by an older parser are never used.
+PARSER_VERSION = 1
+
+FORMAT_VERSION = 3
+MAGIC = b'KDPC'
+HEADER = MAGIC + struct.pack('<HH', FORMAT_VERSION, marshal.version)
+SUFFIX = '.entries'
+
+# Top-level entries per marshal block
+BLOCK_ENTRIES = 1000
+
+# Temporary files not written to for this many seconds belong to a writer
+# that died; younger ones may still be in use (see purge_cache)
+TMP_GRACE = 3600
+
+_U32 = struct.Struct('<I')
+
+
+class CacheError(ValueError):
+    """A parse cache artifact is damaged and cannot be read."""
+
+
+def source_digest(file_path, block_size=1024 * 1024):
+    """Return the hex SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, digest):
+    """Path of the artifact for a source digest and the current parser version."""
+    return os.path.join(cache_dir, f"{digest}-p{PARSER_VERSION}{SUFFIX}")
+
+
+def _entry_record(entry):
+    record = (entry.term, entry.inflections, entry.description)
+    if isinstance(entry, EntryGroup):
+        record += ([_entry_record(child) for child in entry.children],)
+    return record
+
+
+def _record_entry(record):
+    if len(record) == 4:
+        term, inflections, description, members = record
+        return EntryGroup(term, inflections, description, [_record_entry(member) for member in members])
+    return Entry(*record)
+
+
+def encode_entries(entries):
+    """Serialize a list of top-level entries (with their members) as one block."""
+    data = marshal.dumps([_entry_record(entry) for entry in entries])
+    return _U32.pack(len(data)) + data
+
+
+def encode_report(report):
+    """Serialize a ParseReport as the final block of an artifact."""
+    data = marshal.dumps(report.as_dict())
+    return _U32.pack(len(data)) + data
+
+
+def iter_cached_entries(path, report=None):
+    """
+    Lazily yield the top-level entries stored in an artifact, one block at a time.
+
+    If ``report`` is given, it is loaded from the report block once all
+    entries have been yielded.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(HEADER)) != HEADER:
+            raise CacheError(f"Not a parse cache artifact: {path}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = len(HEADER)
+            size = len(data)
+            while offset < size:
+                end = offset + _U32.size
+                if end > size:
+                    raise CacheError("Truncated parse cache artifact")
+                end += _U32.unpack_from(data, offset)[0]
+                if end > size:
+                    raise CacheError("Truncated parse cache artifact")
+                try:
+                    records = marshal.loads(data[offset + _U32.size:end])
+                except (EOFError, TypeError, ValueError) as e:
+                    raise CacheError(f"Corrupted parse cache artifact: {str(e)}")
+                offset = end
+                if isinstance(records, dict):
+                    if report is not None:
+                        report.load(records)
+                    continue
+                for record in records:
+                    try:
+                        entry = _record_entry(record)
+                    except (TypeError, ValueError) as e:
+                        raise CacheError(f"Corrupted parse cache artifact: {str(e)}")
+                    yield entry
+
+
+def load_entries(path, report=None):
+    """
+    Return an iterator over a cached artifact, or None on a cache miss.
+
+    ``report`` is filled from the artifact (see iter_cached_entries).
+
+    A hit refreshes the artifact's modification time, which is what the
+    LRU eviction in prune_cache goes by.
+    """
+    try:
+        with open(path, 'rb') as f:
+            valid = f.read(len(HEADER)) == HEADER
+    except FileNotFoundError:
+        return None
+    if not valid:
+        logger.warning(f"Ignoring invalid parse cache artifact: {path}")
+        return None
+    os.utime(path)
+    return iter_cached_entries(path, report)
+
+
+class CacheWriter:
+    """
+    Writes an artifact to a temporary file and publishes it atomically.
+
+    Use as a context manager: the artifact is renamed into place only if the
+    block finishes without an exception, otherwise the temporary file is
+    removed and readers never see a partial artifact.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(HEADER)
+        return self
+
+    def write(self, data):
+        self.file.write(data)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+        return False
+
+
+def store_entries(entries, path, report=None):
+    """
+    Yield ``entries`` unchanged while writing them to a new artifact at ``path``.
+
+    ``report`` is the ParseReport being filled while ``entries`` is
+    consumed; it is stored after the last entry.
+    """
+    with CacheWriter(path) as writer:
+        block = []
+        for entry in entries:
+            block.append(entry)
+            if len(block) == BLOCK_ENTRIES:
+                writer.write(encode_entries(block))
+                block = []
+            yield entry
+        if block:
+            writer.write(encode_entries(block))
+        if report is not None:
+            writer.write(encode_report(report))
+
+
+def prune_cache(cache_dir, max_bytes, max_age_days, suffix=SUFFIX):
+    """
+    Evict artifacts: first those unused for more than ``max_age_days``, then
+    the least recently used ones until the cache fits in ``max_bytes``.
+
+    Only files ending with ``suffix`` are considered, so the same eviction
+    serves other caches keyed the same way (see cover_cache).
+
+    Returns:
+        Number of removed artifacts
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    artifacts = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(suffix):
+            stat = entry.stat()
+            artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+    artifacts.sort()
+
+    removed = 0
+    total = sum(size for _mtime, size, _path in artifacts)
+    cutoff = time.time() - max_age_days * 86400 if max_age_days else None
+    for mtime, size, path in artifacts:
+        if (cutoff is None or mtime >= cutoff) and (not max_bytes or total <= max_bytes):
+            break
+        try:
+            os.remove(path)
+            removed += 1
+            total -= size
+        except OSError as e:
+            logger.warning(f"Could not remove cache artifact {path}: {str(e)}")
+    return removed
+
+
+def purge_cache(cache_dir, older_than_days=None):
+    """
+    Remove artifacts (and leftover temporary files) from the cache.
+
+    Temporary files are only removed once they have not been written to for
+    TMP_GRACE seconds, so an artifact being written is not cut short.
+
+    Args:
+        cache_dir: Cache directory
+        older_than_days: Only remove artifacts unused for this many days
+
+    Returns:
+        Number of removed files
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    now = time.time()
+    cutoff = now - older_than_days * 86400 if older_than_days is not None else None
+    removed = 0
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file():
+            continue
+        if entry.name.endswith('.tmp'):
+            if entry.stat().st_mtime >= min(now - TMP_GRACE, cutoff or now):
+                continue
+        elif not entry.name.endswith(SUFFIX):
+            continue
+        elif cutoff is not None and entry.stat().st_mtime >= cutoff:
+            continue
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except OSError as e:
+            logger.warning(f"Could not remove parse cache file {entry.path}: {str(e)}")
+    return removed
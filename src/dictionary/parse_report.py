@@ -0,0 +1,101 @@
+# src/dictionary/parse_report.py
+
+"""
+Statistics about the lines of a dictionary source.
+
+iter_entries fills a ParseReport while parsing, so the same parser that
+builds the dictionary can also check a source without rendering anything
+(see dictionary_creator.validate_lines). A build logs the report once and
+stores it in Dictionary.build_report instead of logging every line.
+"""
+
+# Problem lines kept (per kind) as examples
+MAX_SAMPLES = 20
+
+# Characters of a problem line kept in a sample
+SAMPLE_TEXT_LENGTH = 200
+
+# Merged headwords listed in a report (see merge_duplicate_entries)
+MAX_MERGED_TERMS = 100
+
+# Counters filled by the parser (and stored in parse cache artifacts)
+COUNTERS = ('lines', 'blank', 'entries', 'groups', 'members', 'invalid', 'orphans')
+
+
+class ParseReport:
+    """Counters and sample problem lines for one parsed source."""
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.lines = 0
+        self.blank = 0
+        self.entries = 0  # simple top-level entries
+        self.groups = 0  # ``~`` entries
+        self.members = 0  # ``+`` entries attached to a group
+        self.invalid = 0
+        self.orphans = 0  # ``+`` lines before any group
+        self.invalid_samples = []  # (line number, text)
+        self.orphan_samples = []
+        self.duplicates = 0  # entries merged into an earlier entry with the same headword
+        self.merged_terms = []
+
+    @property
+    def total_entries(self):
+        return self.entries + self.groups + self.members
+
+    @property
+    def problems(self):
+        return self.invalid + self.orphans
+
+    def is_acceptable(self, max_problems=0):
+        """True if the source has entries and at most ``max_problems`` skipped lines."""
+        return self.total_entries > 0 and self.problems <= max_problems
+
+    def add_invalid(self, line_number, line):
+        self.invalid += 1
+        if len(self.invalid_samples) < self.max_samples:
+            self.invalid_samples.append((line_number, line[:SAMPLE_TEXT_LENGTH]))
+
+    def add_orphan(self, line_number, line):
+        self.orphans += 1
+        if len(self.orphan_samples) < self.max_samples:
+            self.orphan_samples.append((line_number, line[:SAMPLE_TEXT_LENGTH]))
+
+    def add_merged_term(self, term, count):
+        """Record that ``count`` later entries were merged into the entry for ``term``."""
+        self.duplicates += count
+        if len(self.merged_terms) < MAX_MERGED_TERMS:
+            self.merged_terms.append(term)
+
+    def merge(self, other):
+        """Add the counters and samples of a report for a later part of the same source."""
+        for name in COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        room = self.max_samples - len(self.invalid_samples)
+        self.invalid_samples.extend(other.invalid_samples[:max(room, 0)])
+        room = self.max_samples - len(self.orphan_samples)
+        self.orphan_samples.extend(other.orphan_samples[:max(room, 0)])
+
+    def load(self, data):
+        """Replace the contents of the report with a dict from as_dict."""
+        for name in COUNTERS:
+            setattr(self, name, data[name])
+        self.invalid_samples = [(sample['line'], sample['text']) for sample in data['invalid_samples']]
+        self.orphan_samples = [(sample['line'], sample['text']) for sample in data['orphan_samples']]
+
+    def as_dict(self):
+        """JSON-serializable form of the report."""
+        return {
+            'lines': self.lines,
+            'blank': self.blank,
+            'entries': self.entries,
+            'groups': self.groups,
+            'members': self.members,
+            'total_entries': self.total_entries,
+            'invalid': self.invalid,
+            'orphans': self.orphans,
+            'invalid_samples': [{'line': number, 'text': text} for number, text in self.invalid_samples],
+            'orphan_samples': [{'line': number, 'text': text} for number, text in self.orphan_samples],
+            'duplicates': self.duplicates,
+            'merged_terms': self.merged_terms,
+        }
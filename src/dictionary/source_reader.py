@@ -0,0 +1,147 @@
+# src/dictionary/source_reader.py
+
+"""
+Reading of uploaded dictionary source files.
+
+Sources are memory-mapped and decoded incrementally, so only one chunk of
+decoded text exists at a time. The encoding is detected from a bounded
+prefix of the file: UTF-8 (with or without BOM), UTF-16, and the two
+single-byte encodings Polish text is usually saved in, cp1250 and
+ISO-8859-2.
+"""
+
+import os
+import mmap
+import codecs
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bytes inspected by detect_encoding
+SAMPLE_SIZE = 64 * 1024
+
+# Bytes decoded at a time by iter_source_lines
+CHUNK_SIZE = 1024 * 1024
+
+# Polish letters stored at different code points in the two single-byte
+# encodings (ą Ą ś Ś ź Ź). All other Polish letters share their code point.
+_CP1250_LETTERS = frozenset(b'\xb9\xa5\x9c\x8c\x9f\x8f')
+_ISO_8859_2_LETTERS = frozenset(b'\xb1\xa1\xb6\xa6\xbc\xac')
+
+
+def _guess_single_byte_encoding(sample):
+    """Choose between cp1250 and ISO-8859-2 for a sample that is not UTF-8."""
+    # 0x80-0x9F are C1 control characters in ISO-8859-2 and never occur in
+    # text saved in it, while cp1250 uses them for printable characters.
+    if any(0x80 <= byte <= 0x9f for byte in sample):
+        return 'cp1250'
+    cp1250_hits = sum(1 for byte in sample if byte in _CP1250_LETTERS)
+    iso_hits = sum(1 for byte in sample if byte in _ISO_8859_2_LETTERS)
+    return 'iso-8859-2' if iso_hits > cp1250_hits else 'cp1250'
+
+
+def detect_encoding(sample, complete=False):
+    """
+    Detect the encoding of a source file from its first bytes.
+
+    Args:
+        sample: Prefix of the file (see SAMPLE_SIZE)
+        complete: True if ``sample`` is the whole file, so a multi-byte
+            sequence cut at its end is an error rather than a truncation
+
+    Returns:
+        Python codec name
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+
+    # UTF-16 without a BOM: text in Latin scripts has a NUL in every other byte
+    if sample.count(0) > len(sample) // 4:
+        return 'utf-16-le' if sample[1::2].count(0) > sample[0::2].count(0) else 'utf-16-be'
+
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=complete)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return _guess_single_byte_encoding(sample)
+
+
+def iter_buffer_lines(data, encoding=None, name='<buffer>'):
+    """
+    Lazily yield the decoded lines of a source held in a bytes-like buffer.
+
+    Only ``\\r\\n`` and ``\\n`` end a line; a bare ``\\r`` stays inside the line,
+    where it acts as a paragraph separator. Like ``str.split('\\n')``, a source
+    ending with a line break yields a trailing empty line.
+
+    Args:
+        data: Encoded source (bytes or an mmap)
+        encoding: Codec to use; detected with detect_encoding if None
+        name: Source name used in log messages
+    """
+    size = len(data)
+    if size == 0:
+        yield ''
+        return
+
+    if encoding is None:
+        encoding = detect_encoding(data[:SAMPLE_SIZE], complete=size <= SAMPLE_SIZE)
+    logger.info(f"Reading source file {name} as {encoding}")
+
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    replaced = False
+    tail = ''
+    for offset in range(0, size, CHUNK_SIZE):
+        text = decoder.decode(data[offset:offset + CHUNK_SIZE], final=offset + CHUNK_SIZE >= size)
+        if not replaced and '\ufffd' in text:
+            replaced = True
+            logger.warning(f"Source file {name} contains bytes that are not valid {encoding}; "
+                           f"they were replaced with U+FFFD")
+        lines = (tail + text).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            if line.endswith('\r'):
+                line = line[:-1]
+            yield line
+    yield tail
+
+
+def iter_source_lines(file_path, encoding=None):
+    """
+    Lazily yield the decoded lines of a dictionary source file.
+
+    The file is memory-mapped; see iter_buffer_lines for the line semantics.
+
+    Args:
+        file_path: Path to the source file
+        encoding: Codec to use; detected with detect_encoding if None
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield ''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from iter_buffer_lines(data, encoding, file_path)
+
+
+def iter_uploaded_lines(uploaded_file, encoding=None):
+    """
+    Lazily yield the decoded lines of a Django UploadedFile.
+
+    Large uploads are read from their temporary file; uploads kept in memory
+    are rewound afterwards so they can still be saved.
+    """
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        yield from iter_source_lines(uploaded_file.temporary_file_path(), encoding)
+        return
+    uploaded_file.seek(0)
+    data = uploaded_file.read()
+    uploaded_file.seek(0)
+    yield from iter_buffer_lines(data, encoding, uploaded_file.name)
+
+
+def read_source_text(file_path, encoding=None):
+    """Return the whole decoded source file with ``\\r\\n`` normalized to ``\\n``."""
+    return '\n'.join(iter_source_lines(file_path, encoding))
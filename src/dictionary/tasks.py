@@ -5,26 +5,82 @@ Celery tasks for the Dictionary app.
 """
 
 import os
+import json
+import time
+import shutil
 import logging
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+from .kindlegen_jobs import PRIORITY_INTERACTIVE, PRIORITY_BULK
+
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+# Description of a build waiting for kindlegen, stored in its build directory
+BUILD_FILE = 'build.json'
+
+# How long finish_dictionary_build keeps a build to itself
+FINISH_LOCK_TIMEOUT = 3600
+
+# kindlegen compression level of the preview MOBI file (-c0: none)
+PREVIEW_COMPRESSION = 0
+
+def _complete_build(dictionary, build_started_at=None):
+    """
+    Mark a dictionary as built and notify its creator.
+
+    Records the time from the start of the build until its files could be
+    downloaded as ``time_to_first_download`` in the build report.
+    """
+    dictionary.status = 'completed'
+    dictionary.built_at = timezone.now()
+    if build_started_at and dictionary.build_report is not None:
+        dictionary.build_report['time_to_first_download'] = round(time.time() - build_started_at, 3)
+    dictionary.save(update_fields=['status', 'built_at', 'build_report', 'updated_at'])
+
+    # Send email notification
+    send_completion_notification.delay(str(dictionary.id))
+
+def _finish_key(build_dir):
+    return f"dictionary-build-finish:{os.path.basename(build_dir)}"
+
 @shared_task
-def process_dictionary(dictionary_id):
+def process_dictionary(dictionary_id, priority=PRIORITY_INTERACTIVE):
     """
     Process a dictionary to generate all necessary files.
+
+    ``priority`` orders the kindlegen job in the external processor's queue:
+    builds a user waits for are interactive, admin mass rebuilds are bulk
+    (see kindlegen_jobs.PRIORITIES).
+
+    With the kindlegen backend the build is split into stages: this task
+    generates the source files in a kindlegen job directory, submits the job,
+    then returns and leaves the worker free. finish_dictionary_build packages
+    the result once the external processor is done; it is sent by the
+    processor itself (--celery-broker-url) and scheduled here as a deferred
+    retry in case the callback never arrives.
+
+    With DICTIONARY_PREVIEW_BUILD interactive builds run kindlegen twice: an
+    uncompressed (-c0) preview job, published as soon as it is done, and a
+    bulk-priority job for the compressed MOBI file, which finish_final_build
+    publishes in place of the preview.
     """
     # Import here to avoid circular imports
     from .models import Dictionary
-    from .dictionary_creator import create_dictionary_files
+    from .dictionary_creator import (create_dictionary_files, create_build_dir, prepare_dictionary_build,
+                                     submit_kindlegen_job, mark_build_failed, kindlegen_cache_key,
+                                     cached_kindlegen_mobi, package_dictionary_build, create_final_build)
     
     logger.info(f"Starting to process dictionary: {dictionary_id}")
     
+    build_started_at = time.time()
+    build_dir = None
+    final_dir = None
     try:
         # Get the dictionary object
         dictionary = Dictionary.objects.get(pk=dictionary_id)
@@ -32,30 +88,93 @@ def process_dictionary(dictionary_id):
         # Update status to processing
         dictionary.status = 'processing'
         dictionary.save(update_fields=['status', 'updated_at'])
-        
-        # Process the dictionary
-        success = create_dictionary_files(dictionary)
-        
-        if success:
-            # Update dictionary status to completed
-            dictionary.status = 'completed'
-            dictionary.built_at = timezone.now()
-            dictionary.save(update_fields=['status', 'built_at', 'updated_at'])
-            
-            # Send email notification
-            send_completion_notification.delay(str(dictionary.id))
-            
+
+        if dictionary.build_backend == 'native' or not settings.DICTIONARY_ASYNC_KINDLEGEN:
+            # Everything runs in this task
+            success = create_dictionary_files(dictionary, priority=priority)
+            if success:
+                _complete_build(dictionary, build_started_at)
+                logger.info(f"Successfully processed dictionary: {dictionary_id}")
+                return True
+            else:
+                logger.error(f"Failed to process dictionary: {dictionary_id}")
+                return False
+
+        # Stage 1: source files, written straight into the kindlegen job directory
+        build_dir = create_build_dir(dictionary)
+        try:
+            build = prepare_dictionary_build(dictionary, build_dir)
+        except Exception as e:
+            mark_build_failed(dictionary, e)
+            shutil.rmtree(build_dir, ignore_errors=True)
+            return False
+
+        # Identical inputs were converted before: no kindlegen job at all
+        cache_key = kindlegen_cache_key(build)
+        mobi_path = cached_kindlegen_mobi(dictionary, build, cache_key)
+        if mobi_path:
+            try:
+                package_dictionary_build(dictionary, build, mobi_path)
+            except Exception as e:
+                mark_build_failed(dictionary, e)
+                return False
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+            _complete_build(dictionary, build_started_at)
             logger.info(f"Successfully processed dictionary: {dictionary_id}")
             return True
-        else:
-            logger.error(f"Failed to process dictionary: {dictionary_id}")
-            return False
+        dictionary.save(update_fields=['build_report', 'updated_at'])
+
+        # Stage 2: hand the job to the external processor; the build directory
+        # is the job directory, and build.json must exist before the callback
+        preview = settings.DICTIONARY_PREVIEW_BUILD and priority == PRIORITY_INTERACTIVE
+        build['job_dir'] = build_dir
+        build['build_started_at'] = build_started_at
+        build['submitted_at'] = time.time()
+        build['preview'] = preview
+        # Only compressed MOBI files go to the kindlegen cache
+        build['cache_key'] = None if preview else cache_key
+        if preview:
+            # The final build gets its own copy: the preview's files are moved
+            # into storage when it is published
+            final = create_final_build(dictionary, build)
+            final_dir = final['work_dir']
+            final.update(job_dir=final_dir, cache_key=cache_key, preview=False,
+                         preview_build=os.path.basename(build_dir))
+            build['final_build'] = os.path.basename(final_dir)
+            # Written before the preview is submitted: finish_dictionary_build
+            # publishes the preview as final if this file is missing
+            final['submitted_at'] = time.time()
+            with open(os.path.join(final_dir, BUILD_FILE), 'w', encoding='utf-8') as f:
+                json.dump(final, f, ensure_ascii=False, indent=4)
+        with open(os.path.join(build_dir, BUILD_FILE), 'w', encoding='utf-8') as f:
+            json.dump(build, f, ensure_ascii=False, indent=4)
+        callback = {'task': finish_dictionary_build.name, 'args': [str(dictionary_id), build_dir]}
+        submit_kindlegen_job(build['file_paths']['opf'], callback=callback, priority=priority,
+                             compression=PREVIEW_COMPRESSION if preview else None)
+
+        # Stage 3 runs in finish_dictionary_build
+        finish_dictionary_build.apply_async((str(dictionary_id), build_dir),
+                                            countdown=settings.KINDLEGEN_RETRY_DELAY)
+        logger.info(f"Submitted kindlegen job for dictionary {dictionary_id}: {build['job_dir']}")
+
+        if preview:
+            # Submitted after the preview, so an idle processor starts with the preview
+            callback = {'task': finish_final_build.name, 'args': [str(dictionary_id), final_dir]}
+            submit_kindlegen_job(final['file_paths']['opf'], callback=callback, priority=PRIORITY_BULK)
+            finish_final_build.apply_async((str(dictionary_id), final_dir),
+                                           countdown=settings.KINDLEGEN_RETRY_DELAY)
+            logger.info(f"Submitted final kindlegen job for dictionary {dictionary_id}: {final_dir}")
+        return True
         
     except Dictionary.DoesNotExist:
         logger.error(f"Dictionary not found: {dictionary_id}")
         return False
     except Exception as e:
         logger.error(f"Error processing dictionary {dictionary_id}: {str(e)}")
+        for directory in (build_dir, final_dir):
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
         
         # Try to update the dictionary status to failed
         try:
@@ -68,6 +187,165 @@ def process_dictionary(dictionary_id):
             
         return False
 
+def _read_build(build_dir):
+    """Build description written by process_dictionary, or None if the build is finished."""
+    try:
+        with open(os.path.join(build_dir, BUILD_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.info(f"Build {build_dir} already finished")
+        return None
+
+def _finished_job(task, build, pending_timeout=None):
+    """
+    Final job.json of a build's kindlegen job; retries ``task`` while it is not finished.
+
+    A pending job is waited for as long as a processor is alive and
+    cancelled once none has been seen for KINDLEGEN_JOB_TIMEOUT seconds; a
+    running one is waited for until the deadline the processor set for it
+    (a job over it ends "timed_out").
+
+    Args:
+        pending_timeout: Instead, wait for a pending job this many seconds
+            after its submission, whether a processor is alive or not
+
+    Returns:
+        job.json contents, or None if the build stopped waiting for the job
+    """
+    from .kindlegen_jobs import read_job, give_up_at, cancel_job, FINAL_STATUSES
+
+    job = read_job(build['job_dir'])
+    if job is None or job.get('status') not in FINAL_STATUSES:
+        if pending_timeout is not None and not (job or {}).get('deadline'):
+            until = build['submitted_at'] + pending_timeout
+        else:
+            until = give_up_at(build['job_dir'], job, build['submitted_at'], settings.KINDLEGEN_JOB_TIMEOUT)
+        if time.time() < until:
+            raise task.retry(countdown=settings.KINDLEGEN_RETRY_DELAY)
+        waited = time.time() - build['submitted_at']
+        logger.error(f"Timed out waiting for job completion after {int(waited)}s: {build['job_dir']}")
+        # A processor picking it up now would run it for nobody
+        cancel_job(build['job_dir'], f"Build stopped waiting for the job after {int(waited)}s")
+        job = None
+    return job
+
+def _final_build_pending(build_dir, build):
+    """True if the final job of a preview build is still waiting to be published."""
+    final_build = build.get('final_build')
+    return bool(final_build) and os.path.exists(os.path.join(os.path.dirname(build_dir), final_build, BUILD_FILE))
+
+@shared_task(bind=True, max_retries=None)
+def finish_dictionary_build(self, dictionary_id, build_dir):
+    """
+    Last build stage: collect the MOBI file from the kindlegen job and save all files.
+
+    Sent by the kindlegen processor when the job is finished, and scheduled
+    by process_dictionary as a fallback that re-schedules itself every
+    KINDLEGEN_RETRY_DELAY seconds until the job is finished (see
+    _finished_job). Whichever run comes first does the work; the others
+    return without doing anything. If kindlegen failed the build is packaged
+    with the source files only; a job that timed out or was given up fails
+    the build. A preview MOBI file is published marked as such and replaced
+    later by finish_final_build, unless its final build has been given up.
+    """
+    # Import here to avoid circular imports
+    from .models import Dictionary
+    from .dictionary_creator import (collect_kindlegen_job, cache_kindlegen_mobi, record_kindlegen_job,
+                                     package_dictionary_build, mark_build_failed)
+
+    build = _read_build(build_dir)
+    if build is None:
+        return False
+    job = _finished_job(self, build)
+
+    # Only one run may package the build
+    if not cache.add(_finish_key(build_dir), self.request.id or True, timeout=FINISH_LOCK_TIMEOUT):
+        logger.info(f"Build {build_dir} is already being finished")
+        return False
+
+    try:
+        dictionary = Dictionary.objects.get(pk=dictionary_id)
+        if job is None or job.get('status') == 'timed_out':
+            if job is not None:
+                record_kindlegen_job(dictionary, job)
+            mark_build_failed(dictionary, (job or {}).get('error') or "No kindlegen processor finished the job")
+            return False
+        mobi_path = os.path.join(build_dir, job.get('output_file') or f"{build['base_filename']}.mobi")
+        mobi_path = collect_kindlegen_job(build['job_dir'], job, mobi_path)
+        cache_kindlegen_mobi(build.get('cache_key'), mobi_path)
+        record_kindlegen_job(dictionary, job)
+        preview = build.get('preview', False) and _final_build_pending(build_dir, build)
+        if preview and dictionary.build_report is not None:
+            # finish_final_build publishes only over the preview of this build
+            dictionary.build_report['preview_build'] = os.path.basename(build_dir)
+        try:
+            package_dictionary_build(dictionary, build, mobi_path, preview=preview)
+        except Exception as e:
+            mark_build_failed(dictionary, e)
+            return False
+        _complete_build(dictionary, build.get('build_started_at'))
+        logger.info(f"Successfully processed dictionary: {dictionary_id}")
+        return True
+    except Dictionary.DoesNotExist:
+        logger.error(f"Dictionary not found: {dictionary_id}")
+        return False
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+@shared_task(bind=True, max_retries=None)
+def finish_final_build(self, dictionary_id, job_dir):
+    """
+    Publish the compressed MOBI file of a two-phase build in place of its preview.
+
+    Sent and scheduled like finish_dictionary_build, for the final kindlegen
+    job of a build with a preview (see process_dictionary). Waits until the
+    preview has been published. The bulk-priority final job may wait behind
+    a whole rebuild, so it is not cancelled for a long queue: it is given up
+    only DICTIONARY_FINAL_BUILD_TIMEOUT seconds after its submission (or
+    when it runs over its deadline). If the final pass fails or is given
+    up, the preview stays as the dictionary's MOBI file (abandon_final_build).
+    """
+    # Import here to avoid circular imports
+    from .models import Dictionary
+    from .kindlegen_jobs import cancel_job
+    from .dictionary_creator import (collect_kindlegen_job, cache_kindlegen_mobi, record_kindlegen_job,
+                                     publish_final_mobi, abandon_final_build)
+
+    build = _read_build(job_dir)
+    if build is None:
+        return False
+    preview_dir = os.path.join(os.path.dirname(job_dir), build['preview_build'])
+    if os.path.exists(os.path.join(preview_dir, BUILD_FILE)):
+        # The preview is not published yet
+        if time.time() < build['submitted_at'] + settings.DICTIONARY_FINAL_BUILD_TIMEOUT:
+            raise self.retry(countdown=settings.KINDLEGEN_RETRY_DELAY)
+        # Without this build directory the preview is published as the final file
+        logger.error(f"Preview of {job_dir} was not published in time, giving up the final build")
+        cancel_job(job_dir, "Preview build was not published in time")
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return False
+    job = _finished_job(self, build, pending_timeout=settings.DICTIONARY_FINAL_BUILD_TIMEOUT)
+
+    if not cache.add(_finish_key(job_dir), self.request.id or True, timeout=FINISH_LOCK_TIMEOUT):
+        logger.info(f"Build {job_dir} is already being finished")
+        return False
+
+    try:
+        dictionary = Dictionary.objects.get(pk=dictionary_id)
+        if job is None:
+            abandon_final_build(dictionary, build, "Final kindlegen job was not started in time")
+            return False
+        mobi_path = os.path.join(job_dir, job.get('output_file') or f"{build['base_filename']}.mobi")
+        mobi_path = collect_kindlegen_job(job_dir, job, mobi_path)
+        cache_kindlegen_mobi(build.get('cache_key'), mobi_path)
+        record_kindlegen_job(dictionary, job, key='kindlegen_final_job')
+        return publish_final_mobi(dictionary, build, mobi_path)
+    except Dictionary.DoesNotExist:
+        logger.error(f"Dictionary not found: {dictionary_id}")
+        return False
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
 @shared_task
 def send_completion_notification(dictionary_id):
     """
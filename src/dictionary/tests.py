@@ -1,5 +1,388 @@
 # src\dictionary\tests.py
 
-from django.test import TestCase
+import os
+import sys
+import json
+import time
+import tempfile
+import importlib.util
+import unittest
+from concurrent.futures import Future
+from unittest import mock
 
-# Create your tests here.
+from celery.exceptions import Retry
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from .entries import Entry, EntryGroup
+from .models import Dictionary
+from . import mobi_writer
+from . import kindlegen_jobs
+from . import tasks
+
+SCRIPTS_DIR = os.path.join(settings.BASE_DIR.parent, 'scripts')
+
+
+def load_script(name):
+    """Import one of the host scripts from scripts/ as a module."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS_DIR, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def requires_script(name):
+    return unittest.skipUnless(os.path.exists(os.path.join(SCRIPTS_DIR, f'{name}.py')),
+                               "scripts/ is not part of this installation")
+
+
+# Stand-in for kindlegen, run as "python stub.py book.opf [-cN] -o out.mobi":
+# writes the compression option (or "final") to the output file, or with
+# HANG in the OPF file name starts a child process and never finishes
+STUB_KINDLEGEN = """
+import os, sys, time, subprocess
+if 'HANG' in sys.argv[1]:
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    with open('child.pid', 'w') as f:
+        f.write(str(child.pid))
+    time.sleep(60)
+compression = [arg for arg in sys.argv if arg.startswith('-c')]
+with open(sys.argv[sys.argv.index('-o') + 1], 'wb') as f:
+    f.write(b'BOOKMOBI' + (compression[0] if compression else 'final').encode())
+"""
+
+
+def process_alive(pid):
+    """True if ``pid`` is a running (not zombie) process."""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+LANGUAGE_INFO = {
+    'creator_name': 'Test',
+    'language_code': 'pl',
+    'dictionary_in_language': 'pl',
+    'dictionary_out_language': 'pl',
+}
+
+
+@requires_script('compare_mobi_indexes')
+class MobiWriterTests(SimpleTestCase):
+    """Round trip of a small dictionary through the native writer and the MOBI index reader."""
+
+    def setUp(self):
+        self.reader = load_script('compare_mobi_indexes')
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def write(self, entries):
+        path = os.path.join(self.tmp_dir.name, 'test.mobi')
+        mobi_writer.write_mobi(entries, path, 'Test', LANGUAGE_INFO)
+        return self.reader.MobiBook(path)
+
+    def test_labels_are_normalised(self):
+        book = self.write([
+            Entry('Żółw', ['Żółwia', 'żółwiem '], 'turtle'),
+            # 'ą' decomposed into 'a' and a combining ogonek
+            Entry('Ła\u0328ka', ['ŁĄKI'], 'meadow'),
+        ])
+        labels = {label for label, _start, _length in book.orth_entries()}
+        self.assertEqual(labels, {'żółw', 'żółwia', 'żółwiem', 'łąka', 'łąki'})
+
+    def test_labels_are_in_collation_order(self):
+        words = ['zebra', 'źródło', 'żaba', 'łąka', 'lato', 'ąb', 'ab', 'b', 'ćma', 'cel', 'a b']
+        book = self.write([Entry(word, [], word) for word in words])
+        labels = [label for label, _start, _length in book.orth_entries()]
+        self.assertEqual(labels, ['a b', 'ab', 'ąb', 'b', 'cel', 'ćma', 'lato', 'łąka', 'zebra', 'źródło', 'żaba'])
+
+    def test_inflections_lead_to_their_entry(self):
+        entries = [Entry(f'słowo{number}', [f'Słowa{number}', f'słowem{number}'], f'opis {number}')
+                   for number in range(2000)]
+        entries.append(EntryGroup('Dom', ['domu'], 'house', [Entry('domek', ['Domku'], 'small house')]))
+        book = self.write(entries)
+
+        self.assertGreater(self.reader._indx_header(book.record(book.orth_index))['count'], 1)
+        headwords = self.reader.index_headwords(book)
+        self.assertEqual(headwords['słowa1234'], ['słowo1234'])
+        self.assertEqual(headwords['słowem7'], ['słowo7'])
+        self.assertEqual(headwords['domu'], ['Dom'])
+        self.assertEqual(headwords['domku'], ['domek'])
+        self.assertEqual(len(headwords), 3 * 2000 + 4)
+
+
+class FakeExecutor:
+    """Records the jobs a JobScheduler submits without running them."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, function, job_path, *args):
+        self.submitted.append(os.path.basename(job_path))
+        return Future()
+
+
+@requires_script('process_kindlegen_jobs')
+class KindlegenProcessorTests(SimpleTestCase):
+    """Leases, scheduling and timeouts of scripts/process_kindlegen_jobs.py."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.processor = load_script('process_kindlegen_jobs')
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.jobs_dir = tmp_dir.name
+        self.stub = os.path.join(self.jobs_dir, 'kindlegen_stub.py')
+        with open(self.stub, 'w') as f:
+            f.write(STUB_KINDLEGEN)
+
+    def make_job(self, name, **fields):
+        job_path = os.path.join(self.jobs_dir, name)
+        os.makedirs(job_path)
+        job_data = {'status': 'pending', 'opf_file': f'{name}.opf', 'output_file': f'{name}.mobi',
+                    'created_at': time.time(), **fields}
+        with open(os.path.join(job_path, 'job.json'), 'w') as f:
+            json.dump(job_data, f)
+        with open(os.path.join(job_path, job_data['opf_file']), 'w') as f:
+            f.write('<package/>')
+        return job_path, job_data
+
+    def read_job(self, job_path):
+        with open(os.path.join(job_path, 'job.json')) as f:
+            return json.load(f)
+
+    def write_lock(self, job_path, owner, age=0):
+        lock_path = os.path.join(job_path, self.processor.LOCK_FILE)
+        with open(lock_path, 'w') as f:
+            json.dump({'owner': owner}, f)
+        os.utime(lock_path, (time.time() - age, time.time() - age))
+
+    def test_live_lease_is_respected(self):
+        job_path, _job_data = self.make_job('live')
+        self.write_lock(job_path, 'other', age=self.processor.lease_timeout / 2)
+        self.assertIsNone(self.processor.JobLease.acquire(job_path))
+        self.assertIsNone(self.processor.process_job(job_path, self.read_job(job_path), self.stub, sys.executable))
+
+    def test_stale_lease_is_taken_over(self):
+        job_path, _job_data = self.make_job('stale', status='processing', started_at=time.time())
+        self.write_lock(job_path, 'other', age=self.processor.lease_timeout + 10)
+        self.assertTrue(self.processor.lease_expired(job_path))
+
+        self.assertTrue(self.processor.process_job(job_path, self.read_job(job_path), self.stub, sys.executable))
+        job_data = self.read_job(job_path)
+        self.assertEqual(job_data['status'], 'completed')
+        self.assertEqual(job_data['processor'], self.processor.PROCESSOR_ID)
+        self.assertFalse(os.path.exists(os.path.join(job_path, self.processor.LOCK_FILE)))
+        self.assertEqual([name for name in os.listdir(job_path) if name.endswith('.stale')], [])
+
+    def test_lost_lease_is_noticed_and_left_alone(self):
+        job_path, _job_data = self.make_job('lost')
+        with mock.patch.object(self.processor, 'lease_timeout', 0.2):
+            lease = self.processor.JobLease.acquire(job_path)
+            self.assertTrue(lease.owned())
+            self.write_lock(job_path, 'other')
+            for _ in range(50):
+                if lease.lost:
+                    break
+                time.sleep(0.05)
+            lease.release()
+        self.assertTrue(lease.lost)
+        # The new owner's lock stays
+        with open(os.path.join(job_path, self.processor.LOCK_FILE)) as f:
+            self.assertEqual(json.load(f)['owner'], 'other')
+
+    def test_dispatch_order(self):
+        now = time.time()
+        self.make_job('bulk-small', priority='bulk', input_size=10, created_at=now - 100)
+        self.make_job('interactive-large', priority='interactive', input_size=5000, created_at=now - 50)
+        self.make_job('interactive-small-new', priority='interactive', input_size=100, created_at=now)
+        self.make_job('interactive-small-old', priority='interactive', input_size=100, created_at=now - 10)
+        self.make_job('no-priority', input_size=1000, created_at=now)
+        self.make_job('done', status='completed', input_size=1)
+
+        executor = FakeExecutor()
+        scheduler = self.processor.JobScheduler(executor, 2, self.jobs_dir, self.stub, sys.executable)
+        with mock.patch.object(self.processor, 'job_index', None):
+            self.assertEqual(scheduler.dispatch(), 2)
+            self.assertEqual(executor.submitted, ['interactive-small-old', 'interactive-small-new'])
+            # Both workers are busy
+            self.assertEqual(scheduler.dispatch(), 0)
+            scheduler.capacity = 5
+            scheduler.dispatch()
+        self.assertEqual(executor.submitted, ['interactive-small-old', 'interactive-small-new',
+                                              'no-priority', 'interactive-large', 'bulk-small'])
+        self.assertTrue(os.path.exists(os.path.join(self.jobs_dir, self.processor.HEARTBEAT_FILE)))
+
+    def test_compression_is_passed_to_kindlegen(self):
+        job_path, job_data = self.make_job('preview', compression=0)
+        self.assertTrue(self.processor.run_job(job_path, job_data, self.stub, sys.executable, 10))
+        with open(os.path.join(job_path, 'preview.mobi'), 'rb') as f:
+            self.assertEqual(f.read(), b'BOOKMOBI-c0')
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "needs /proc")
+    def test_timeout_kills_the_process_group(self):
+        job_path, job_data = self.make_job('HANG')
+        started = time.monotonic()
+        self.assertFalse(self.processor.run_job(job_path, job_data, self.stub, sys.executable, 1))
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertEqual(self.read_job(job_path)['status'], 'timed_out')
+
+        with open(os.path.join(job_path, 'child.pid')) as f:
+            child = int(f.read())
+        for _ in range(50):
+            if not process_alive(child):
+                break
+            time.sleep(0.1)
+        self.assertFalse(process_alive(child))
+
+
+@requires_script('process_kindlegen_jobs')
+class TwoPhaseBuildTests(TestCase):
+    """Preview and final kindlegen jobs of a build, run by the processor with a stub kindlegen."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.processor = load_script('process_kindlegen_jobs')
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        media_root = tmp_dir.name
+        overrides = override_settings(
+            MEDIA_ROOT=media_root,
+            DICTIONARY_BUILD_DIR=os.path.join(media_root, 'dictionary_builds'),
+            PARSE_CACHE_DIR=os.path.join(media_root, 'parse_cache'),
+            COVER_CACHE_DIR=os.path.join(media_root, 'cover_cache'),
+            KINDLEGEN_CACHE_DIR=os.path.join(media_root, 'kindlegen_cache'),
+            KINDLEGEN_CACHE_ENABLED=False,
+            DICTIONARY_ASYNC_KINDLEGEN=True,
+            DICTIONARY_PREVIEW_BUILD=True,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.jobs_dir = os.path.join(media_root, 'kindlegen_jobs')
+        self.stub = os.path.join(media_root, 'kindlegen_stub.py')
+        with open(self.stub, 'w') as f:
+            f.write(STUB_KINDLEGEN)
+
+        # Tasks the build schedules and the callbacks the processor sends
+        self.scheduled = []
+        self.callbacks = []
+        for task in (tasks.finish_dictionary_build, tasks.finish_final_build):
+            patcher = mock.patch.object(task, 'apply_async',
+                                        lambda *args, name=task.name, **kwargs: self.scheduled.append(name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks.send_completion_notification, 'delay')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        celery_app = mock.Mock()
+        celery_app.send_task.side_effect = lambda name, args: self.callbacks.append((name.rsplit('.', 1)[1], args))
+        for name, value in (('celery_app', celery_app), ('redis_client', None), ('job_index', None)):
+            patcher = mock.patch.object(self.processor, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.dictionary = Dictionary(name='Test', language_code='pl', creator_name='Test')
+        self.dictionary.source_file.save(
+            'source.txt', ContentFile(''.join(f'słowo{i} | opis {i}\n' for i in range(20)).encode()), save=False)
+        self.dictionary.save()
+
+    def build(self):
+        """Start a build; returns the preview and final callbacks the processor will send."""
+        self.assertTrue(tasks.process_dictionary(str(self.dictionary.id)))
+        self.assertEqual(self.scheduled, ['dictionary.tasks.finish_dictionary_build',
+                                          'dictionary.tasks.finish_final_build'])
+        self.scheduled.clear()
+        jobs = {}
+        for name in os.listdir(self.jobs_dir):
+            job = kindlegen_jobs.read_job(os.path.join(self.jobs_dir, name))
+            if job:
+                jobs[job['callback']['task'].rsplit('.', 1)[1]] = job['callback']['args']
+        return jobs['finish_dictionary_build'], jobs['finish_final_build']
+
+    def run_jobs(self):
+        """Run all pending kindlegen jobs with the stub; returns the callbacks sent for them."""
+        executor = mock.Mock()
+        executor.submit.side_effect = lambda function, *args: self._done(function(*args))
+        self.processor.JobScheduler(executor, 1, self.jobs_dir, self.stub, sys.executable).run_pending()
+        callbacks, self.callbacks = self.callbacks, []
+        return callbacks
+
+    @staticmethod
+    def _done(result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def run_task(self, name, args):
+        try:
+            return getattr(tasks, name)(*args)
+        except Retry:
+            return 'retry'
+
+    def mobi(self):
+        self.dictionary.refresh_from_db()
+        with open(self.dictionary.mobi_file.path, 'rb') as f:
+            return self.dictionary.mobi_is_preview, f.read()
+
+    def test_final_build_finished_before_the_preview_is_published(self):
+        preview_args, final_args = self.build()
+        # Interactive preview first, then the bulk final job
+        self.assertEqual([name for name, _args in self.run_jobs()], ['finish_dictionary_build', 'finish_final_build'])
+
+        self.assertEqual(self.run_task('finish_final_build', final_args), 'retry')
+        self.assertTrue(self.run_task('finish_dictionary_build', preview_args))
+        self.assertEqual(self.mobi(), (True, b'BOOKMOBI-c0'))
+        self.assertTrue(self.run_task('finish_final_build', final_args))
+        self.assertEqual(self.mobi(), (False, b'BOOKMOBIfinal'))
+        self.assertEqual(self.dictionary.status, 'completed')
+
+    def test_final_build_finished_after_the_preview_is_published(self):
+        preview_args, final_args = self.build()
+        processor_run = self.processor.process_job
+        # Only the preview job runs now
+        final_dir = final_args[1]
+        with mock.patch.object(self.processor, 'process_job',
+                               lambda job_path, *args: None if job_path == final_dir else processor_run(job_path, *args)):
+            self.run_jobs()
+        self.assertTrue(self.run_task('finish_dictionary_build', preview_args))
+        self.assertEqual(self.mobi(), (True, b'BOOKMOBI-c0'))
+
+        self.assertEqual(self.run_task('finish_final_build', final_args), 'retry')
+        self.assertEqual(self.run_jobs(), [('finish_final_build', final_args)])
+        self.assertTrue(self.run_task('finish_final_build', final_args))
+        self.assertEqual(self.mobi(), (False, b'BOOKMOBIfinal'))
+
+    def test_final_build_of_an_older_build_is_discarded(self):
+        preview_args, final_args = self.build()
+        self.run_jobs()
+        self.assertTrue(self.run_task('finish_dictionary_build', preview_args))
+        # The dictionary is rebuilt before the final file of the first build is published
+        self.build()
+        self.assertFalse(self.run_task('finish_final_build', final_args))
+        self.assertEqual(self.mobi(), (True, b'BOOKMOBI-c0'))
+
+    def test_build_is_finished_once(self):
+        preview_args, _final_args = self.build()
+        self.run_jobs()
+        build_dir = preview_args[1]
+        cache.add(tasks._finish_key(build_dir), 'other-run')
+        self.assertFalse(self.run_task('finish_dictionary_build', preview_args))
+        self.assertTrue(os.path.exists(build_dir))
+        self.dictionary.refresh_from_db()
+        self.assertEqual(self.dictionary.status, 'processing')
+
+        cache.delete(tasks._finish_key(build_dir))
+        self.assertTrue(self.run_task('finish_dictionary_build', preview_args))
+        self.assertFalse(os.path.exists(build_dir))
+        self.assertFalse(self.run_task('finish_dictionary_build', preview_args))
@@ -13,6 +13,7 @@ urlpatterns = [
     # Dictionary views
     path('', views.DictionaryListView.as_view(), name='list'),
     path('search/', views.search_dictionaries, name='search'),
+    path('validate/', views.validate_dictionary_source, name='validate'),
     path('create/', views.DictionaryCreateView.as_view(), name='create'),
     path('<uuid:pk>/', views.DictionaryDetailView.as_view(), name='detail'),
     path('<uuid:pk>/update/', views.DictionaryUpdateView.as_view(), name='update'),
@@ -13,6 +13,7 @@ from django.views.generic import ListView, DetailView, CreateView, UpdateView, V
 from django.views.generic.edit import UpdateView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.decorators import user_passes_test, login_required
+from django.views.decorators.http import require_POST
 from django.http import HttpResponseForbidden
 from django.contrib import messages
 from django.http import FileResponse, Http404, JsonResponse, HttpResponse
@@ -30,6 +31,8 @@ from .forms import (
     UserSettingsForm, UserApprovalForm, UserRejectionForm
 )
 from .tasks import process_dictionary
+from .dictionary_creator import validate_lines
+from .source_reader import iter_uploaded_lines
 import difflib
 from .email_utils import (
     send_test_email, send_contact_message_notification, send_task_notification,
@@ -762,6 +765,9 @@ def dictionary_download(request, pk, file_type):
         file_field = dictionary.source_file
         filename = f"{dictionary.name}.txt"
     elif file_type == 'html':
+        if dictionary.html_parts > 1:
+            # html_file holds the first part only; the ZIP package has them all
+            return redirect('dictionary:download', pk=dictionary.pk, file_type='zip')
         file_field = dictionary.html_file
         filename = f"{dictionary.name}.html"
     elif file_type == 'opf':
@@ -1197,6 +1203,35 @@ def search_dictionaries(request):
     
     return JsonResponse({'dictionaries': result})
 
+@login_required
+@require_POST
+def validate_dictionary_source(request):
+    """API endpoint to check a dictionary source without building it
+
+    Accepts the same ``content`` / ``source_file`` fields as the dictionary
+    forms and returns line statistics with examples of invalid and orphaned
+    lines (see ParseReport). Sources over MAX_UPLOAD_SIZE are rejected.
+    """
+    source_file = request.FILES.get('source_file')
+    content = request.POST.get('content', '')
+    size = source_file.size if source_file else len(content.encode('utf-8'))
+    if size > settings.MAX_UPLOAD_SIZE:
+        return JsonResponse({'success': False,
+                             'error': f'Source is larger than {settings.MAX_UPLOAD_SIZE} bytes'}, status=413)
+    if source_file:
+        lines = iter_uploaded_lines(source_file)
+    elif content:
+        lines = content.split('\n')
+    else:
+        return JsonResponse({'success': False, 'error': 'Either content or source_file is required'}, status=400)
+
+    report = validate_lines(lines)
+    return JsonResponse({
+        'success': True,
+        'valid': report.is_acceptable(settings.DICTIONARY_SOURCE_MAX_PROBLEMS),
+        'report': report.as_dict(),
+    })
+
 @login_required
 def toggle_dictionary_public(request, pk):
     """View to toggle dictionary public status"""
@@ -123,3 +123,75 @@ CELERY_TIMEZONE = TIME_ZONE
 
 # File upload settings
 MAX_UPLOAD_SIZE = 5242880  # 5MB
+
+# Dictionary builds: sources of at least this many bytes are parsed and
+# rendered in a process pool (0 disables it). Workers default to the CPU count.
+DICTIONARY_PARALLEL_MIN_SIZE = env.int('DICTIONARY_PARALLEL_MIN_SIZE', default=2 * 1024 * 1024)
+DICTIONARY_PARALLEL_WORKERS = env.int('DICTIONARY_PARALLEL_WORKERS', default=0)
+DICTIONARY_PARALLEL_CHUNK_LINES = env.int('DICTIONARY_PARALLEL_CHUNK_LINES', default=20000)
+
+# The generated HTML is split into several documents of at most this many bytes
+# (0 = a single document); kindlegen handles them faster than one huge file.
+DICTIONARY_HTML_PART_MAX_BYTES = env.int('DICTIONARY_HTML_PART_MAX_BYTES', default=10 * 1024 * 1024)
+
+# Sources of at least this many bytes are rendered as compact HTML: no
+# indentation and no repeated inflections, a third or more smaller for kindlegen
+# to read and in the ZIP package (0 keeps the indented layout for every build).
+DICTIONARY_COMPACT_HTML_MIN_SIZE = env.int('DICTIONARY_COMPACT_HTML_MIN_SIZE', default=1024 * 1024)
+
+# External kindlegen processor (scripts/process_kindlegen_jobs.py): builds wait
+# for a queued job while a processor is alive and cancel it once none has been
+# seen for this many seconds; a running job is waited for until the deadline
+# the processor set from the size of its input (its --job-timeout options). The processor signals finished jobs
+# via this Redis (its --redis-url); empty = watch the job directory with inotify.
+KINDLEGEN_JOB_TIMEOUT = env.int('KINDLEGEN_JOB_TIMEOUT', default=600)
+KINDLEGEN_REDIS_URL = env('KINDLEGEN_REDIS_URL', default=f"redis://{env('REDIS_HOST', default='redis')}:{env('REDIS_PORT', default='6379')}/2")
+
+# Builds with the kindlegen backend run as a task chain: the build task
+# submits the job and returns, and finish_dictionary_build packages the result
+# when the processor sends it (its --celery-broker-url) or, as a fallback,
+# every KINDLEGEN_RETRY_DELAY seconds until the job is done. False = block the
+# worker until kindlegen is done.
+DICTIONARY_ASYNC_KINDLEGEN = env.bool('DICTIONARY_ASYNC_KINDLEGEN', default=True)
+KINDLEGEN_RETRY_DELAY = env.int('KINDLEGEN_RETRY_DELAY', default=5)
+
+# Two-phase kindlegen builds (with DICTIONARY_ASYNC_KINDLEGEN): interactive
+# builds first publish an uncompressed (-c0) MOBI file, which is much quicker
+# to produce, and a bulk-priority job replaces it with the compressed one.
+# A final job not started within DICTIONARY_FINAL_BUILD_TIMEOUT seconds of its
+# submission is given up and the preview stays as the dictionary's MOBI file.
+DICTIONARY_PREVIEW_BUILD = env.bool('DICTIONARY_PREVIEW_BUILD', default=True)
+DICTIONARY_FINAL_BUILD_TIMEOUT = env.int('DICTIONARY_FINAL_BUILD_TIMEOUT', default=6 * 3600)
+
+# Kindlegen builds are written straight into their job directory, native builds
+# into this one; both are on the media filesystem so that the artifacts are
+# moved into FileField storage by rename instead of being copied.
+DICTIONARY_BUILD_DIR = os.path.join(MEDIA_ROOT, 'dictionary_builds')
+
+# Uploaded sources are checked before a build is queued: forms reject them if
+# they have no valid entries or more invalid/orphaned lines than this.
+DICTIONARY_SOURCE_MAX_PROBLEMS = env.int('DICTIONARY_SOURCE_MAX_PROBLEMS', default=0)
+
+# Parsed-entry cache keyed by the source content hash (dictionary/parse_cache.py).
+# Least recently used artifacts are evicted above the size limit or after the
+# given number of days without use; `manage.py purge_parse_cache` empties it.
+PARSE_CACHE_ENABLED = env.bool('PARSE_CACHE_ENABLED', default=True)
+PARSE_CACHE_DIR = os.path.join(MEDIA_ROOT, 'parse_cache')
+PARSE_CACHE_MAX_BYTES = env.int('PARSE_CACHE_MAX_BYTES', default=512 * 1024 * 1024)
+PARSE_CACHE_MAX_AGE_DAYS = env.int('PARSE_CACHE_MAX_AGE_DAYS', default=30)
+
+# Rendered cover images keyed by the dictionary title (dictionary/cover_cache.py),
+# evicted the same way as parse cache artifacts.
+COVER_CACHE_ENABLED = env.bool('COVER_CACHE_ENABLED', default=True)
+COVER_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cover_cache')
+COVER_CACHE_MAX_BYTES = env.int('COVER_CACHE_MAX_BYTES', default=64 * 1024 * 1024)
+COVER_CACHE_MAX_AGE_DAYS = env.int('COVER_CACHE_MAX_AGE_DAYS', default=90)
+
+# MOBI files produced by kindlegen, keyed by a hash of its inputs and of
+# KINDLEGEN_VERSION (dictionary/mobi_cache.py); update KINDLEGEN_VERSION when
+# the processor switches to another kindlegen. Evicted like parse cache artifacts.
+KINDLEGEN_CACHE_ENABLED = env.bool('KINDLEGEN_CACHE_ENABLED', default=True)
+KINDLEGEN_CACHE_DIR = os.path.join(MEDIA_ROOT, 'kindlegen_cache')
+KINDLEGEN_CACHE_MAX_BYTES = env.int('KINDLEGEN_CACHE_MAX_BYTES', default=1024 * 1024 * 1024)
+KINDLEGEN_CACHE_MAX_AGE_DAYS = env.int('KINDLEGEN_CACHE_MAX_AGE_DAYS', default=30)
+KINDLEGEN_VERSION = env('KINDLEGEN_VERSION', default='2.9')
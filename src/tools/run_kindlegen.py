@@ -1,10 +1,27 @@
 #!/usr/bin/env python3
 # kindle_dict\src\tools\run_kindlegen.py
 
+"""
+Run kindlegen once by hand, e.g. to check a generated OPF file.
+
+The application does not use this script: its builds go through the
+external processor (scripts/process_kindlegen_jobs.py), whose --wine-pool
+keeps wineservers running between jobs. This script starts Wine in the
+default prefix on every call, so it never touches (or recycles) the
+processor's pool prefixes.
+"""
+
 import subprocess
+import functools
+import shutil
 import sys
 import os
 
+@functools.lru_cache(maxsize=None)
+def wine_command():
+    """Wine launcher to use: wine64 if it is installed, wine otherwise (looked up once)."""
+    return 'wine64' if shutil.which('wine64') else 'wine'
+
 def run_kindlegen(opf_file, output_file=None):
     """
     Run kindlegen.exe through Wine in headless mode, capturing both stdout and stderr.
@@ -29,14 +46,8 @@ def run_kindlegen(opf_file, output_file=None):
     env['WINEDLLOVERRIDES'] = 'mscoree,mshtml=' # Wyłączenie niektórych DLL
     
     # Użycie wine64 zamiast wine, jeśli dostępne
-    wine_cmd = 'wine'
-    try:
-        # Sprawdź, czy wine64 jest dostępne
-        subprocess.run(['which', 'wine64'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        wine_cmd = 'wine64'
-        logger.info("Using wine64 command")
-    except:
-        logger.info("Using wine command")
+    wine_cmd = wine_command()
+    logger.info(f"Using {wine_cmd} command")
     
     command = [wine_cmd, kindlegen_path]
     command.append(opf_file)